@@ -40,6 +40,12 @@ def EventAdmin(EventModel, SuperModel=MPTTModelAdmin): #pass in the name of your
             super(_EventAdmin, self).__init__(*args, **kwargs)
             self.occurrence_model = self.model.occurrences.related.model
         
+        def queryset(self, request):
+            qs = super(_EventAdmin, self).queryset(request)
+            if EventModel.OccurrenceSummary() is not None: # occurrence_link reads the summaries
+                qs = qs.select_related('occurrence_summary')
+            return qs
+
         def occurrence_link(self, event):
             return '<a href="%s">View %s Occurrences</a>' % (
                 reverse("%s:%s_%s_changelist_for_event" % (
@@ -230,21 +236,11 @@ def OccurrenceAdmin(OccurrenceModel):
             return super(_OccurrenceAdmin, self).changelist_view(
                 request, extra_context)
 
-        def _get_event_ids(self, request):
-            # includes a little bit of caching
-            if hasattr(request, '_event'):
-                if not hasattr(request, '_event_ids'):
-                    descendants = request._event.get_descendants()
-                    request._event_ids = \
-                        descendants.values_list('id', flat=True)
-                return request._event_ids
-            return None
-
         def queryset(self, request):
             # limit to occurrences of descendents of request._event, if set
             queryset = super(_OccurrenceAdmin, self).queryset(request)
-            if self._get_event_ids(request):
-                queryset = queryset.filter(event__id__in=request._event_ids)
+            if hasattr(request, '_event') and not request._event.is_leaf_node():
+                queryset = queryset.in_subtree_of(request._event, include_self=False)
             return queryset
 
     return _OccurrenceAdmin
@@ -257,4 +253,7 @@ def GeneratorInline(GeneratorModel):
         formfield_overrides = {
             models.DateTimeField: {'form_class': DateAndMaybeTimeField},
             }        
+        if GeneratorModel.ExceptionModel() is not None:
+            # the exceptions are kept in their own table, so the field isn't used
+            exclude = ('exceptions',)
     return _GeneratorInline
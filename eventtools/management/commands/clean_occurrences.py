@@ -30,12 +30,9 @@ class Command(LabelCommand):
             generator_length = generator.event_end - generator.event_start
             for occurrence in generator.occurrences.all():
                 # Check if occurrence length doesn't match the generator length
-                # and make sure it's not an exception. We can't use
-                # .is_exception() because it tries to modify stuff.
-                if (not generator.exceptions
-                    or not generator.exceptions.has_key(
-                        occurrence.start.isoformat())
-                ) and occurrence.end - occurrence.start != generator_length:
+                # and make sure it's not an exception.
+                if not generator.is_exception(occurrence.start) \
+                        and occurrence.end - occurrence.start != generator_length:
                     bad_occurrences += 1
                     # Don't do anything on a dry run
                     if not dry_run:
@@ -61,10 +58,7 @@ class Command(LabelCommand):
                     # validation, it will fail
                     Model.save(generator)
                     for occurrence in generator.occurrences.all():
-                        if (not generator.exceptions
-                            or not generator.exceptions.has_key(
-                                occurrence.start.isoformat())
-                        ):
+                        if not generator.is_exception(occurrence.start):
                             occurrence.end = occurrence.end.replace(
                                 *occurrence.start.timetuple()[:3])
                             Model.save(occurrence)
@@ -72,18 +66,14 @@ class Command(LabelCommand):
             deleted_pks = []
             duplicates = 0
             for occurrence in generator.occurrences.all():
-                if not generator.exceptions \
-                        or not generator.exceptions.has_key(
-                            occurrence.start.isoformat()) \
+                if not generator.is_exception(occurrence.start) \
                         and not occurrence.pk in deleted_pks:
                     possible_duplicates = generator.occurrences.filter(
                         start=occurrence.start, end=occurrence.end).exclude(
                             pk=occurrence.pk)
                     if possible_duplicates:
                         for duplicate in possible_duplicates:
-                            if not generator.exceptions \
-                                    or not generator.exceptions.has_key(
-                                        duplicate.start.isoformat()):
+                            if not generator.is_exception(duplicate.start):
                                 duplicates += 1
                                 deleted_pks += [duplicate.pk]
                                 if not dry_run:
@@ -0,0 +1,72 @@
+from optparse import make_option
+
+from django.core.management.base import LabelCommand
+from django.db import connections, router, transaction
+from django.db.models.loading import get_model
+
+from ...conf import settings
+from ...models import OccurrenceModel
+
+class Command(LabelCommand):
+    args = '<app.Model app.Model ...>'
+    label = 'app.Model'
+    option_list = LabelCommand.option_list + (
+        make_option('--dry-run',
+            action='store_true', dest='dry_run', default=False,
+            help='Output the SQL without running it.'),
+        )
+    help = ('Create the indexes that eventtools settings and queries rely on '
+        'for the specified occurrence model (in app.Model format): a unique '
+        'index on (generator, start, end), or on (event, start, end) if '
+        'ALLOW_CLASHING_OCCURRENCES is False, for UNIQUE_OCCURRENCES, and an '
+        'index on (event, start) for by_next_occurrence(), and for '
+        'TreeOccurrenceModels, an index on (event_tree_id, event_lft, start) '
+        'for in_subtree_of(). Remove duplicate occurrences (eg. with '
+        'clean_occurrences) first.')
+
+    def handle_label(self, arg, **options):
+        dry_run = options.pop('dry_run', False)
+        verbosity = int(options.get('verbosity', 1))
+        assert len(arg.split('.')) == 2, 'Arguments must be in app.Model format.'
+        occurrence_model = get_model(*arg.split('.'))
+        assert issubclass(occurrence_model, OccurrenceModel), ('The model '
+            'must inherit from OccurrenceModel.')
+
+        using = router.db_for_write(occurrence_model)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        opts = occurrence_model._meta
+        field_names = [f.name for f in opts.fields]
+
+        if settings.ALLOW_CLASHING_OCCURRENCES and 'generator' in field_names:
+            owner = 'generator'
+        else:
+            owner = 'event'
+        columns = lambda names: u", ".join([qn(opts.get_field(name).column) for name in names])
+        statements = [u"CREATE UNIQUE INDEX %s ON %s (%s);" % (
+            qn('%s_%s_unique' % (opts.db_table, owner)),
+            qn(opts.db_table),
+            columns((owner, 'start', 'end')),
+        )]
+        if owner != 'event':
+            # otherwise the unique index covers (event, start)
+            statements.append(u"CREATE INDEX %s ON %s (%s);" % (
+                qn('%s_event_start' % opts.db_table),
+                qn(opts.db_table),
+                columns(('event', 'start')),
+            ))
+        if occurrence_model.tracks_event_tree:
+            statements.append(u"CREATE INDEX %s ON %s (%s);" % (
+                qn('%s_event_tree' % opts.db_table),
+                qn(opts.db_table),
+                columns(('event_tree_id', 'event_lft', 'start')),
+            ))
+
+        cursor = connection.cursor()
+        for sql in statements:
+            if verbosity or dry_run:
+                print sql
+            if not dry_run:
+                cursor.execute(sql)
+        if not dry_run:
+            transaction.commit_unless_managed(using=using)
@@ -0,0 +1,44 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db.models import get_models
+
+from ...models import RegenerationRequestModel
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size',
+            type='int', dest='batch_size', default=10,
+            help='How many requests to claim at a time.'),
+        make_option('--loop',
+            action='store_true', dest='loop', default=False,
+            help='Keep polling the queue, rather than stopping when it is empty.'),
+        make_option('--interval',
+            type='float', dest='interval', default=5,
+            help='Seconds to wait between polls of an empty queue with --loop.'),
+        )
+    help = ('Regenerate the generators queued while DEFER_REGENERATION is on. '
+        'Several of these can run at once.')
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        queues = [model for model in get_models() if issubclass(model, RegenerationRequestModel)]
+        while True:
+            requests = []
+            for RegenerationRequest in queues:
+                requests.extend(RegenerationRequest.objects.claim(options['batch_size']))
+            for request in requests:
+                try:
+                    request.run()
+                except Exception, e:
+                    # the claim times out, and the request is tried again
+                    sys.stderr.write('Regenerating %s failed: %s\n' % (request, e))
+                else:
+                    if verbosity > 1:
+                        print 'Regenerated %s.' % request
+            if not requests:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
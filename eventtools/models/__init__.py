@@ -2,4 +2,5 @@
 from .event import *
 from .occurrence import *
 from .generator import *
-from .rule import *
\ No newline at end of file
+from .rule import *
+from .regeneration import *
\ No newline at end of file
@@ -1,9 +1,13 @@
+import hashlib
+import uuid
+from datetime import datetime
 from operator import itemgetter
 
-from django.db import models
+from django.db import models, connections, router
 from django.db.models.base import ModelBase
 from django.db.models.fields import FieldDoesNotExist
-from django.db.models import Count
+from django.db.models import Count, Min, Max
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.template.defaultfilters import urlencode
@@ -11,24 +15,74 @@ from django.template.defaultfilters import urlencode
 from mptt.models import MPTTModel, MPTTModelBase
 from mptt.managers import TreeManager
 
-from eventtools.utils.inheritingdefault import ModelInstanceAwareDefault #TODO: deprecate
+
+from eventtools.conf import settings
+from eventtools.utils import datetimeify
 from eventtools.utils.pprint_timespan import pprint_datetime_span
 from eventtools.utils.dateranges import DateTester
 from eventtools.utils.domain import django_root_url
+from eventtools.utils.dirtyfields import DirtyFieldsMixin
+from eventtools.utils.treesnapshot import TreeSnapshot
+from eventtools.utils.bulk import chunks, bulk_insert, bulk_update
+
+class _FirstOccurrencePks(object):
+    """
+    The pks of the first (or with `descending`, the last) of `occurrences` of each event, by start, end and then pk, as
+    a subquery for a pk__in lookup. It's grouped joins on (event, start) and (event, start, end) of the events' first
+    starts, so the rows read grow with the number of occurrences, and it doesn't refer to the outer query, so it still
+    works when that is nested in another.
+    """
+    def __init__(self, occurrences, descending=False):
+        self.occurrences = occurrences
+        self.descending = descending
+
+    def prepare(self):
+        return self
+
+    def relabel_aliases(self, change_map):
+        pass # there are no references to the outer query to relabel
+
+    def as_sql(self, qn, connection):
+        Agg = self.descending and Max or Min
+        firsts, params = self.occurrences.order_by().values('event').annotate(_start=Agg('start')) \
+            .query.get_compiler(connection=connection).as_sql()
+        opts = self.occurrences.model._meta
+        names = {
+            'agg': Agg.name.upper(),
+            'table': qn(opts.db_table),
+            'pk': qn(opts.pk.column),
+            'event': qn(opts.get_field('event').column),
+            'start': qn(opts.get_field('start').column),
+            'end': qn(opts.get_field('end').column),
+            'first_start': qn('_start'),
+            'first_end': qn('_end'),
+            'firsts': firsts,
+        }
+        sql = (u"(SELECT %(agg)s(o.%(pk)s) FROM %(table)s o INNER JOIN ("
+            u"SELECT o.%(event)s, o.%(start)s, %(agg)s(o.%(end)s) AS %(first_end)s "
+            u"FROM %(table)s o INNER JOIN (%(firsts)s) f "
+            u"ON o.%(event)s = f.%(event)s AND o.%(start)s = f.%(first_start)s "
+            u"GROUP BY o.%(event)s, o.%(start)s"
+            u") e ON o.%(event)s = e.%(event)s AND o.%(start)s = e.%(start)s AND o.%(end)s = e.%(first_end)s "
+            u"GROUP BY o.%(event)s)") % names
+        return sql, params
+
 
 class EventQuerySet(models.query.QuerySet):
     #much as you may be tempted to add "storts_between" and other OccurrenceQuerySet methods, resist (for the sake of DRYness and performance). Instead, use OccurrenceQuerySet.starts_between().events().
     def occurrences(self, *args, **kwargs):
         return self.model.Occurrence().objects.filter(event__in=self).filter(*args, **kwargs)
     
+    def _first_occurrences(self, descending=False):
+        """
+        The first (or with `descending`, the last) occurrence of each event, by start, end and then id, as
+        opening_occurrence() (closing_occurrence()) has them. It's one query however many events there are (see
+        _FirstOccurrencePks).
+        """
+        return self.occurrences(pk__in=_FirstOccurrencePks(self.occurrences(), descending))
+
     def opening_occurrences(self):
-        pks = []
-        for e in self:
-            try:
-                pks.append(e.opening_occurrence().id)
-            except AttributeError:
-                pass
-        return self.occurrences(pk__in=pks)
+        return self._first_occurrences()
         
     def opening_before(self, date):
         return self.opening_occurrences().before(date).events()
@@ -40,13 +94,7 @@ class EventQuerySet(models.query.QuerySet):
         return self.opening_occurrences().on(date).events()
 
     def closing_occurrences(self):
-        pks = []
-        for e in self:
-            try:
-                pks.append(e.closing_occurrence().id)
-            except AttributeError:
-                pass
-        return self.occurrences(pk__in=pks)
+        return self._first_occurrences(descending=True)
         
     def closing_before(self, date):
         return self.closing_occurrences().before(date).events()
@@ -57,59 +105,137 @@ class EventQuerySet(models.query.QuerySet):
     def closing_on(self, date):
         return self.closing_occurrences().on(date).events()
 
-    def _with_relatives_having(self, relatives_fn, *args, **kwargs):
+    def by_next_occurrence(self, after=None, include_descendants=False):
+        """
+        The events that have an occurrence starting at or after `after` (default: now), annotated with the start of
+        the first such occurrence as `next_start`, and ordered by it. With `include_descendants`, the occurrences of
+        each event's descendants count too.
+
+        `next_start` is picked in the database with a correlated subquery, so the result can be sliced (paginated)
+        without fetching occurrences. It's returned as the database returns it, which on SQLite is a string. Create
+        an index on the occurrences' (event, start) (see the create_occurrence_indexes command) to keep this fast.
+        """
+        after = datetimeify(after or datetime.now(), clamp="min")
+        Occurrence = self.model.Occurrence()
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        occurrence_opts = Occurrence._meta
+        table = qn(opts.db_table)
+        column = lambda attr: qn(opts.get_field(attr).column)
+        start = qn(occurrence_opts.get_field('start').column)
+        event = qn(occurrence_opts.get_field('event').column)
+
+        if include_descendants:
+            mptt = self.model._mptt_meta
+            subquery = (
+                u"SELECT MIN(o.%s) FROM %s o INNER JOIN %s d ON d.%s = o.%s "
+                u"WHERE d.%s = %s.%s AND d.%s >= %s.%s AND d.%s <= %s.%s AND o.%s >= %%s" % (
+                    start, qn(occurrence_opts.db_table), table, column(opts.pk.name), event,
+                    column(mptt.tree_id_attr), table, column(mptt.tree_id_attr),
+                    column(mptt.left_attr), table, column(mptt.left_attr),
+                    column(mptt.right_attr), table, column(mptt.right_attr),
+                    start)
+            )
+        else:
+            subquery = u"SELECT MIN(o.%s) FROM %s o WHERE o.%s = %s.%s AND o.%s >= %%s" % (
+                start, qn(occurrence_opts.db_table), event, table, column(opts.pk.name), start)
+        params = [connection.ops.value_to_db_datetime(after)]
+        return self.extra(
+            select={'next_start': u"(%s)" % subquery}, select_params=params,
+            where=[u"(%s) IS NOT NULL" % subquery], params=params,
+            order_by=['next_start', 'pk'],
+        )
+
+    def _relatives_filter(self, relation, candidates, exclude=False):
+        """
+        Return the items in self that have (or with `exclude`, don't have) relatives of the given kind among the
+        `candidates` queryset. `relation` is one of 'children', 'descendants', 'descendants_and_self', 'parent' or
+        'ancestors'.
+
+        This is one EXISTS (or NOT EXISTS) subquery that compares the MPTT columns of each item with those of the
+        candidates, rather than a query per item.
+        """
+        opts = self.model._meta
+        mptt = self.model._mptt_meta
+        qn = connections[self.db].ops.quote_name
+        column = lambda attr: qn(opts.get_field(attr).column)
+        table = qn(opts.db_table)
+        outer = lambda attr: u"%s.%s" % (table, column(attr))
+        relative = lambda attr: u"r.%s" % column(attr)
+
+        tree, left, right = mptt.tree_id_attr, mptt.left_attr, mptt.right_attr
+        if relation == 'children':
+            conditions = [u"%s = %s" % (relative(mptt.parent_attr), outer(opts.pk.name))]
+        elif relation == 'parent':
+            conditions = [u"%s = %s" % (relative(opts.pk.name), outer(mptt.parent_attr))]
+        elif relation in ('descendants', 'descendants_and_self'):
+            inclusive = relation == 'descendants_and_self' and u"=" or u""
+            conditions = [
+                u"%s = %s" % (relative(tree), outer(tree)),
+                u"%s >%s %s" % (relative(left), inclusive, outer(left)),
+                u"%s <%s %s" % (relative(right), inclusive, outer(right)),
+            ]
+        elif relation == 'ancestors':
+            conditions = [
+                u"%s = %s" % (relative(tree), outer(tree)),
+                u"%s < %s" % (relative(left), outer(left)),
+                u"%s > %s" % (relative(right), outer(right)),
+            ]
+        else:
+            raise ValueError("Unknown relation '%s'." % relation)
+
+        candidates = candidates.order_by().values(opts.pk.name, mptt.parent_attr, tree, left, right)
+        sql, params = candidates.query.get_compiler(using=self.db).as_sql()
+        where = u"%sEXISTS (SELECT 1 FROM (%s) r WHERE %s)" % (
+            exclude and u"NOT " or u"", sql, u" AND ".join(conditions))
+        return self.extra(where=[where], params=list(params))
+
+    def _relatives(self, relation):
+        """
+        The events that can be relatives of the given kind. A parent has to be in self.
+        """
+        if relation == 'parent':
+            return self.all()
+        return self.model._event_manager.all()
+
+    def _with_relatives_having(self, relation, *args, **kwargs):
         """
         Return the set of items in self that have relatives matching a particular criteria.
         """
-        match_ids = set()
-        for obj in self:
-            matches = relatives_fn(obj)
-            if matches.count(): #weird bug where filter returns results on an empty qs!
-                matches = matches.filter(*args, **kwargs)
-                if matches.count():
-                    match_ids.add(obj.id)
-        return self.filter(id__in=match_ids)
+        return self._relatives_filter(relation, self._relatives(relation).filter(*args, **kwargs))
 
     def with_children_having(self, *args, **kwargs):
-        return self._with_relatives_having(lambda x: x.get_children(), *args, **kwargs)
+        return self._with_relatives_having('children', *args, **kwargs)
         
     def with_descendants_having(self, *args, **kwargs):
         include_self = kwargs.pop('include_self', True)
-        return self._with_relatives_having(lambda x: x.get_descendants(include_self=include_self), *args, **kwargs)
+        return self._with_relatives_having(include_self and 'descendants_and_self' or 'descendants', *args, **kwargs)
 
     def with_parent_having(self, *args, **kwargs):
-        return self._with_relatives_having(lambda x: self.filter(id=x.parent_id), *args, **kwargs)
+        return self._with_relatives_having('parent', *args, **kwargs)
 
     def with_ancestors_having(self, *args, **kwargs):
-        return self._with_relatives_having(lambda x: x.get_ancestors(), *args, **kwargs)
+        return self._with_relatives_having('ancestors', *args, **kwargs)
 
-    def _without_relatives_having(self, relatives_fn, *args, **kwargs):
+    def _without_relatives_having(self, relation, *args, **kwargs):
         """
         Return the set of items in self that have 0 relatives matching a particular criteria.
         """
-        match_ids = set()
-        for obj in self:
-            matches = relatives_fn(obj)
-            if matches.count(): #weird bug where filter returns results on an empty qs!
-                matches = matches.filter(*args, **kwargs)
-                if matches.count() == 0:
-                    match_ids.add(obj.id)
-            else: #no relatives => win
-                    match_ids.add(obj.id)                
-        return self.filter(id__in=match_ids)
+        return self._relatives_filter(relation, self._relatives(relation).filter(*args, **kwargs), exclude=True)
         
     def without_children_having(self, *args, **kwargs):
-        return self._without_relatives_having(lambda x: x.get_children(), *args, **kwargs)
+        return self._without_relatives_having('children', *args, **kwargs)
 
     def without_descendants_having(self, *args, **kwargs):
         include_self = kwargs.pop('include_self', True)
-        return self._without_relatives_having(lambda x: x.get_descendants(include_self=include_self), *args, **kwargs)
+        return self._without_relatives_having(include_self and 'descendants_and_self' or 'descendants', *args, **kwargs)
 
     def without_parent_having(self, *args, **kwargs):
-        return self._without_relatives_having(lambda x: self.filter(id=x.parent_id), *args, **kwargs)
+        return self._without_relatives_having('parent', *args, **kwargs)
 
     def without_ancestors_having(self, *args, **kwargs):
-        return self._without_relatives_having(lambda x: x.get_ancestors(), *args, **kwargs)
+        return self._without_relatives_having('ancestors', *args, **kwargs)
         
     #some simple annotations
     def having_occurrences(self):
@@ -130,10 +256,15 @@ class EventQuerySet(models.query.QuerySet):
         This is a good first blush at 'The List Of Events', since it is the longest list of events whose descendants'
         occurrences will cover the entire set of occurrences with no repetitions.
         """
-        return self.having_occurrences()._without_relatives_having(
-            lambda x: x.get_ancestors().annotate(num_occurrences=Count('occurrences')),
-            num_occurrences__gt=0
-        )
+        return self.having_occurrences()._relatives_filter(
+            'ancestors', self.model._event_manager.having_occurrences(), exclude=True)
+
+    def robot_descriptions(self):
+        """
+        A dict of {event id: robot_description()} for these events, in a few queries (see
+        EventModel.robot_descriptions()).
+        """
+        return self.model.robot_descriptions(self.values_list('pk', flat=True))
 
 
 class EventTreeManager(TreeManager):
@@ -161,6 +292,10 @@ class EventTreeManager(TreeManager):
         return self.get_query_set().closing_between(*args, **kwargs)
     def closing_on(self, *args, **kwargs):
         return self.get_query_set().closing_on(*args, **kwargs)        
+    def by_next_occurrence(self, *args, **kwargs):
+        return self.get_query_set().by_next_occurrence(*args, **kwargs)
+    def robot_descriptions(self):
+        return self.get_query_set().robot_descriptions()
     def with_children_having(self, *args, **kwargs):
         return self.get_query_set().with_children_having(*args, **kwargs)        
     def with_descendants_having(self, *args, **kwargs):
@@ -197,8 +332,10 @@ class EventOptions(object):
     """
     
     fields_to_inherit = []
+    inherited_fields = [] # (name, attname) pairs, filled in by EventModelBase
     event_manager_class = EventTreeManager
     event_manager_attr = 'eventobjects'
+    cache_tree = False # keep a TreeSnapshot of the events in the cache (see EventModel.tree_snapshot())
     
     def __init__(self, opts):
         # Override defaults with options provided
@@ -228,13 +365,15 @@ class EventModelBase(MPTTModelBase):
             # copies)
             pass
         else:
+            # the fields that new events created with a parent take from it (see EventModel.__init__)
+            inherited_fields = []
             for field_name in class_dict['_event_meta'].fields_to_inherit:
                 try:
                     field = cls._meta.get_field(field_name)
-                    #injecting our fancy inheriting default
-                    field.default = ModelInstanceAwareDefault(field_name, field.default)
                 except models.FieldDoesNotExist:
                     continue
+                inherited_fields.append((field.name, field.attname))
+            cls._event_meta.inherited_fields = inherited_fields
             
             # Add a custom manager
             assert issubclass(cls._event_meta.event_manager_class, EventTreeManager), 'Custom Event managers must subclass EventTreeManager.'
@@ -248,29 +387,87 @@ class EventModelBase(MPTTModelBase):
 
         return cls
 
-class EventModel(MPTTModel):
+_tree_snapshots = {} # {model: (version, TreeSnapshot)}, the last snapshot each process has seen
+
+class EventModel(DirtyFieldsMixin, MPTTModel):
     __metaclass__ = EventModelBase
     
     parent = models.ForeignKey('self', null=True, blank=True, related_name='children')
 
     class Meta:
         abstract = True
+
+    def __init__(self, *args, **kwargs):
+        """
+        An event created with a `parent` takes the parent's values for the fields_to_inherit that aren't given.
+        """
+        parent = kwargs.get('parent', None)
+        if parent is not None and not args:
+            for name, attname in type(self)._event_meta.inherited_fields:
+                if name not in kwargs and attname not in kwargs:
+                    kwargs[attname] = getattr(parent, attname)
+        super(EventModel, self).__init__(*args, **kwargs)
     
     def update_endless_generators(self):
         if hasattr(self, 'generators'):
             endless_generators = self.generators.filter(rule__isnull=False, repeat_until__isnull=True)
             for generator in endless_generators:
+                if settings.DEFER_REGENERATION:
+                    generator.request_regeneration(incremental=True)
+                    continue
                 # An AttributeError usually means that the generator fails
                 # validation. There's no need to stop the event from saving.
                 try:
-                    generator.generate()
+                    # only generate what has come within the horizon since last time
+                    generator.generate(incremental=True)
                 except AttributeError:
                     pass
     
     def save(self, *args, **kwargs):
-        self.cascade_changes_to_children()
+        """
+        Pass update_descendant_generators=True to also update the endless generators of the descendants that inherit
+        a changed field (see cascade_changes_to_children).
+        """
+        update_descendant_generators = kwargs.pop('update_descendant_generators', False)
+        self.cascade_changes_to_children(update_generators=update_descendant_generators)
         self.update_endless_generators()
-        return super(EventModel, self).save(*args, **kwargs)
+
+        saved_self, moved = None, False
+        if self.OccurrenceSummary() is not None or self.Occurrence().tracks_event_tree or self._event_meta.cache_tree:
+            saved_self = self.saved_instance()
+            moved = saved_self is None or saved_self.parent_id != self.parent_id
+        result = super(EventModel, self).save(*args, **kwargs)
+        self.Occurrence().occurrences_changed() # their summaries, URLs etc. come from the event
+        if moved:
+            type(self).invalidate_tree_snapshot()
+            # the subtree summaries of both trees have changed, as have the lfts of the events after this one
+            type(self).refresh_occurrence_summaries([self.pk, saved_self and saved_self.parent_id])
+            tree_id_attr = self._mptt_meta.tree_id_attr
+            self.Occurrence().refresh_event_tree_fields(
+                [getattr(self, tree_id_attr), saved_self and getattr(saved_self, tree_id_attr)])
+        return result
+
+    def delete(self, *args, **kwargs):
+        parent_id = self.parent_id
+        tree_id = getattr(self, self._mptt_meta.tree_id_attr)
+        super(EventModel, self).delete(*args, **kwargs)
+        type(self).invalidate_tree_snapshot()
+        self.Occurrence().occurrences_changed()
+        if parent_id is not None:
+            type(self).refresh_occurrence_summaries([parent_id])
+            self.Occurrence().refresh_event_tree_fields([tree_id])
+
+    def move_to(self, target, position='first-child'):
+        """
+        As MPTTModel.move_to(). Moves can renumber other trees too, so all the occurrences' event tree fields are
+        checked (see TreeOccurrenceModel).
+        """
+        parent_id = self.parent_id
+        super(EventModel, self).move_to(target, position)
+        type(self).invalidate_tree_snapshot()
+        self.Occurrence().occurrences_changed()
+        type(self).refresh_occurrence_summaries([self.pk, parent_id])
+        self.Occurrence().refresh_event_tree_fields()
                 
     @classmethod
     def Occurrence(cls):
@@ -281,6 +478,173 @@ class EventModel(MPTTModel):
         if hasattr(cls, 'generators'):
             return cls.generators.related.model
 
+    @classmethod
+    def OccurrenceSummary(cls):
+        """
+        The OccurrenceSummaryModel subclass for this model, or None if occurrences aren't summarised.
+        """
+        descriptor = getattr(cls, 'occurrence_summary', None)
+        if descriptor is None:
+            return None
+        return descriptor.related.model
+
+    @classmethod
+    def refresh_occurrence_summaries(cls, event_ids):
+        """
+        Recalculate the occurrence summaries of the events with the given ids, and of the other events in their trees
+        (whose subtree figures may have changed), in a handful of queries. Does nothing if occurrences aren't
+        summarised.
+        """
+        Summary = cls.OccurrenceSummary()
+        event_ids = [pk for pk in set(event_ids) if pk is not None]
+        if Summary is None or not event_ids:
+            return
+
+        mptt = cls._mptt_meta
+        tree_ids = set()
+        for chunk in chunks(event_ids):
+            tree_ids.update(cls._event_manager.filter(pk__in=chunk).values_list(mptt.tree_id_attr, flat=True))
+        if not tree_ids:
+            return
+        in_trees = {'%s__in' % mptt.tree_id_attr: list(tree_ids)}
+        nodes = list(cls._event_manager.filter(**in_trees).order_by(
+            mptt.tree_id_attr, mptt.left_attr).values_list('pk', mptt.parent_attr))
+
+        own = cls._own_summary_figures([pk for pk, parent_id in nodes], cls.Occurrence().objects.filter(**dict([
+            ('event__%s' % key, value) for key, value in in_trees.items()])))
+
+        # roll the figures up the trees, children (which come after their parents) first
+        subtree = dict([(pk, list(figures)) for pk, figures in own.items()])
+        for pk, parent_id in reversed(nodes):
+            if parent_id in subtree:
+                subtree[parent_id] = _combine_summaries(subtree[parent_id], subtree[pk])
+
+        existing = {}
+        for chunk in chunks(own.keys()):
+            existing.update(Summary._default_manager.filter(event__in=chunk).values_list('event', 'pk'))
+        values = {}
+        new = []
+        for pk in own:
+            fields = dict(zip(OCCURRENCE_SUMMARY_FIELDS, own[pk] + subtree[pk]))
+            if pk in existing:
+                values[existing[pk]] = fields
+            else:
+                new.append(Summary(event_id=pk, **fields))
+        bulk_update(Summary, values)
+        bulk_insert(Summary, new)
+
+    @classmethod
+    def refresh_occurrence_summary_branches(cls, event_ids):
+        """
+        Recalculate the occurrence summaries of the events with the given ids, whose own occurrences have changed, and
+        of their ancestors. The ancestors' subtree figures are rolled up from the stored summaries of their other
+        children, so the rest of the tree isn't read. Falls back to refresh_occurrence_summaries() if any of those
+        summaries are missing. Does nothing if occurrences aren't summarised.
+        """
+        Summary = cls.OccurrenceSummary()
+        event_ids = set([pk for pk in event_ids if pk is not None])
+        if Summary is None or not event_ids:
+            return
+
+        # the events and their ancestors, a level of the tree at a time
+        mptt = cls._mptt_meta
+        levels = {}
+        frontier = list(event_ids)
+        while frontier:
+            parent_ids = set()
+            for chunk in chunks(frontier):
+                for pk, parent_id, level in cls._event_manager.filter(pk__in=chunk).values_list(
+                        'pk', mptt.parent_attr, mptt.level_attr):
+                    levels[pk] = level
+                    if parent_id is not None:
+                        parent_ids.add(parent_id)
+            frontier = [pk for pk in parent_ids if pk not in levels]
+        branches = levels.keys()
+        if not branches:
+            return
+        children = {}
+        for chunk in chunks(branches):
+            for pk, parent_id in cls._event_manager.filter(**{'%s__in' % mptt.parent_attr: chunk}).values_list(
+                    'pk', mptt.parent_attr):
+                children.setdefault(parent_id, []).append(pk)
+
+        stored = {}
+        needed = set(branches)
+        for child_ids in children.values():
+            needed.update(child_ids)
+        for chunk in chunks(list(needed)):
+            for row in Summary._default_manager.filter(event__in=chunk).values_list(
+                    'event', 'pk', *OCCURRENCE_SUMMARY_FIELDS):
+                stored[row[0]] = row[1:]
+        if len(stored) < len(needed):
+            cls.refresh_occurrence_summaries(event_ids)
+            return
+
+        changed = [pk for pk in branches if pk in event_ids]
+        own = dict([(pk, list(stored[pk][1:6])) for pk in branches])
+        own.update(cls._own_summary_figures(changed, cls.Occurrence().objects.filter(event__in=changed)))
+
+        # roll the figures up the branches, deepest first
+        subtree = {}
+        for pk in sorted(branches, key=lambda pk: -levels[pk]):
+            figures = own[pk]
+            for child_id in children.get(pk, []):
+                figures = _combine_summaries(figures, subtree.get(child_id) or list(stored[child_id][6:]))
+            subtree[pk] = figures
+        bulk_update(Summary, dict([
+            (stored[pk][0], dict(zip(OCCURRENCE_SUMMARY_FIELDS, own[pk] + subtree[pk]))) for pk in branches]))
+
+    @classmethod
+    def _own_summary_figures(cls, event_ids, occurrences):
+        """
+        Each event's own figures, [first_start, last_start, last_end, next_start, count], from `occurrences`.
+        """
+        own = dict([(pk, [None, None, None, None, 0]) for pk in event_ids])
+        occurrences = occurrences.order_by()
+        for row in occurrences.values('event').annotate(
+                first_start=Min('start'), last_start=Max('start'), last_end=Max('end'), count=Count('pk')):
+            figures = own[row['event']]
+            figures[0], figures[1], figures[2], figures[4] = \
+                row['first_start'], row['last_start'], row['last_end'], row['count']
+        for event_id, next_start in occurrences.filter(start__gte=datetime.now()).values('event').annotate(
+                next_start=Min('start')).values_list('event', 'next_start'):
+            own[event_id][3] = next_start
+        return own
+
+    def _occurrence_summary(self):
+        """
+        This event's OccurrenceSummaryModel, refreshed if need be, or None if occurrences aren't summarised.
+        """
+        Summary = self.OccurrenceSummary()
+        if Summary is None or self.pk is None:
+            return None
+        try:
+            summary = self.occurrence_summary
+        except Summary.DoesNotExist:
+            summary = None
+        if summary is None:
+            type(self).refresh_occurrence_summaries([self.pk])
+            summary = Summary._default_manager.get(event=self.pk)
+            setattr(self, type(self).occurrence_summary.cache_name, summary)
+        elif summary.is_stale():
+            self._refresh_next_starts(summary)
+        return summary
+
+    def _refresh_next_starts(self, summary):
+        """
+        Recalculate the next starts of this event's summary, whose time has passed, updating just its row. The rest
+        of the summary is unaffected by time passing, and the other summaries in the tree are refreshed as they are
+        read.
+        """
+        now = datetime.now()
+        if summary.next_start is not None and summary.next_start < now:
+            summary.next_start = self.occurrences.filter(start__gte=now).aggregate(
+                next_start=Min('start'))['next_start']
+        summary.subtree_next_start = self.get_descendants().occurrences(start__gte=now).aggregate(
+            next_start=Min('start'))['next_start']
+        type(summary)._default_manager.filter(pk=summary.pk).update(
+            next_start=summary.next_start, subtree_next_start=summary.subtree_next_start)
+
         
     def reload(self):
         """
@@ -288,36 +652,87 @@ class EventModel(MPTTModel):
         """
         return type(self)._event_manager.get(pk=self.pk)
         
-    def cascade_changes_to_children(self):
-        if self.pk:
-            saved_self = type(self)._event_manager.get(pk=self.pk)
-            attribs = type(self)._event_meta.fields_to_inherit
-        
-            for child in self.get_children():
-                for a in attribs:
-                    try:
-                        saved_value = getattr(saved_self, a)
-                        ch_value = getattr(child, a)
-                        if ch_value == saved_value: #the child inherits this value from the parent
-                            new_value = getattr(self, a)
-                            setattr(child, a, new_value)
-                    except AttributeError:
-                        continue
-                child.save() #cascades to grandchildren
+    def cascade_changes_to_children(self, update_generators=False):
+        """
+        Give the new value of each changed field in fields_to_inherit to the descendants that inherit it, ie. those
+        that have the old value, as do all the events between them and self.
+
+        The descendants are read in one query, and updated with one UPDATE per changed field (per chunk), so they
+        aren't saved and no signals are sent. With `update_generators`, the endless generators of the updated
+        descendants are then updated.
+        """
+        if not self.pk:
+            return
+        saved_self = self.saved_instance()
+        changed = []
+        for a in type(self)._event_meta.fields_to_inherit:
+            try:
+                field = self._meta.get_field(a)
+            except FieldDoesNotExist:
+                continue
+            saved_value, new_value = getattr(saved_self, field.attname), getattr(self, field.attname)
+            if saved_value != new_value:
+                changed.append((field, saved_value, new_value))
+        if not changed:
+            return
+
+        mptt = self._mptt_meta
+        descendants = self.get_descendants(include_self=False).order_by(mptt.tree_id_attr, mptt.left_attr)
+        rows = list(descendants.values_list('pk', mptt.parent_attr, *[field.name for field, old, new in changed]))
+
+        updated = set()
+        for i, (field, saved_value, new_value) in enumerate(changed):
+            # parents come before their children, so each row can look up whether its parent inherits
+            inherits = {self.pk: True}
+            pks = []
+            for row in rows:
+                pk, parent_id, value = row[0], row[1], row[2 + i]
+                inherits[pk] = inherits.get(parent_id, False) and value == saved_value
+                if inherits[pk]:
+                    pks.append(pk)
+            for chunk in chunks(pks):
+                type(self)._event_manager.filter(pk__in=chunk).update(**{field.name: new_value})
+            updated.update(pks)
+
+        if update_generators:
+            for descendant in type(self)._event_manager.filter(pk__in=list(updated)):
+                descendant.update_endless_generators()
                 
     def occurrence_count(self, include_descendants=True):
+        summary = self._occurrence_summary()
+        if summary is not None:
+            if include_descendants:
+                return summary.subtree_count
+            return summary.count
         if include_descendants:
             return self.get_descendants().occurrences().count()
         else:
             return self.occurrences.count()
         
     def opening_occurrence(self):
+        summary = self._occurrence_summary()
+        if summary is not None:
+            if not summary.count:
+                return None
+            # only the occurrences that start at the summary's first start are read, through the index on start
+            try:
+                return self.occurrences.filter(start=summary.first_start)[0]
+            except IndexError:
+                pass # the summary is out of date
         try:
             return self.occurrences.all()[0]
         except IndexError:
             return None
         
     def closing_occurrence(self):
+        summary = self._occurrence_summary()
+        if summary is not None:
+            if not summary.count:
+                return None
+            try:
+                return self.occurrences.filter(start=summary.last_start).reverse()[0]
+            except IndexError:
+                pass # the summary is out of date
         try:
             return self.occurrences.all().reverse()[0]
         except IndexError:
@@ -332,35 +747,194 @@ class EventModel(MPTTModel):
         return descendantsqs
 
     def get_family(self, include_self=True):
+        snapshot = self._tree_snapshot_of_self()
+        if snapshot is not None:
+            return type(self)._event_manager.filter(pk__in=snapshot.family_ids(self.pk, include_self=include_self))
         #have to call super, because the clone buggers up the filter...
         familyqs = super(EventModel, self).get_ancestors() | super(EventModel, self).get_descendants(include_self=include_self)
         return familyqs
-        
+
+    def ancestor_ids(self, include_self=False):
+        """
+        The ids of this event's ancestors, root first, from the tree snapshot if there is one.
+        """
+        snapshot = self._tree_snapshot_of_self()
+        if snapshot is not None:
+            return snapshot.ancestor_ids(self.pk, include_self=include_self)
+        ids = list(super(EventModel, self).get_ancestors().values_list('pk', flat=True))
+        return include_self and ids + [self.pk] or ids
+
+    def descendant_ids(self, include_self=False):
+        """
+        The ids of this event's descendants, in tree order, from the tree snapshot if there is one.
+        """
+        snapshot = self._tree_snapshot_of_self()
+        if snapshot is not None:
+            return snapshot.descendant_ids(self.pk, include_self=include_self)
+        return list(super(EventModel, self).get_descendants(include_self=include_self).values_list('pk', flat=True))
+
+    def family_ids(self, include_self=True):
+        """
+        The ids of this event's ancestors and descendants, in tree order, from the tree snapshot if there is one.
+        """
+        return self.ancestor_ids() + self.descendant_ids(include_self=include_self)
+
     def highest_ancestor_having_occurrences(self, include_self=True, test=False):
-        ancestors = self.get_ancestors()
-        if ancestors:
-            ancestors_with_occurrences = ancestors.having_occurrences()
-            if ancestors_with_occurrences:
-                return ancestors_with_occurrences[0]
+        snapshot = self._tree_snapshot_of_self()
+        if snapshot is not None:
+            ancestor_ids = snapshot.ancestor_ids(self.pk)
+            if ancestor_ids:
+                having = set(self.Occurrence().objects.filter(event__in=ancestor_ids).values_list('event', flat=True))
+                for pk in ancestor_ids:
+                    if pk in having:
+                        return type(self)._event_manager.get(pk=pk)
+        else:
+            ancestors = self.get_ancestors()
+            if ancestors:
+                ancestors_with_occurrences = ancestors.having_occurrences()
+                if ancestors_with_occurrences:
+                    return ancestors_with_occurrences[0]
         if include_self and self.occurrence_count():
             return self
         return None
+
+    @classmethod
+    def tree_snapshot(cls):
+        """
+        A TreeSnapshot of all the events, if EventMeta.cache_tree is set (otherwise None).
+
+        The snapshot is kept in the default cache under a version that creating, moving or deleting events replaces
+        (see invalidate_tree_snapshot()), and in memory for as long as that version is current, so lookups only cost
+        a cache get of the version.
+
+        Every process needs to see the same version, so the default cache should be shared between them (eg.
+        memcached). With a per-process cache (eg. locmem), other processes don't see a change to the tree until
+        EVENT_TREE_CACHE_TIMEOUT has passed. With the dummy cache, which keeps nothing, each call builds a new
+        snapshot.
+        """
+        if not cls._event_meta.cache_tree:
+            return None
+        timeout = settings.EVENT_TREE_CACHE_TIMEOUT
+        version_key = 'eventtools.tree_version.%s' % cls._meta.db_table
+        version = cache.get(version_key)
+        if version is None:
+            cache.add(version_key, uuid.uuid4().hex, timeout)
+            version = cache.get(version_key)
+            if version is None: # eg. the dummy cache, so there's no telling whether a snapshot is current
+                _tree_snapshots.pop(cls, None)
+                return cls._build_tree_snapshot()
+        current = _tree_snapshots.get(cls)
+        if current is not None and current[0] == version:
+            return current[1]
+
+        snapshot_key = 'eventtools.tree.%s.%s' % (cls._meta.db_table, version)
+        snapshot = cache.get(snapshot_key)
+        if snapshot is None:
+            snapshot = cls._build_tree_snapshot()
+            cache.set(snapshot_key, snapshot, timeout)
+        _tree_snapshots[cls] = (version, snapshot)
+        return snapshot
+
+    @classmethod
+    def _build_tree_snapshot(cls):
+        mptt = cls._mptt_meta
+        return TreeSnapshot(cls._event_manager.order_by(mptt.tree_id_attr, mptt.left_attr).values_list(
+            'pk', mptt.parent_attr, mptt.tree_id_attr, mptt.left_attr, mptt.right_attr, mptt.level_attr))
+
+    @classmethod
+    def invalidate_tree_snapshot(cls):
+        """
+        Start a new version of the tree snapshot. Events that are created, moved or deleted do this themselves; call
+        it after changing the tree in other ways (eg. with TreeManager.move_node() or rebuild()).
+        """
+        if cls._event_meta.cache_tree:
+            cache.set('eventtools.tree_version.%s' % cls._meta.db_table, uuid.uuid4().hex,
+                settings.EVENT_TREE_CACHE_TIMEOUT)
+
+    def _tree_snapshot_of_self(self):
+        """
+        The tree snapshot, if there is one and it includes this event.
+        """
+        snapshot = type(self).tree_snapshot()
+        if snapshot is not None and self.pk in snapshot:
+            return snapshot
+        return None
         
     def get_absolute_url(self):
         return reverse('event', kwargs={'event_slug': self.slug })
         
     def robot_description(self):
-        spans = reduce(list.__add__, [gen.get_spans() for gen in self.generators.all()])
-        spans.sort(key=itemgetter(0))
-        repeated_spans = u'\n'.join([pprint_datetime_span(start, end) + repeat_description \
-            for start, end, repeat_description in spans if repeat_description])
-        ordinary_spans = u'\n'.join([pprint_datetime_span(start, end) \
-            for start, end, repeat_description in spans if not repeat_description])
-        if repeated_spans and ordinary_spans:
-            repeated_spans += '\n\n'
-        return repeated_spans + ordinary_spans
+        return type(self).robot_descriptions([self.pk]).get(self.pk, u'')
+
+    @classmethod
+    def robot_descriptions(cls, event_ids):
+        """
+        A dict of {event id: robot_description()} for the events with the given ids, built from their generators and
+        rules, their generators' occurrence counts, and the occurrences of the generators with only a few of them, in
+        three queries (rather than a few per generator).
+
+        Descriptions are cached for ROBOT_DESCRIPTION_CACHE_TIMEOUT under a key made from all that, so it changes
+        whenever one of the event's generators (or their rules or occurrences) does.
+        """
+        event_ids = [pk for pk in event_ids if pk is not None]
+        descriptions = dict([(pk, u'') for pk in event_ids])
+        Generator = cls.Generator()
+        if Generator is None or not event_ids:
+            return descriptions
+
+        generators = {}
+        by_pk = {}
+        for chunk in chunks(event_ids):
+            for generator in Generator._default_manager.filter(event__in=chunk).select_related('rule'):
+                generators.setdefault(generator.event_id, []).append(generator)
+                by_pk[generator.pk] = generator
+
+        Occurrence = Generator.Occurrence()
+        generator_field = Generator.occurrences.related.field.name
+        of_generators = lambda pks: Occurrence._default_manager.filter(**{'%s__in' % generator_field: pks})
+        counts = {}
+        for chunk in chunks(by_pk.keys()):
+            for row in of_generators(chunk).order_by().values(generator_field).annotate(count=Count('pk')):
+                counts[row[generator_field]] = row['count']
+        # generators with a rule and only a few occurrences are described by their occurrences
+        few = [pk for pk, generator in by_pk.items() if generator.rule_id and counts.get(pk, 0) <= 3]
+        occurrences = dict([(pk, []) for pk in few])
+        for chunk in chunks(few):
+            for pk, start, end in of_generators(chunk).values_list(generator_field, 'start', 'end'):
+                occurrences[pk].append((start, end))
+
+        keys = {}
+        for event_id, event_generators in generators.items():
+            signature = [(
+                g.pk, g.event_start, g.event_end, g.repeat_until, g.rule_id, g.rule and unicode(g.rule),
+                counts.get(g.pk, 0), occurrences.get(g.pk),
+            ) for g in event_generators]
+            keys[event_id] = 'eventtools.robot_description.%s' % hashlib.md5(
+                repr((cls._meta.db_table, event_id, signature))).hexdigest()
+
+        timeout = settings.ROBOT_DESCRIPTION_CACHE_TIMEOUT
+        cached = {}
+        if timeout is not None and keys:
+            cached = cache.get_many(keys.values())
+        missing = {}
+        for event_id, event_generators in generators.items():
+            key = keys[event_id]
+            if key in cached:
+                descriptions[event_id] = cached[key]
+                continue
+            spans = []
+            for generator in event_generators:
+                spans.extend(generator.get_spans(
+                    occurrence_count=counts.get(generator.pk, 0), occurrences=occurrences.get(generator.pk)))
+            descriptions[event_id] = missing[key] = _describe_spans(spans)
+        if timeout is not None and missing:
+            cache.set_many(missing, timeout)
+        return descriptions
 
     def has_finished(self):
+        summary = self._occurrence_summary()
+        if summary is not None:
+            return summary.last_end is None or summary.last_end < datetime.now()
         for o in self.occurrences.all():
             if not o.has_finished:
                 return False
@@ -383,4 +957,74 @@ class EventModel(MPTTModel):
         return self.ics_url().replace("http://", "webcal://").replace("https://", "webcal://")
         
     def gcal_url(self):
-        return  "http://www.google.com/calendar/render?cid=%s" % urlencode(self.ics_url())
\ No newline at end of file
+        return  "http://www.google.com/calendar/render?cid=%s" % urlencode(self.ics_url())
+
+
+OCCURRENCE_SUMMARY_FIELDS = (
+    'first_start', 'last_start', 'last_end', 'next_start', 'count',
+    'subtree_first_start', 'subtree_last_start', 'subtree_last_end', 'subtree_next_start', 'subtree_count',
+)
+
+def _describe_spans(spans):
+    """
+    The text of a robot description of (start, end, repeat_description) spans: the repeated spans, then the others,
+    each in order of start.
+    """
+    spans = sorted(spans, key=itemgetter(0))
+    repeated_spans = u'\n'.join([pprint_datetime_span(start, end) + repeat_description \
+        for start, end, repeat_description in spans if repeat_description])
+    ordinary_spans = u'\n'.join([pprint_datetime_span(start, end) \
+        for start, end, repeat_description in spans if not repeat_description])
+    if repeated_spans and ordinary_spans:
+        repeated_spans += '\n\n'
+    return repeated_spans + ordinary_spans
+
+def _combine_summaries(a, b):
+    """
+    Combine two lists of [first_start, last_start, last_end, next_start, count].
+    """
+    def pick(fn, x, y):
+        if x is None:
+            return y
+        if y is None:
+            return x
+        return fn(x, y)
+    return [pick(min, a[0], b[0]), pick(max, a[1], b[1]), pick(max, a[2], b[2]), pick(min, a[3], b[3]), a[4] + b[4]]
+
+class OccurrenceSummaryModel(models.Model):
+    """
+    An optional abstract model that keeps a summary of each event's occurrences (and those of its descendants), so
+    that listings can show them without querying the occurrences of every event.
+
+    Implementing subclasses should define an 'event' OneToOneField to an EventModel subclass. The related_name for
+    the field should be 'occurrence_summary':
+
+    event = models.OneToOneField(SomeEvent, related_name="occurrence_summary", primary_key=True)
+
+    The summaries are refreshed when occurrences are saved or deleted, by generators and by bulk deletes. Changes made
+    any other way (eg. QuerySet.update()) need EventModel.refresh_occurrence_summaries() to be called.
+    """
+    first_start = models.DateTimeField(null=True, editable=False)
+    last_start = models.DateTimeField(null=True, editable=False)
+    last_end = models.DateTimeField(null=True, editable=False)
+    next_start = models.DateTimeField(null=True, editable=False)
+    count = models.PositiveIntegerField(default=0, editable=False)
+    subtree_first_start = models.DateTimeField(null=True, editable=False)
+    subtree_last_start = models.DateTimeField(null=True, editable=False)
+    subtree_last_end = models.DateTimeField(null=True, editable=False)
+    subtree_next_start = models.DateTimeField(null=True, editable=False, db_index=True)
+    subtree_count = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def __unicode__(self):
+        return u"%s: %s occurrences" % (self.event, self.subtree_count)
+
+    def is_stale(self):
+        """
+        Whether time has moved past the next start, so the next start needs recalculating.
+        """
+        now = datetime.now()
+        return (self.next_start is not None and self.next_start < now) or \
+            (self.subtree_next_start is not None and self.subtree_next_start < now)
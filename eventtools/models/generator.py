@@ -1,5 +1,5 @@
 # −*− coding: UTF−8 −*−
-from django.db import models, transaction
+from django.db import models, transaction, connections, router, IntegrityError
 from django.db.models.base import ModelBase
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.core import exceptions
@@ -11,13 +11,97 @@ from rule import Rule, FREQUENCY_TIME_MAP
 from nosj.fields import JSONField
 
 from eventtools.utils import datetimeify
+from eventtools.utils.dirtyfields import DirtyFieldsMixin
+from eventtools.utils.bulk import (bulk_insert, bulk_update, supports_insert_ignore, chunks,
+    datetime_add_sql, time_of_day_sql, DATETIME_SQL_VENDORS)
 from eventtools.conf import settings
 from eventtools.utils.pprint_timespan import (
     pprint_datetime_span, pprint_date_span)
 
 from datetime import date, time, datetime, timedelta
 
-class GeneratorModel(models.Model):
+class GeneratorChangePlan(object):
+    """
+    The changes to make to a generator's occurrences when it is saved (see GeneratorModel.plan_changes):
+
+        • shift: {pk: (start, end)} for occurrences that move
+        • re_end: {pk: end} for occurrences that only change their end
+        • delete: the pks of occurrences to delete
+        • add: [(start, end), ...] for occurrences to generate
+        • time_shift: ('start' or 'end', old time, timedelta) if only the generator's start or end time changed, and
+          the database can shift the matching occurrences itself (see GeneratorModel._shift_times)
+
+    With `bulk`, apply() makes the changes with a few bulk DELETE, UPDATE and INSERT statements, and no occurrence
+    signals are sent. Otherwise it saves, deletes and creates each occurrence in turn, so Occurrence.save() and the
+    signals run, and deleted generated occurrences are added to the generator's exceptions.
+    """
+    def __init__(self):
+        self.shift = {}
+        self.re_end = {}
+        self.delete = set()
+        self.add = []
+        self.time_shift = None
+
+    def apply(self, generator, bulk=True):
+        Occurrence = generator.Occurrence()
+        if not bulk:
+            self._apply_one_by_one(generator, Occurrence)
+            return
+        if self.time_shift is not None:
+            generator._shift_times(*self.time_shift)
+        Occurrence._bulk_delete(self.delete)
+        values = dict([(pk, {'start': start, 'end': end}) for pk, (start, end) in self.shift.iteritems()])
+        values.update([(pk, {'end': end}) for pk, end in self.re_end.iteritems()])
+        bulk_update(Occurrence, values)
+        generator._insert_occurrences(self.add)
+        Occurrence.occurrences_changed()
+
+    def _apply_one_by_one(self, generator, Occurrence):
+        if self.time_shift is not None:
+            raise ValueError("A time_shift can only be applied in bulk.")
+        occurrences = {}
+        for chunk in chunks(list(self.delete) + self.shift.keys() + self.re_end.keys()):
+            occurrences.update(Occurrence._default_manager.in_bulk(chunk))
+        for pk, occurrence in occurrences.iteritems():
+            # so that the exceptions that saves and deletes add are kept in this instance too
+            if occurrence.generator_id == generator.pk:
+                occurrence.generator = generator
+        for pk in self.delete:
+            occurrences[pk].delete()
+        for pk, (start, end) in self.shift.iteritems():
+            occurrences[pk].start, occurrences[pk].end = start, end
+            occurrences[pk].save()
+        for pk, end in self.re_end.iteritems():
+            occurrences[pk].end = end
+            occurrences[pk].save()
+        for start, end in self.add:
+            generator.create_occurrence(start=start, end=end, honour_exceptions=True)
+
+
+class ICalSeries(object):
+    """
+    How to write a generator's occurrences in an iCalendar feed as one recurring VEVENT (see
+    GeneratorModel.ical_series):
+
+        • recur: the RRULE value, without UNTIL
+        • dtstart, until: the starts of the first and last occurrences of the series
+        • exdates: the starts between them that aren't in the feed
+        • instance_pk: the pk of the series' first occurrence, whose attributes the VEVENT has
+        • overrides: [(start, pk), ...] for edited occurrences, which replace the occurrence at `start`
+        • standalone: the pks of edited occurrences that are written as VEVENTs of their own
+    """
+    def __init__(self, generator, recur, dtstart, until, exdates, instance_pk, overrides, standalone):
+        self.generator = generator
+        self.recur = recur
+        self.dtstart = dtstart
+        self.until = until
+        self.exdates = exdates
+        self.instance_pk = instance_pk
+        self.overrides = overrides
+        self.standalone = standalone
+
+
+class GeneratorModel(DirtyFieldsMixin, models.Model):
     """
     A GeneratorModel generates Occurrences according to given rules. For example:
         • One occurrence, Tuesday 18th August 2010, 1500-1600
@@ -32,6 +116,9 @@ class GeneratorModel(models.Model):
 
     Generators without repeat_until limits potentially repeat infinitely. In this case, we generate occurrences until a
     set timedelta in the future. This timedelta is set in the setting 'DEFAULT_GENERATOR_LIMIT'.    
+
+    `generated_until` records how far occurrences have been generated, so that endless generators can be extended
+    without re-checking the occurrences they have already generated.
     """
 
     #define a field called 'event' in the subclass
@@ -40,6 +127,7 @@ class GeneratorModel(models.Model):
     rule = models.ForeignKey(Rule, verbose_name=_(u"repetition rule"), null = True, blank = True, help_text=_(u"Select '----' for a one-off event."))
     repeat_until = models.DateTimeField(null = True, blank = True, help_text=_(u"These start dates are ignored for one-off events."))
     exceptions = JSONField(null=True, blank=True, help_text=_(u"These dates are skipped by the generator."), default={})
+    generated_until = models.DateTimeField(null=True, blank=True, editable=False)
     
     class Meta:
         abstract = True
@@ -73,6 +161,9 @@ class GeneratorModel(models.Model):
     @transaction.commit_on_success()
     def save(self, *args, **kwargs):
         generate = kwargs.pop('generate', True)
+        defer = generate and settings.DEFER_REGENERATION
+        if defer: # the changes to existing occurrences are still made now
+            generate = False
         
         if self.event_end is None:
             self.event_end = self.event_start
@@ -121,58 +212,140 @@ class GeneratorModel(models.Model):
         
         * If only end time was changed:
             update all the generator's occurrences that have the same end time.
+
+        These changes, and the occurrences to generate, are worked out together (see plan_changes) and then applied
+        (see GeneratorChangePlan), with a few bulk statements if BULK_GENERATION is on, and otherwise one occurrence at
+        a time.
         """
-        
-        if self.pk: #it already exists so could potentially be changed
-            saved_self = type(self).objects.get(pk=self.pk)
-            start_shift = self.event_start - saved_self.event_start
-            end_shift = self.event_end - saved_self.event_end
-            duration = self.event_duration
-
-            if start_shift:
-                if self.event_start.date() != saved_self.event_start.date(): # we're shifting days (and times)
-                    occurrence_set = self.occurrences.filter(start__in=list(saved_self.generate_dates()))
-                elif self.event_start.time() != saved_self.event_start.time(): #we're only shifting times
-                    occurrence_set = [o for o in self.occurrences.all() if o.start.time() == saved_self.event_start.time()]
-
-                for occ in occurrence_set:
-                    occ.start += start_shift
-                    occ.end = occ.start + duration
-                    if self.repeat_until and occ.start < self.repeat_until:
-                        occ.save()
-                    else:
-                        occ.delete()
-
-            elif end_shift: #only end has changed (both is covered above)            
-                if self.event_end.date() != saved_self.event_end.date(): # we're shifting days (and times)
-                    occurrence_set = self.occurrences.filter(start__in=list(self.generate_dates()))
-                elif self.event_end.time() != saved_self.event_end.time(): #we're only shifting times
-                    occurrence_set = [o for o in self.occurrences.all() if o.end.time() == saved_self.event_end.time()]
-                
-                for occ in occurrence_set:
-                    occ.end += end_shift
-                    if occ.end < occ.start:
-                        # Something has gone wrong, let's do the only sane
-                        # thing to do
-                        occ.end = occ.start + duration
-                    occ.save()
-            
-            if self.repeat_until and (
-                    not saved_self.repeat_until or
-                    self.repeat_until < saved_self.repeat_until):
-                self.occurrences.filter(start__gt=self.repeat_until).delete()
-            
-            # If the rule has changed, delete occurrences that don't conform
-            # to the new rule
-            if self.rule != saved_self.rule:
-                for occurrence in self.occurrences.exclude(start__in=list(self.generate_dates())):
-                    if not self.is_exception(occurrence.start):
-                        occurrence.delete()
+        bulk = settings.BULK_GENERATION
+        horizon = self.horizon()
+        plan = None
 
+        if self.pk: #it already exists so could potentially be changed
+            saved_self = self.saved_instance()
+            if self.event_start != saved_self.event_start or self.event_end != saved_self.event_end \
+                    or self.rule_id != saved_self.rule_id or self.repeat_until != saved_self.repeat_until:
+                # what has been generated no longer tells us what is left to generate
+                self.generated_until = None
+            plan = self.plan_changes(saved_self, generate=generate and bulk, horizon=horizon, bulk=bulk)
+
+        if generate and bulk:
+            self.generated_until = horizon
         super(GeneratorModel, self).save(*args, **kwargs)
+
+        if plan is not None:
+            plan.apply(self, bulk=bulk)
+        if generate and (plan is None or not bulk):
+            self.generate(bulk=bulk) #need to do this after save, so we have ids.
+        elif plan is not None:
+            self._refresh_occurrence_summaries()
+        if defer:
+            self.request_regeneration()
+
+    def plan_changes(self, saved_self, generate=True, horizon=None, bulk=True):
+        """
+        Work out how this generator's saved occurrences need to change, given that it used to be `saved_self`, in one
+        pass over the old and new rules and the current occurrences (see save() for the rules). With `generate`, the
+        plan includes the occurrences that generate() would create afterwards. Without `bulk`, the plan is for
+        applying one occurrence at a time, so it has no time_shift.
+        """
+        plan = GeneratorChangePlan()
+
+        start_shift = self.event_start - saved_self.event_start
+        end_shift = self.event_end - saved_self.event_end
+        duration = self.event_duration
+        rule_changed = self.rule_id != saved_self.rule_id
+        until_shrunk = self.repeat_until and (
+            not saved_self.repeat_until or self.repeat_until < saved_self.repeat_until)
+
+        # shifting times only can be done with an UPDATE, without looking at the occurrences here
+        if bulk and start_shift and self.event_start.date() == saved_self.event_start.date():
+            if self._can_shift_times(saved_self.event_start.time(), start_shift):
+                plan.time_shift = ('start', saved_self.event_start.time(), start_shift)
+        elif bulk and not start_shift and end_shift and self.event_end.date() == saved_self.event_end.date():
+            if self._can_shift_times(saved_self.event_end.time(), end_shift):
+                plan.time_shift = ('end', saved_self.event_end.time(), end_shift)
+
+        rows = {}
+        event_ids = {}
+        if generate or rule_changed or until_shrunk or ((start_shift or end_shift) and plan.time_shift is None):
+            for pk, event_id, start, end in self.occurrences.values_list('pk', 'event', 'start', 'end'):
+                rows[pk] = (start, end)
+                event_ids[pk] = event_id
+
+        def window_dates(generator):
+            # the generator's dates over the span of the occurrences as they now stand
+            if not rows:
+                return set()
+            starts = [start for start, end in rows.itervalues()]
+            return set(generator._window_dates(min(starts), max(starts)))
+
+        # the rows are kept up to date with the time_shift, if any, so the rest of the plan can take it into account
+        if start_shift:
+            if self.event_start.date() != saved_self.event_start.date(): # we're shifting days (and times)
+                old_dates = window_dates(saved_self)
+                moving = [pk for pk, (start, end) in rows.iteritems() if start in old_dates]
+            else: #we're only shifting times
+                old_time = saved_self.event_start.time()
+                moving = [pk for pk, (start, end) in rows.iteritems() if start.time() == old_time]
+
+            for pk in moving:
+                start = rows[pk][0] + start_shift
+                if not self.repeat_until or start < self.repeat_until:
+                    rows[pk] = (start, start + duration)
+                    if plan.time_shift is None:
+                        plan.shift[pk] = rows[pk]
+                else:
+                    if plan.time_shift is None:
+                        plan.delete.add(pk)
+                    del rows[pk]
+
+        elif end_shift: #only end has changed (both is covered above)
+            if self.event_end.date() != saved_self.event_end.date(): # we're shifting days (and times)
+                new_dates = window_dates(self)
+                moving = [pk for pk, (start, end) in rows.iteritems() if start in new_dates]
+            else: #we're only shifting times
+                old_time = saved_self.event_end.time()
+                moving = [pk for pk, (start, end) in rows.iteritems() if end.time() == old_time]
+
+            for pk in moving:
+                start, end = rows[pk]
+                end += end_shift
+                if end < start:
+                    # Something has gone wrong, let's do the only sane
+                    # thing to do
+                    end = start + duration
+                rows[pk] = (start, end)
+                if plan.time_shift is None:
+                    plan.re_end[pk] = end
+
+        if until_shrunk:
+            for pk, (start, end) in rows.items():
+                if start > self.repeat_until:
+                    plan.delete.add(pk)
+                    del rows[pk]
+
+        # If the rule has changed, delete occurrences that don't conform
+        # to the new rule
+        if rule_changed:
+            new_dates = window_dates(self)
+            for pk, (start, end) in rows.items():
+                if start not in new_dates and not self.is_exception(start):
+                    plan.delete.add(pk)
+                    del rows[pk]
+
+        for pk in plan.delete:
+            plan.shift.pop(pk, None)
+            plan.re_end.pop(pk, None)
+
         if generate:
-            self.generate() #need to do this after save, so we have ids.
-    
+            if settings.ALLOW_CLASHING_OCCURRENCES:
+                existing = rows.values()
+            else:
+                existing = [span for pk, span in rows.iteritems() if event_ids[pk] == self.event_id]
+            plan.add = self._missing_spans(self._spans_to_generate(horizon=horizon), existing)
+        return plan
+
     @property
     def all_day(self):
         return self.event_start.time() == time.min and self.event_end.time() == time.max
@@ -191,9 +364,22 @@ class GeneratorModel(models.Model):
             * the start time isn't in the list of exceptions (unless we're 'force'-creating)
             * the occurrence hasn't already been saved by this generator (regardless of the event it is now assigned to)
             * the occurrence doesn't already exist for this event (regardless of the generator it came from)
+
+        With settings.UNIQUE_OCCURRENCES, the unique index is left to reject existing occurrences, rather than checking
+        for them first.
         """
         if not honour_exceptions or (honour_exceptions and not self.is_exception(start)):
-            
+
+            if settings.UNIQUE_OCCURRENCES:
+                sid = transaction.savepoint()
+                try:
+                    occurrence = self.occurrences.create(event=self.event, start=start, end=end)
+                except IntegrityError: # it already exists
+                    transaction.savepoint_rollback(sid)
+                    return
+                transaction.savepoint_commit(sid)
+                return occurrence
+
             if settings.ALLOW_CLASHING_OCCURRENCES:
                 # if this occurrence is already generated by this generator, do nothing
                 if self.occurrences.filter(start=start, end=end).count():
@@ -207,44 +393,227 @@ class GeneratorModel(models.Model):
         # it's an exception, don't generate it.
         return
 
-    def generate_dates(self):
+    def _can_shift_times(self, old_time, delta):
+        """
+        Whether _shift_times() can shift the occurrences on this database. The SQL only deals in whole seconds.
+        """
+        connection = connections[router.db_for_write(self.Occurrence())]
+        if connection.vendor not in DATETIME_SQL_VENDORS:
+            return False
+        return not (old_time.microsecond or delta.microseconds or self.event_duration.microseconds)
+
+    def _shift_times(self, field_name, old_time, delta):
+        """
+        Shift the occurrences whose `field_name` ('start' or 'end') is at `old_time` of day by `delta`, in the database.
+
+        Shifted starts take the event duration with them, and occurrences that would be shifted past repeat_until are
+        deleted. Shifted ends that would come before their starts are set from the event duration instead.
+        """
+        Occurrence = self.Occurrence()
+        using = router.db_for_write(Occurrence)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        opts = Occurrence._meta
+        table = qn(opts.db_table)
+        column = lambda name: u"%s.%s" % (table, qn(opts.get_field(name).column))
+        start, end = column('start'), column('end')
+        seconds = lambda d: d.days * 86400 + d.seconds
+
+        where = [u"%s = %%s" % column(type(self).occurrences.related.field.name),
+            u"%s = %%s" % time_of_day_sql(connection, column(field_name))]
+        where_params = [self.pk, connection.ops.value_to_db_time(old_time)]
+
+        if field_name == 'start':
+            if self.repeat_until:
+                cutoff = self.repeat_until - delta
+                doomed = self.occurrences.filter(start__gte=cutoff).extra(where=where[1:], params=where_params[1:])
+                Occurrence._bulk_delete(doomed.values_list('pk', flat=True))
+            new_start, start_params = datetime_add_sql(connection, start, seconds(delta))
+            new_end, end_params = datetime_add_sql(connection, start, seconds(delta + self.event_duration))
+            assignments = u"%s = %s, %s = %s" % (qn(opts.get_field('start').column), new_start,
+                qn(opts.get_field('end').column), new_end)
+            params = start_params + end_params
+        else:
+            new_end, end_params = datetime_add_sql(connection, end, seconds(delta))
+            fallback_end, fallback_params = datetime_add_sql(connection, start, seconds(self.event_duration))
+            assignments = u"%s = CASE WHEN %s < %s THEN %s ELSE %s END" % (qn(opts.get_field('end').column),
+                new_end, start, fallback_end, new_end)
+            params = end_params + fallback_params + end_params
+
+        cursor = connection.cursor()
+        cursor.execute(u"UPDATE %s SET %s WHERE %s" % (table, assignments, u" AND ".join(where)),
+            params + where_params)
+        transaction.commit_unless_managed(using=using)
+
+    def horizon(self):
+        """
+        The datetime after which no occurrences are generated.
+        """
+        return self.repeat_until or datetime.now() + settings.DEFAULT_GENERATOR_LIMIT
+
+    def dates_between(self, start, end):
+        """
+        Return the start datetimes of the rule that fall between `start` and `end` (inclusive).
+
+        The rule is expanded from the latest point before `start` that it can be (see Rule.rebase), so the cost depends
+        on the size of the window, rather than on how long ago the series started.
+        """
+        if start is None or start < self.event_start:
+            start = self.event_start
+        if end < start:
+            return []
         if self.rule is None:
-            yield self.event_start
-            raise StopIteration
-        
-        rule = self.rule.get_rrule(dtstart=self.event_start)
-        date_iter = iter(rule)
-        drop_dead_date = self.repeat_until or datetime.now() + settings.DEFAULT_GENERATOR_LIMIT
-        
-        while True:
-            d = date_iter.next()
-            if d > drop_dead_date:
-                break
-            yield d
+            return [self.event_start] if start == self.event_start else []
+
+        rule = self.rule.get_rrule(dtstart=self.rule.rebase(self.event_start, start))
+        return rule.between(start, end, inc=True)
+
+    def generate_dates(self, after=None, drop_dead_date=None):
+        """
+        Yield the start datetimes of the rule, up to `drop_dead_date` (the horizon by default). If `after` is given, only
+        start datetimes later than it are yielded.
+        """
+        if drop_dead_date is None:
+            drop_dead_date = self.horizon()
+        if self.rule is None: # one-offs aren't limited by the horizon
+            drop_dead_date = max(drop_dead_date, self.event_start)
+
+        for d in self.dates_between(after, drop_dead_date):
+            if after is None or d > after:
+                yield d
+
+    def _window_dates(self, first_start, last_start):
+        """
+        The generate_dates() that fall between first_start and last_start.
+        """
+        if first_start is None:
+            return []
+        return list(self.generate_dates(
+            first_start - timedelta.resolution, min(last_start, self.horizon())))
+
+    def _spans_to_generate(self, after=None, horizon=None):
+        """
+        The (start, end) pairs of the occurrences generate() would create, exceptions aside.
+        """
+        event_duration = self.event_duration
+        return [(o_start, o_start + event_duration) for o_start in self.generate_dates(after, horizon)]
 
     @transaction.commit_on_success()
-    def generate(self):
+    def generate(self, bulk=None, incremental=False):
         """
         generate my occurrences
+        
+        With `bulk` (defaults to settings.BULK_GENERATION), the existing occurrences are fetched in one query, and the
+        missing ones are INSERTed in chunks, rather than checking and saving each occurrence in turn.
+
+        With `incremental`, only occurrences after `generated_until` are generated, ie. the ones that have come within
+        the horizon since the last time we generated.
         """
+        if bulk is None:
+            bulk = settings.BULK_GENERATION
+
+        after = None
+        if incremental:
+            after = self.generated_until
+        horizon = self.horizon()
+
+        spans = self._spans_to_generate(after, horizon)
+        if not bulk:
+            for o_start, o_end in spans:
+                self.create_occurrence(start=o_start, end=o_end, honour_exceptions=True)
+        elif self._insert_ignores_existing():
+            # the unique index skips the occurrences that already exist
+            self._insert_occurrences([(start, end) for start, end in spans if not self.is_exception(start)])
+        else:
+            self._insert_occurrences(self._missing_spans(spans))
+
+        self.generated_until = horizon
+        type(self)._default_manager.filter(pk=self.pk).update(generated_until=horizon)
+        self._refresh_occurrence_summaries()
 
-        if self.rule is None: #the only occurrence in the village, boyo
-            self.create_occurrence(start=self.event_start, end=self.event_end, honour_exceptions=True)
+    def _refresh_occurrence_summaries(self):
+        """
+        Refresh the occurrence summaries (if any) of the events of this generator's occurrences.
+        """
+        Event = self.Occurrence().Event()
+        if Event.OccurrenceSummary() is None:
             return
+        event_ids = set(self.occurrences.order_by().values_list('event', flat=True).distinct())
+        event_ids.add(self.event_id)
+        Event.refresh_occurrence_summary_branches(event_ids)
 
-        event_duration = self.event_duration
-        for o_start in self.generate_dates():
-            o_end = o_start + event_duration
-            self.create_occurrence(start=o_start, end=o_end, honour_exceptions=True)
+    def _insert_ignores_existing(self):
+        """
+        Whether _insert_occurrences() can rely on a unique index to skip occurrences that already exist.
+        """
+        if not settings.UNIQUE_OCCURRENCES:
+            return False
+        return supports_insert_ignore(connections[router.db_for_write(self.Occurrence())])
+
+    def _insert_occurrences(self, spans):
+        Occurrence = self.Occurrence()
+        generator_field = type(self).occurrences.related.field.name
+        fields = {'event_id': self.event_id, generator_field: self}
+        if spans:
+            fields.update(Occurrence._event_tree_fields(self.event_id))
+        bulk_insert(Occurrence, [
+            Occurrence(start=start, end=end, **fields) for start, end in spans
+        ], ignore_conflicts=self._insert_ignores_existing())
+        if spans:
+            Occurrence.occurrences_changed()
+
+    def _missing_spans(self, spans, existing=None):
+        """
+        Return the (start, end) pairs in `spans` that create_occurrence() would create, ie. those that aren't
+        exceptions, aren't already generated by this generator (or, if clashes aren't allowed, that don't exist for
+        this event), in one query.
+
+        `existing` can be given as this generator's (start, end) pairs for this event, if they're already known.
+        """
+        spans = [(start, end) for start, end in spans if not self.is_exception(start)]
+        if not spans:
+            return []
+        starts = [start for start, end in spans]
+        window = {'start__gte': min(starts), 'start__lte': max(starts)}
+        if existing is None:
+            if settings.ALLOW_CLASHING_OCCURRENCES:
+                existing = self.occurrences.filter(**window)
+            else:
+                existing = self.Occurrence().objects.filter(event=self.event_id, **window)
+            existing = existing.values_list('start', 'end')
+        elif not settings.ALLOW_CLASHING_OCCURRENCES and not self._insert_ignores_existing():
+            # other occurrences of this event clash too (unless the unique index will skip them)
+            generator_field = type(self).occurrences.related.field.name
+            others = self.Occurrence().objects.filter(event=self.event_id, **window).exclude(**{generator_field: self})
+            existing = list(existing) + list(others.values_list('start', 'end'))
+
+        # compare the values as the database stores them (eg. MySQL drops microseconds)
+        ops = connections[router.db_for_read(self.Occurrence())].ops
+        key = lambda start, end: (ops.value_to_db_datetime(start), ops.value_to_db_datetime(end))
+        existing_keys = set([key(start, end) for start, end in existing])
+
+        missing = []
+        for start, end in spans:
+            k = key(start, end)
+            if k not in existing_keys:
+                existing_keys.add(k)
+                missing.append((start, end))
+        return missing
 
     def robot_description(self):
         return u'\n'.join(
             [pprint_datetime_span(start, end) + repeat_description \
             for start, end, repeat_description in self.get_spans()])
     
-    def get_spans(self):
+    def get_spans(self, occurrence_count=None, occurrences=None):
+        """
+        The (start, end, repeat_description) spans that describe this generator. `occurrence_count` and the (start,
+        end) pairs of `occurrences` can be given if they're already known (see EventModel.robot_descriptions()).
+        """
         if self.rule:
-            if self.occurrences.count() > 3:
+            if occurrence_count is None:
+                occurrence_count = self.occurrences.count()
+            if occurrence_count > 3:
                 if self.repeat_until:
                     repeat_description = u', repeating %s until %s' % (
                         self.rule,
@@ -254,33 +623,192 @@ class GeneratorModel(models.Model):
                     repeat_description = u', repeating %s' % self.rule
                 return [(self.event_start, self.event_end, repeat_description),]
             else:
-                return [(occ.start, occ.end, u'') for occ in self.occurrences.all()]
+                if occurrences is None:
+                    occurrences = self.occurrences.values_list('start', 'end')
+                return [(start, end, u'') for start, end in occurrences]
         else:
             return [(self.event_start, self.event_end, u''),]
         
     
+    def ical_series(self, rows):
+        """
+        Plan how to write this generator's occurrences in an iCalendar feed as one recurring VEVENT, given the (pk,
+        start, end, event_id) `rows` of the ones in the feed. Returns an ICalSeries, or None if they can't be written as
+        one (the rule can't be written as an RRULE, or fewer than two of the occurrences follow it).
+
+        The RRULE covers the occurrences that are as this generator would generate them, from the first to the last.
+        Edited occurrences (moved to another event, or to another time on the day of a start the rule has) override
+        the occurrence they replace, and those that can't be matched to one are written on their own. The rule's starts
+        without an occurrence in the feed (exceptions, or occurrences the feed leaves out) are EXDATEs.
+        """
+        if self.rule is None or len(rows) < 2:
+            return None
+        recur = self.rule.ical_recur()
+        if recur is None:
+            return None
+
+        rows = sorted(rows, key=lambda row: row[1])
+        starts = self.dates_between(
+            datetime.combine(rows[0][1].date(), time.min), datetime.combine(rows[-1][1].date(), time.max))
+        free = set(starts)
+        instances = {}
+        edited = []
+        for pk, start, end, event_id in rows:
+            if start in free and end - start == self.event_duration and event_id == self.event_id:
+                free.remove(start)
+                instances[start] = pk
+            else:
+                edited.append((pk, start))
+        if len(instances) < 2:
+            return None
+
+        free_by_date = {}
+        for start in free:
+            free_by_date.setdefault(start.date(), []).append(start)
+        overrides = []
+        standalone = []
+        for pk, start in edited:
+            candidates = free_by_date.get(start.date())
+            if candidates:
+                replaced = min(candidates, key=lambda candidate: abs(candidate - start))
+                candidates.remove(replaced)
+                free.remove(replaced)
+                overrides.append((replaced, pk))
+            else:
+                standalone.append(pk)
+
+        used = instances.keys() + [replaced for replaced, pk in overrides]
+        dtstart, until = min(used), max(used)
+        starts = [start for start in starts if dtstart <= start <= until]
+        # the RRULE has to repeat from dtstart exactly as the rule does from event_start
+        written = rrule.rrulestr('%s;UNTIL=%s' % (recur, until.strftime('%Y%m%dT%H%M%S')), dtstart=dtstart)
+        if list(written) != starts:
+            return None
+        exdates = [start for start in starts if start in free]
+        return ICalSeries(self, recur, dtstart, until, exdates, instances[min(instances)], overrides, standalone)
+
+    @classmethod
+    def ExceptionModel(cls):
+        """
+        The GeneratorExceptionModel subclass that stores this generator's exceptions, or None if they are kept in the
+        `exceptions` field.
+        """
+        descriptor = getattr(cls, 'exception_set', None)
+        if descriptor is None:
+            return None
+        return descriptor.related.model
+
+    @classmethod
+    def RegenerationRequest(cls):
+        """
+        The RegenerationRequestModel subclass that queues this generator for regeneration, or None if it has none.
+        """
+        descriptor = getattr(cls, 'regeneration_requests', None)
+        if descriptor is None:
+            return None
+        return descriptor.related.model
+
+    def request_regeneration(self, incremental=False):
+        """
+        Queue this generator for regeneration (see RegenerationRequestModel), as saves do with DEFER_REGENERATION.
+        """
+        RegenerationRequest = self.RegenerationRequest()
+        if RegenerationRequest is None:
+            raise exceptions.ImproperlyConfigured("%s can't be queued for regeneration (DEFER_REGENERATION is on) "
+                "without a RegenerationRequestModel subclass with a 'generator' ForeignKey to it, with related_name "
+                "'regeneration_requests'." % type(self).__name__)
+        RegenerationRequest.objects.request(self, incremental=incremental)
+
+    def _exception_starts(self):
+        """
+        The set of exception datetimes in the exception table, loaded once and then kept up to date by this instance.
+        """
+        if getattr(self, '_exception_cache', None) is None:
+            self._exception_cache = set(self.exception_set.values_list('start', flat=True))
+        return self._exception_cache
+
     def is_exception(self, dt):
+        if self.ExceptionModel() is not None:
+            return dt in self._exception_starts()
         if self.exceptions is None:
             return False
         return self.exceptions.has_key(dt.isoformat())
     
     def add_exception(self, dt):
-        if self.exceptions is None:
-            self.reset_exceptions()
-        
-        self.exceptions[dt.isoformat()] = True
-        self.save(generate=False)       
+        self.add_exceptions([dt])
 
     def remove_exception(self, dt):
+        self.remove_exceptions([dt])
+
+    def add_exceptions(self, dts):
+        """
+        Add the datetimes `dts` to the exceptions, with one write (per chunk, if there is an exception table).
+        """
+        dts = set(dts)
+        ExceptionModel = self.ExceptionModel()
+        if ExceptionModel is not None:
+            existing = set()
+            for chunk in chunks(list(dts)):
+                existing.update(self.exception_set.filter(start__in=chunk).values_list('start', flat=True))
+            bulk_insert(ExceptionModel, [ExceptionModel(generator=self, start=dt) for dt in dts - existing])
+            self._exception_starts().update(dts)
+            return
+
         if self.exceptions is None:
-            self.reset_exceptions()
-        if self.is_exception(dt):
-            del self.exceptions[dt.isoformat()]
-            self.save(generate=False)
+            self.exceptions = {}
+        for dt in dts:
+            self.exceptions[dt.isoformat()] = True
+        self._save_exceptions()
+
+    def remove_exceptions(self, dts):
+        """
+        Remove the datetimes `dts` from the exceptions, with one write (per chunk, if there is an exception table).
+        """
+        dts = set(dts)
+        if self.ExceptionModel() is not None:
+            removed = dts & self._exception_starts()
+            for chunk in chunks(list(removed)):
+                self.exception_set.filter(start__in=chunk).delete()
+            self._exception_starts().difference_update(removed)
+            fields = self._rewind_generated_until(removed)
+            if fields and self.pk is not None:
+                type(self)._default_manager.filter(pk=self.pk).update(**fields)
+            return
+
+        if self.exceptions is None:
+            self.exceptions = {}
+        removed = [dt for dt in dts if self.is_exception(dt)]
+        if removed:
+            for dt in removed:
+                del self.exceptions[dt.isoformat()]
+            self._save_exceptions(**self._rewind_generated_until(removed))
+
+    def _rewind_generated_until(self, dts):
+        """
+        Move generated_until back to just before the earliest of `dts` (former exceptions), so that the next
+        incremental generate() revisits them. Returns the fields to write.
+        """
+        if not dts or self.generated_until is None or min(dts) > self.generated_until:
+            return {}
+        self.generated_until = min(dts) - timedelta.resolution
+        return {'generated_until': self.generated_until}
 
     def reset_exceptions(self):
+        if self.ExceptionModel() is not None:
+            self.exception_set.all().delete()
+            self._exception_cache = set()
         self.exceptions = {}
-        self.save(generate=False)
+        self.generated_until = None # so the next generate() revisits the formerly excepted dates
+        self._save_exceptions(generated_until=None)
+
+    def _save_exceptions(self, **fields):
+        """
+        Write just the exceptions (and any other `fields` given), without going through save().
+        """
+        if self.pk is None:
+            self.save(generate=False)
+        else:
+            type(self)._default_manager.filter(pk=self.pk).update(exceptions=self.exceptions, **fields)
 
     def reload(self):
         """
@@ -288,3 +816,26 @@ class GeneratorModel(models.Model):
         """
         return type(self)._default_manager.get(pk=self.pk)
 
+
+class GeneratorExceptionModel(models.Model):
+    """
+    An abstract model for keeping a generator's exceptions in their own indexed table, rather than in its `exceptions`
+    field, which has to be rewritten whole for every change. Worth it for generators with many exceptions.
+
+    Implementing subclasses should define a 'generator' ForeignKey to a GeneratorModel subclass. The related_name for
+    the ForeignKey should be 'exception_set' (that's how the generator finds the table):
+
+    generator = models.ForeignKey(SomeGenerator, related_name="exception_set")
+
+    If the subclass has its own Meta, it should extend GeneratorExceptionModel.Meta, to keep the unique index.
+    """
+    start = models.DateTimeField()
+
+    class Meta:
+        abstract = True
+        ordering = ('start',)
+        unique_together = (('generator', 'start'),)
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.generator, self.start)
+
@@ -1,10 +1,14 @@
+import threading
+import time as _time
+import uuid
 from datetime import date, time, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from dateutil.tz import gettz
 from vobject.icalendar import utc
 
-from django.db import models
+from django.db import models, connections, router, transaction
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.utils.safestring import mark_safe
 from django.core.urlresolvers import reverse
@@ -20,6 +24,13 @@ from eventtools.utils import dateranges
 from eventtools.utils.viewutils import parse_GET_date
 from eventtools.utils.pprint_timespan import pprint_datetime_span, pprint_time_span
 from eventtools.utils.domain import django_root_url
+from eventtools.utils.bulk import bulk_delete, chunks
+from eventtools.utils.dirtyfields import DirtyFieldsMixin
+from eventtools.utils import ics
+
+# Set while deleting occurrences whose generator exceptions have already been taken care of, so that _pre_delete
+# leaves them alone.
+_quiet_deletes = threading.local()
 
 
 class OccurrenceQuerySetFN(object):
@@ -302,6 +313,20 @@ class OccurrenceQuerySetFN(object):
         n = datetime.now()
         return self.starts_before(n).ends_after(n)
         
+    def in_subtree_of(self, event, include_self=True):
+        """
+        The occurrences of `event`'s descendants (and, with `include_self`, of `event`). For TreeOccurrenceModels this
+        is a range on the occurrences' own event tree fields, rather than a subquery of the descendants.
+        """
+        if self.model.tracks_event_tree:
+            mptt = event._mptt_meta
+            return self.filter(**{
+                'event_tree_id': getattr(event, mptt.tree_id_attr),
+                include_self and 'event_lft__gte' or 'event_lft__gt': getattr(event, mptt.left_attr),
+                'event_lft__lt': getattr(event, mptt.right_attr),
+            })
+        return self.filter(event__in=event.get_descendants(include_self=include_self))
+
     def events(self):
         """
         Return a queryset corresponding to the events matched by these occurrences.
@@ -320,7 +345,30 @@ class OccurrenceQuerySetFN(object):
                 
         
 class OccurrenceQuerySet(models.query.QuerySet, OccurrenceQuerySetFN):
-    pass #all the goodness is inherited from OccurrenceQuerySetFN
+    #all the goodness is inherited from OccurrenceQuerySetFN
+
+    def bulk_delete(self):
+        """
+        Delete these occurrences in bulk.
+
+        As with delete(), generated occurrences are added to their generators' exceptions, but with one write per
+        generator rather than a generator save per occurrence. The occurrences are then deleted with one statement per
+        chunk (and no signals, unless other models refer to them).
+        """
+        model = self.model
+        if 'generator' in [f.name for f in model._meta.fields]:
+            rows = list(self.values_list('pk', 'generator', 'start'))
+            starts = {}
+            for pk, generator_id, start in rows:
+                if generator_id is not None:
+                    starts.setdefault(generator_id, []).append(start)
+            Generator = model._meta.get_field('generator').rel.to
+            for generator in Generator._default_manager.filter(pk__in=starts.keys()):
+                generator.add_exceptions(starts[generator.pk])
+            pks = [row[0] for row in rows]
+        else:
+            pks = list(self.values_list('pk', flat=True))
+        return model._bulk_delete(pks)
 
 class OccurrenceManagerType(type):
     """
@@ -366,9 +414,11 @@ class OccurrenceModelBase(ModelBase):
             pass
             
         signals.pre_delete.connect(cls._pre_delete, sender=cls)
+        signals.post_save.connect(cls._post_save, sender=cls)
+        signals.post_delete.connect(cls._post_delete, sender=cls)
         return cls
 
-class OccurrenceModel(models.Model):
+class OccurrenceModel(DirtyFieldsMixin, models.Model):
     """
     An abstract model for an event occurrence.
     
@@ -412,12 +462,16 @@ class OccurrenceModel(models.Model):
         # TODO: add the new time if self.start is in exceptions and durations
         # are equal
         if hasattr(self, 'generator') and self.pk:
-            saved_self = type(self).objects.get(pk=self.pk)
-            generator_changed = self.generator != saved_self.generator
-            if saved_self.generator \
+            saved_self = self.saved_instance()
+            generator_changed = self.generator_id != saved_self.generator_id
+            if generator_changed:
+                saved_generator = saved_self.generator
+            else:
+                saved_generator = self.generator
+            if saved_generator \
                     and generator_changed \
-                    or saved_self.generator.event_duration != self.duration:
-                saved_self.generator.add_exception(saved_self.start)
+                    or saved_generator.event_duration != self.duration:
+                saved_generator.add_exception(saved_self.start)
 
             if self.generator and self.generator.is_exception(self.start):
                 if self.duration == self.generator.event_duration:
@@ -425,8 +479,86 @@ class OccurrenceModel(models.Model):
 
         super(OccurrenceModel, self).save(*args, **kwargs)
 
+    tracks_event_tree = False # see TreeOccurrenceModel
+
+    @classmethod
+    def _event_tree_fields(cls, event_id):
+        """
+        The values of the event tree fields (see TreeOccurrenceModel) for an occurrence of the given event.
+        """
+        return {}
+
+    @classmethod
+    def refresh_event_tree_fields(cls, tree_ids=None):
+        """
+        Bring the event tree fields (see TreeOccurrenceModel) up to date after events have moved.
+        """
+        pass
+
+    @classmethod
+    def change_version(cls):
+        """
+        The (token, timestamp) version of this model's occurrences, which occurrences_changed() replaces whenever they
+        (or their events) change. It's kept in the default cache, so reading it doesn't touch the occurrence table.
+        Cached ICS feeds are keyed by it (see ICAL_CACHE).
+        """
+        key = 'eventtools.occurrence_version.%s' % cls._meta.db_table
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, (uuid.uuid4().hex, _time.time()), settings.ICAL_CACHE_TIMEOUT)
+            version = cache.get(key)
+            if version is None: # eg. the dummy cache
+                version = (uuid.uuid4().hex, _time.time())
+        return version
+
+    @classmethod
+    def occurrences_changed(cls):
+        """
+        Start a new change_version() (with ICAL_CACHE). Saving or deleting occurrences or events, and generating,
+        do this themselves; call it after changing occurrences in other ways (eg. with QuerySet.update()).
+        """
+        if settings.ICAL_CACHE:
+            cache.set('eventtools.occurrence_version.%s' % cls._meta.db_table, (uuid.uuid4().hex, _time.time()),
+                settings.ICAL_CACHE_TIMEOUT)
+
+    @classmethod
+    def _bulk_delete(cls, pks):
+        """
+        Delete the occurrences with the given pks in bulk, without adding them to their generators' exceptions.
+        """
+        pks = list(pks)
+        Event = cls.Event()
+        event_ids = set()
+        if Event.OccurrenceSummary() is not None:
+            for chunk in chunks(pks):
+                event_ids.update(cls._default_manager.filter(pk__in=chunk).values_list('event', flat=True))
+        _quiet_deletes.active = True
+        try:
+            deleted = bulk_delete(cls, pks)
+        finally:
+            _quiet_deletes.active = False
+        Event.refresh_occurrence_summary_branches(event_ids)
+        cls.occurrences_changed()
+        return deleted
+
+    @staticmethod #connected in the metaclass
+    def _post_save(sender, **kwargs):
+        occ = kwargs['instance']
+        saved_state = getattr(occ, '_saved_state', None) or {} # as it was before this save
+        sender.Event().refresh_occurrence_summary_branches([occ.event_id, saved_state.get('event_id')])
+        sender.occurrences_changed()
+
+    @staticmethod #connected in the metaclass
+    def _post_delete(sender, **kwargs):
+        if getattr(_quiet_deletes, 'active', False): # _bulk_delete refreshes them all at once
+            return
+        sender.Event().refresh_occurrence_summary_branches([kwargs['instance'].event_id])
+        sender.occurrences_changed()
+
     @staticmethod #connected in the metaclass
     def _pre_delete(sender, **kwargs):
+        if getattr(_quiet_deletes, 'active', False):
+            return
         occ = kwargs['instance']
         if hasattr(occ, 'generator') and occ.generator is not None:
             occ.generator.add_exception(occ.start)
@@ -570,6 +702,7 @@ class OccurrenceModel(models.Model):
         
         """
         vevent = ical.add('vevent')
+        vevent.add('uid').value = ics.occurrence_uid(self, request.get_host())
         
         start = self.start
         end = self.end
@@ -621,6 +754,14 @@ class OccurrenceModel(models.Model):
             
         return ical 
 
+    def as_vevent(self, request, **kwargs):
+        """
+        Returns the occurrence as the (UTF-8) text of an iCalendar VEVENT, written directly rather than with vobject.
+        Takes the same *_attr arguments as as_icalendar() (see eventtools.utils.ics.CalendarWriter). To write many
+        occurrences, use one CalendarWriter for them all.
+        """
+        return ics.CalendarWriter(request, **kwargs).vevent(self)
+
     def ics_url(self):
         """
         Needs to be fully-qualified (for sending to calendar apps). Your app needs to define
@@ -633,4 +774,77 @@ class OccurrenceModel(models.Model):
         return self.ics_url().replace("http://", "webcal://").replace("https://", "webcal://")
         
     def gcal_url(self):
-        return  "http://www.google.com/calendar/render?cid=%s" % urlencode(self.ics_url())
\ No newline at end of file
+        return  "http://www.google.com/calendar/render?cid=%s" % urlencode(self.ics_url())
+
+
+class TreeOccurrenceModel(OccurrenceModel):
+    """
+    An OccurrenceModel that keeps a copy of its event's MPTT tree_id and lft, so that the occurrences of a subtree of
+    events (see in_subtree_of()) can be found with a range scan of one index, on (event_tree_id, event_lft, start).
+    Create that index with the create_occurrence_indexes command.
+
+    The copies are set as occurrences are saved or generated, and refreshed in bulk as events are created, moved or
+    deleted. Call refresh_event_tree_fields() after changing the events' tree in other ways (eg. with
+    TreeManager.move_node(), or EventModel.tree.rebuild()).
+    """
+    event_tree_id = models.PositiveIntegerField(null=True, editable=False)
+    event_lft = models.PositiveIntegerField(null=True, editable=False)
+
+    tracks_event_tree = True
+
+    class Meta(OccurrenceModel.Meta):
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if self.event_id is not None:
+            for attname, value in type(self)._event_tree_fields(self.event_id).items():
+                setattr(self, attname, value)
+        super(TreeOccurrenceModel, self).save(*args, **kwargs)
+
+    @classmethod
+    def _event_tree_fields(cls, event_id):
+        Event = cls.Event()
+        mptt = Event._mptt_meta
+        tree_id, left = Event._event_manager.filter(pk=event_id).values_list(mptt.tree_id_attr, mptt.left_attr)[0]
+        return {'event_tree_id': tree_id, 'event_lft': left}
+
+    @classmethod
+    def refresh_event_tree_fields(cls, tree_ids=None):
+        """
+        Copy their events' current tree_id and lft to the occurrences of the events in the given trees, and to those
+        that were in them, in one UPDATE. Without `tree_ids`, every occurrence whose copies are out of date is updated.
+        """
+        if tree_ids is not None:
+            tree_ids = [tree_id for tree_id in set(tree_ids) if tree_id is not None]
+            if not tree_ids:
+                return
+        Event = cls.Event()
+        using = router.db_for_write(cls)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        opts, event_opts, mptt = cls._meta, Event._meta, Event._mptt_meta
+        table, event_table = qn(opts.db_table), qn(event_opts.db_table)
+        column = lambda name: u"%s.%s" % (table, qn(opts.get_field(name).column))
+        event_column = lambda attr: u"e.%s" % qn(event_opts.get_field(attr).column)
+        event_value = lambda attr: u"(SELECT %s FROM %s e WHERE %s = %s)" % (
+            event_column(attr), event_table, event_column(event_opts.pk.name), column('event'))
+        tree_value, left_value = event_value(mptt.tree_id_attr), event_value(mptt.left_attr)
+
+        if tree_ids is None:
+            where = u"%s IS NULL OR %s IS NULL OR %s <> %s OR %s <> %s" % (
+                column('event_tree_id'), column('event_lft'),
+                column('event_tree_id'), tree_value, column('event_lft'), left_value)
+            params = []
+        else:
+            placeholders = u", ".join(["%s"] * len(tree_ids))
+            where = u"%s IN (%s) OR %s IN (SELECT %s FROM %s e WHERE %s IN (%s))" % (
+                column('event_tree_id'), placeholders,
+                column('event'), event_column(event_opts.pk.name), event_table, event_column(mptt.tree_id_attr),
+                placeholders)
+            params = tree_ids * 2
+
+        cursor = connection.cursor()
+        cursor.execute(u"UPDATE %s SET %s = %s, %s = %s WHERE %s" % (
+            table, qn(opts.get_field('event_tree_id').column), tree_value,
+            qn(opts.get_field('event_lft').column), left_value, where), params)
+        transaction.commit_unless_managed(using=using)
@@ -0,0 +1,95 @@
+import uuid
+from datetime import datetime, timedelta
+
+from django.db import models, transaction, router, IntegrityError
+from django.db.models import Q
+from django.utils.translation import ugettext_lazy as _
+
+from eventtools.conf import settings
+
+class RegenerationRequestManager(models.Manager):
+
+    def request(self, generator, incremental=False):
+        """
+        Queue `generator` for regeneration. Repeated requests for a generator coalesce into its one pending request
+        (which becomes a full regeneration if any of them is), and push it back by REGENERATION_DELAY.
+        """
+        pending = self.filter(generator=generator, claim='')
+        changes = {'requested_at': datetime.now()}
+        if not incremental:
+            changes['incremental'] = False
+        if pending.update(**changes):
+            return
+
+        using = router.db_for_write(self.model)
+        sid = transaction.savepoint(using=using)
+        try:
+            self.create(generator=generator, **dict(changes, incremental=incremental))
+        except IntegrityError: # another process has just queued it
+            transaction.savepoint_rollback(sid, using=using)
+            pending.update(**changes)
+        else:
+            transaction.savepoint_commit(sid, using=using)
+
+    def claim(self, limit=None):
+        """
+        Claim (up to `limit` of) the requests that are ready to run, oldest first: those that have been pending for
+        REGENERATION_DELAY, and those whose claims are older than REGENERATION_CLAIM_TIMEOUT (eg. their worker died).
+
+        The claim is an UPDATE that only matches requests nobody else has claimed meanwhile, so several workers can
+        drain the queue at once.
+        """
+        now = datetime.now()
+        ready = Q(claim='', requested_at__lte=now - timedelta(seconds=settings.REGENERATION_DELAY)) | \
+            Q(claimed_at__lt=now - timedelta(seconds=settings.REGENERATION_CLAIM_TIMEOUT))
+        pks = list(self.filter(ready).order_by('requested_at').values_list('pk', flat=True)[:limit])
+        if not pks:
+            return []
+        token = uuid.uuid4().hex
+        self.filter(ready, pk__in=pks).update(claim=token, claimed_at=now)
+        return list(self.filter(claim=token).order_by('requested_at'))
+
+
+class RegenerationRequestModel(models.Model):
+    """
+    An abstract model for the queue of generators whose occurrences need generating, queued by saves while
+    DEFER_REGENERATION is on. Drain the queue with the process_regeneration_requests command.
+
+    Implementing subclasses should define a 'generator' ForeignKey to a GeneratorModel subclass. The related_name for
+    the ForeignKey should be 'regeneration_requests' (that's how the generator finds the queue):
+
+    generator = models.ForeignKey(SomeGenerator, related_name="regeneration_requests")
+
+    If the subclass has its own Meta, it should extend RegenerationRequestModel.Meta, to keep the unique index.
+
+    A generator has at most one pending (unclaimed) request. Once a worker has claimed it, a later save queues another.
+    """
+    incremental = models.BooleanField(_("incremental"), default=True,
+        help_text=_("only generate the occurrences that have come within the horizon since the last time."))
+    requested_at = models.DateTimeField(_("requested at"), db_index=True)
+    claim = models.CharField(max_length=32, blank=True, default='', editable=False)
+    claimed_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = RegenerationRequestManager()
+
+    class Meta:
+        abstract = True
+        verbose_name = _('regeneration request')
+        verbose_name_plural = _('regeneration requests')
+        ordering = ('requested_at',)
+        unique_together = (('generator', 'claim'),)
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.generator, self.requested_at)
+
+    def run(self):
+        """
+        Regenerate the generator, and remove this request from the queue.
+        """
+        # An AttributeError usually means that the generator fails validation, as in
+        # EventModel.update_endless_generators.
+        try:
+            self.generator.generate(incremental=self.incremental)
+        except AttributeError:
+            pass
+        self.delete()
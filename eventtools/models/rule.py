@@ -1,9 +1,13 @@
-from datetime import timedelta
+import threading
+from datetime import datetime, timedelta
 from dateutil import rrule
+from dateutil.relativedelta import relativedelta
 
 from django.db import models
 from django.utils.translation import ugettext, ugettext_lazy as _
 
+from eventtools.conf import settings
+
 
 # The deltas don't need to be particularly precise, the minimum length will do
 FREQUENCIES = (
@@ -21,6 +25,122 @@ FREQUENCY_TIME_MAP = dict((f[0], f[2]) for f in FREQUENCIES)
 # For backwards compatibility
 freqs = FREQUENCY_CHOICES
 
+# Frequencies whose periods are a fixed length, and those that are a whole number of months long
+FIXED_PERIODS = {
+    "WEEKLY": timedelta(7),
+    "DAILY": timedelta(1),
+    "HOURLY": timedelta(hours=1),
+}
+MONTH_PERIODS = {
+    "YEARLY": 12,
+    "MONTHLY": 1,
+}
+
+# Rule params and the iCalendar RECUR parts they become (count is left to the generator)
+RECUR_PARTS = {
+    'interval': 'INTERVAL',
+    'bysetpos': 'BYSETPOS',
+    'bymonth': 'BYMONTH',
+    'bymonthday': 'BYMONTHDAY',
+    'byyearday': 'BYYEARDAY',
+    'byweekno': 'BYWEEKNO',
+    'byweekday': 'BYDAY',
+    'byhour': 'BYHOUR',
+    'byminute': 'BYMINUTE',
+    'bysecond': 'BYSECOND',
+    'wkst': 'WKST',
+}
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+
+class CompiledRule(object):
+    """
+    The parts of a Rule that don't depend on dtstart, parsed once, so that rrules for any dtstart can be made from
+    them cheaply.
+    """
+    def __init__(self, rule):
+        self.complex_rule = None
+        self._template = None
+        if rule.complex_rule:
+            text = str(rule.complex_rule)
+            try:
+                template = rrule.rrulestr(text, dtstart=datetime(2000, 1, 1))
+            except: #Except what?
+                pass
+            else:
+                self.complex_rule = text
+                # dateutil >= 2.7 can rebind an rrule's dtstart without parsing it again
+                if hasattr(template, 'replace') and isinstance(template, rrule.rrule) \
+                        and 'DTSTART' not in text.upper():
+                    self._template = template
+        self.params = rule.get_params()
+        self.frequency = getattr(rrule, rule.frequency, None)
+
+    def get_rrule(self, dtstart):
+        if self.complex_rule is not None:
+            if self._template is not None:
+                return self._template.replace(dtstart=dtstart)
+            return rrule.rrulestr(self.complex_rule, dtstart=dtstart)
+        if self.frequency is None:
+            raise AttributeError('Unknown frequency.')
+        rs = rrule.rruleset()
+        rs.rrule(rrule.rrule(self.frequency, dtstart=dtstart, **self.params))
+        return rs
+
+
+class CompiledRuleCache(object):
+    """
+    A process-wide, least-recently-used cache of CompiledRules, keyed by rule id and content.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._rules = {}
+        self._order = []
+        self._lock = threading.Lock()
+
+    def get(self, rule):
+        key = (rule.pk, rule.frequency, rule.params, rule.complex_rule)
+        self._lock.acquire()
+        try:
+            compiled = self._rules.get(key)
+            if compiled is not None:
+                self._order.remove(key)
+                self._order.append(key)
+                return compiled
+        finally:
+            self._lock.release()
+
+        compiled = CompiledRule(rule)
+        self._lock.acquire()
+        try:
+            if key not in self._rules:
+                self._order.append(key)
+            self._rules[key] = compiled
+            while len(self._order) > self.size:
+                del self._rules[self._order.pop(0)]
+        finally:
+            self._lock.release()
+        return compiled
+
+    def invalidate(self, pk):
+        self._lock.acquire()
+        try:
+            for key in [k for k in self._order if k[0] == pk]:
+                self._order.remove(key)
+                del self._rules[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._rules = {}
+            self._order = []
+        finally:
+            self._lock.release()
+
+compiled_rules = CompiledRuleCache(settings.RULE_CACHE_SIZE)
+
 
 class Rule(models.Model):
     """
@@ -86,15 +206,95 @@ class Rule(models.Model):
         """Human readable string for Rule"""
         return self.name or unicode(self.frequency).lower()
 
+    def save(self, *args, **kwargs):
+        super(Rule, self).save(*args, **kwargs)
+        compiled_rules.invalidate(self.pk)
+
+    def delete(self, *args, **kwargs):
+        compiled_rules.invalidate(self.pk)
+        super(Rule, self).delete(*args, **kwargs)
+
+    def compiled(self):
+        """
+        The cached CompiledRule for this rule.
+        """
+        return compiled_rules.get(self)
+
     def get_rrule(self, dtstart):
-        if self.complex_rule:
-            try:
-                return rrule.rrulestr(str(self.complex_rule), dtstart=dtstart)
-            except: #Except what?
-                pass
-        params = self.get_params()
-        frequency = 'rrule.%s' % self.frequency
-        simple_rule = rrule.rrule(eval(frequency), dtstart=dtstart, **params)
-        rs = rrule.rruleset()
-        rs.rrule(simple_rule)
-        return rs
+        return self.compiled().get_rrule(dtstart)
+
+    def ical_recur(self):
+        """
+        The value of an iCalendar RRULE that repeats as this rule does, without COUNT or UNTIL (which are up to whoever
+        writes it), or None if there isn't one (eg. the rule uses byeaster, or is a complex rule with more than an
+        RRULE in it).
+
+        >>> Rule(frequency="WEEKLY", params="interval:2;byweekday:0,2").ical_recur()
+        'FREQ=WEEKLY;BYDAY=MO,WE;INTERVAL=2'
+        """
+        compiled = self.compiled()
+        if compiled.complex_rule is not None:
+            lines = [line.strip() for line in compiled.complex_rule.upper().splitlines() if line.strip()]
+            if len(lines) != 1:
+                return None
+            line = lines[0]
+            if line.startswith('RRULE:'):
+                line = line[len('RRULE:'):]
+            if ':' in line: # DTSTART, EXRULE etc.
+                return None
+            return ';'.join([part for part in line.split(';')
+                if part and part.split('=')[0] not in ('COUNT', 'UNTIL')])
+
+        if compiled.frequency is None:
+            return None
+        parts = ['FREQ=%s' % self.frequency]
+        for name, value in sorted(compiled.params.items()):
+            if name == 'count':
+                continue
+            if name not in RECUR_PARTS:
+                return None
+            if not isinstance(value, list):
+                value = [value]
+            if name in ('byweekday', 'wkst'):
+                if [v for v in value if not 0 <= v < 7]:
+                    return None
+                value = [WEEKDAYS[v] for v in value]
+            parts.append('%s=%s' % (RECUR_PARTS[name], ','.join([str(v) for v in value])))
+        return ';'.join(parts)
+
+    def rebase(self, dtstart, after):
+        """
+        Return the latest datetime, no later than `after`, from which this rule repeats exactly as it does from
+        `dtstart`. Expanding the rule from there rather than from dtstart means that getting to `after` doesn't take
+        longer the older the series is.
+
+        Rules that depend on where they started (complex rules, or rules with a count) are returned unchanged.
+
+        >>> rule = Rule(frequency="WEEKLY")
+        >>> rule.rebase(datetime(2008, 1, 1, 10, 30), datetime(2010, 1, 1))
+        datetime.datetime(2009, 12, 29, 10, 30)
+        """
+        if self.complex_rule or after <= dtstart:
+            return dtstart
+        params = self.compiled().params
+        if 'count' in params:
+            return dtstart
+        interval = params.get('interval', 1)
+
+        if self.frequency in FIXED_PERIODS:
+            period = FIXED_PERIODS[self.frequency] * interval
+            delta = after - dtstart
+            periods = (delta.days * 86400 + delta.seconds) // (period.days * 86400 + period.seconds)
+            return dtstart + period * periods
+
+        if self.frequency in MONTH_PERIODS:
+            if dtstart.day > 28: # adding months would move the day of the month
+                return dtstart
+            months = (after.year - dtstart.year) * 12 + after.month - dtstart.month
+            months -= months % (MONTH_PERIODS[self.frequency] * interval)
+            rebased = dtstart + relativedelta(months=months)
+            if rebased > after:
+                rebased = dtstart + relativedelta(months=months - MONTH_PERIODS[self.frequency] * interval)
+            return max(rebased, dtstart)
+
+        return dtstart
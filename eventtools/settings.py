@@ -15,10 +15,57 @@ EVENT_GET_MAP = {
 
 OCCURRENCES_PER_PAGE = 20
 
+from dateutil.relativedelta import relativedelta
 ICAL_CALNAME = getattr(settings, 'SITE_NAME', 'Events list')
 ICAL_CALDESC = "Events listing" #e.g. "Events listing from mysite.com"
+ICAL_CHUNK_SIZE = 500 # how many occurrences to load at a time while streaming an iCalendar
+ICAL_VOBJECT_COMPATIBLE = False # write icals as vobject serializes as_icalendar(), rather than as RFC 5545 has them
+ICAL_SERIES = False # write each generator's occurrences as one recurring VEVENT (see ics.CalendarWriter)
+ICAL_MAX_OCCURRENCES = 10000 # the most occurrences an ICS feed has (None for no limit)
+ICAL_MAX_WINDOW = relativedelta(years=1) # the longest date window occurrence_list_ical exports (None for no limit)
 
-from dateutil.relativedelta import relativedelta
 DEFAULT_GENERATOR_LIMIT = relativedelta(years=1) #months=6, etc
 
-ALLOW_CLASHING_OCCURRENCES = True
\ No newline at end of file
+ALLOW_CLASHING_OCCURRENCES = True
+
+# Set to True for generators to materialise their occurrences with multi-row
+# INSERTs, rather than saving them one by one, and for saving a changed
+# generator to shift, re-end and delete its existing occurrences with bulk
+# UPDATEs and DELETEs. Bulk statements skip Occurrence.save() and the
+# pre_save/post_save/pre_delete signals (so the occurrences a change deletes
+# aren't added to the generator's exceptions), so only turn this on if your
+# Occurrence model doesn't rely on them.
+BULK_GENERATION = False
+OCCURRENCE_INSERT_CHUNK_SIZE = 500
+
+# How many parsed repetition rules to keep in memory (per process).
+RULE_CACHE_SIZE = 256
+
+# Set to True once your occurrence tables have a unique index on (generator, start, end), or on (event, start, end)
+# if clashing occurrences aren't allowed (see the create_occurrence_indexes command). Generation then relies on the
+# index to skip occurrences that already exist, instead of checking for them first.
+UNIQUE_OCCURRENCES = False
+
+# Set to True to queue generators for regeneration when they (or their events) are saved, rather than generating
+# their occurrences during the save. The generator models need a queue (see RegenerationRequestModel), which the
+# process_regeneration_requests command drains. Queued requests wait until REGENERATION_DELAY seconds have passed
+# without another save, and claimed requests are handed to another worker after REGENERATION_CLAIM_TIMEOUT seconds.
+DEFER_REGENERATION = False
+REGENERATION_DELAY = 10
+REGENERATION_CLAIM_TIMEOUT = 600
+
+# How long (in seconds) to cache events' robot descriptions, in the default cache. The cache keys change whenever
+# the events' generators do. Set to None to not cache them.
+ROBOT_DESCRIPTION_CACHE_TIMEOUT = 60 * 60 * 24
+
+# How long (in seconds) to keep the tree snapshots of event models with EventMeta.cache_tree in the default cache.
+# The default cache should be shared between processes (eg. memcached): with a per-process cache (eg. locmem), other
+# processes only see changes to the tree once this has passed.
+EVENT_TREE_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Set to True to cache ICS feeds, gzipped, in the default cache, under a version of the occurrences that saving or
+# deleting occurrences or events replaces (see OccurrenceModel.change_version()). Feeds then have an ETag and
+# Last-Modified, and conditional GETs for an unchanged feed get a 304 without querying the occurrences. Feeds (and
+# versions) are kept for ICAL_CACHE_TIMEOUT seconds.
+ICAL_CACHE = False
+ICAL_CACHE_TIMEOUT = 60 * 60 * 24
@@ -0,0 +1,96 @@
+"""
+Rough timings of hot paths, for comparing implementations. These aren't tests (the test suite doesn't import this
+module). Run them from a shell of a project that has eventtools.tests.eventtools_testapp installed:
+
+    >>> from eventtools.tests.benchmarks import run
+    >>> run()
+"""
+import timeit
+from datetime import datetime, timedelta
+
+from django.test.client import RequestFactory
+from vobject import iCalendar
+
+from eventtools.utils import ics
+from eventtools.utils.inheritingdefault import ModelInstanceAwareDefault
+from eventtools.tests.eventtools_testapp.models import ExampleEvent, ExampleOccurrence, ExampleVenue
+
+def _per_call(fn, number):
+    return min(timeit.repeat(fn, repeat=3, number=number)) / number * 1e6
+
+def _with_frame_walking_defaults(fn):
+    """
+    Run `fn` the old way: with the inherited fields' defaults replaced by frame-walking ModelInstanceAwareDefaults,
+    instead of EventModel.__init__ filling them in.
+    """
+    event_meta = ExampleEvent._event_meta
+    fields = [ExampleEvent._meta.get_field(name) for name in event_meta.fields_to_inherit]
+    old_defaults = [field.default for field in fields]
+    inherited_fields = event_meta.inherited_fields
+    for field in fields:
+        field.default = ModelInstanceAwareDefault(field.name, field.default)
+    event_meta.inherited_fields = []
+    try:
+        return fn()
+    finally:
+        event_meta.inherited_fields = inherited_fields
+        for field, default in zip(fields, old_defaults):
+            field.default = default
+
+def event_instantiation(number=10000):
+    """
+    Microseconds per event instantiation: as new events are created (keyword args), and as new events are created
+    with a parent, with EventModel.__init__ inheritance ('after') and with the frame-walking defaults it replaced
+    ('before'). Loading events from a queryset isn't timed, as their fields' defaults aren't used.
+    """
+    venue = ExampleVenue(id=1, name="Gallery", slug="gallery")
+    parent = ExampleEvent(id=1, name="Festival", slug="festival", venue=venue, lft=1, rght=2, tree_id=1, level=0)
+
+    cases = [
+        ('new', lambda: ExampleEvent(name="Talk")),
+        ('new, with a parent', lambda: ExampleEvent(parent=parent)),
+    ]
+    results = []
+    for label, fn in cases:
+        after = _per_call(fn, number)
+        before = _with_frame_walking_defaults(lambda: _per_call(fn, number))
+        results.append((label, before, after))
+    return results
+
+def ical_serialization(number=1000):
+    """
+    VEVENTs per second: built as vobject objects with OccurrenceModel.as_icalendar() and serialized ('vobject'), and
+    written by a CalendarWriter, as RFC 5545 has them ('native') and byte for byte as vobject would
+    ('vobject_compatible').
+    """
+    event = ExampleEvent(id=1, name=u"Tours, talks; and films \u2013 " + u"x" * 80)
+    start = datetime(2010, 1, 1, 10, 00)
+    occurrences = []
+    for i in range(number):
+        occurrence = ExampleOccurrence(id=i + 1, event=event, start=start + timedelta(days=i),
+            end=start + timedelta(days=i, hours=2))
+        occurrence.ical_url = "/occurrences/%s/" % occurrence.id # so the timings don't include reverse()
+        occurrences.append(occurrence)
+    request = RequestFactory().get('/')
+
+    def with_vobject():
+        ical = iCalendar()
+        for occurrence in occurrences:
+            occurrence.as_icalendar(ical, request, url_attr='ical_url')
+        return ical.serialize()
+
+    cases = [
+        ('vobject', with_vobject),
+        ('native', lambda: "".join(ics.CalendarWriter(request, url_attr='ical_url').stream(occurrences))),
+        ('vobject_compatible', lambda: "".join(
+            ics.CalendarWriter(request, vobject_compatible=True, url_attr='ical_url').stream(occurrences))),
+    ]
+    return [(label, number / min(timeit.repeat(fn, repeat=3, number=1))) for label, fn in cases]
+
+def run():
+    print "Event instantiation (microseconds per instance):"
+    for label, before, after in event_instantiation():
+        print "  %-25s before: %7.1f  after: %7.1f" % (label, before, after)
+    print "iCalendar serialization (VEVENTs per second):"
+    for label, rate in ical_serialization():
+        print "  %-25s %9.0f" % (label, rate)
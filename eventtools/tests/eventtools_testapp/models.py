@@ -1,5 +1,6 @@
 from django.db import models
-from eventtools.models import EventModel, OccurrenceModel, GeneratorModel
+from eventtools.models import EventModel, OccurrenceModel, GeneratorModel, GeneratorExceptionModel, \
+    OccurrenceSummaryModel, TreeOccurrenceModel, RegenerationRequestModel
 from django.conf import settings
 
 class ExampleVenue(models.Model):
@@ -46,3 +47,30 @@ class ExampleGOccurrence(OccurrenceModel):
     event = models.ForeignKey(ExampleGEvent, related_name="occurrences")
     status = models.CharField(max_length=20, blank=True, null=True)
 
+class ExampleGRegenerationRequest(RegenerationRequestModel):
+    generator = models.ForeignKey(ExampleGenerator, related_name="regeneration_requests")
+
+# with generator, exception table, occurrence summaries, event tree fields and a cached tree
+
+class ExampleXEvent(EventModel):
+    name = models.CharField(max_length=100)
+
+    def __unicode__(self):
+        return self.name
+
+    class EventMeta:
+        fields_to_inherit = ['name']
+        cache_tree = True
+
+class ExampleXGenerator(GeneratorModel):
+    event = models.ForeignKey(ExampleXEvent, related_name="generators")
+
+class ExampleXOccurrence(TreeOccurrenceModel):
+    generator = models.ForeignKey(ExampleXGenerator, related_name="occurrences", blank=True, null=True)
+    event = models.ForeignKey(ExampleXEvent, related_name="occurrences")
+
+class ExampleXException(GeneratorExceptionModel):
+    generator = models.ForeignKey(ExampleXGenerator, related_name="exception_set")
+
+class ExampleXEventSummary(OccurrenceSummaryModel):
+    event = models.OneToOneField(ExampleXEvent, related_name="occurrence_summary", primary_key=True)
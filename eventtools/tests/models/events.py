@@ -4,6 +4,8 @@ from eventtools.tests.eventtools_testapp.models import *
 from datetime import date, time, datetime, timedelta
 from eventtools.tests._fixture import bigfixture, reload_films
 from eventtools.utils import dateranges
+from eventtools.models import Rule
+from eventtools.models.event import OCCURRENCE_SUMMARY_FIELDS
 
 class TestTestEvents(AppTestCase):
     
@@ -204,7 +206,61 @@ class TestTestEvents(AppTestCase):
         self.ae(set(c), set([self.talk, self.film_with_popcorn]))
         c = ExampleEvent.eventobjects.closing_on(self.day1)
         self.ae(set(c), set([self.film]))
-        
+
+        # the opening and closing occurrences are picked in the database, in one query however many events there are
+        events = ExampleEvent.eventobjects.all()
+        self.ae(
+            set(events.opening_occurrences()),
+            set([e.opening_occurrence() for e in events if e.opening_occurrence()])
+        )
+        self.ae(
+            set(events.closing_occurrences()),
+            set([e.closing_occurrence() for e in events if e.closing_occurrence()])
+        )
+        self.assertNumQueries(1, lambda: list(ExampleEvent.eventobjects.opening_between(self.day1, self.day2)))
+
+        # occurrences that start together are told apart by their ends, as in opening_occurrence()
+        doubled = ExampleEvent.eventobjects.create(name="Doubled")
+        for start, end in (
+            (datetime(2010, 1, 1, 10, 00), datetime(2010, 1, 1, 12, 00)),
+            (datetime(2010, 1, 1, 10, 00), datetime(2010, 1, 1, 11, 00)),
+            (datetime(2010, 1, 9, 10, 00), datetime(2010, 1, 9, 12, 00)),
+            (datetime(2010, 1, 9, 10, 00), datetime(2010, 1, 9, 11, 00)),
+        ):
+            doubled.occurrences.create(start=start, end=end)
+        events = ExampleEvent.eventobjects.filter(pk=doubled.pk)
+        self.ae(list(events.opening_occurrences()), [doubled.opening_occurrence()])
+        self.ae(events.opening_occurrences()[0].end, datetime(2010, 1, 1, 11, 00))
+        self.ae(list(events.closing_occurrences()), [doubled.closing_occurrence()])
+        self.ae(events.closing_occurrences()[0].end, datetime(2010, 1, 9, 12, 00))
+        
+    def test_next_occurrence(self):
+        """
+        by_next_occurrence() returns the events with occurrences starting at or after a given time, ordered by the
+        first of them, in one query that can be paginated.
+        """
+        def expected(events, include_descendants=False):
+            next_starts = []
+            for event in events:
+                if include_descendants:
+                    occurrences = ExampleOccurrence.objects.filter(event__in=event.get_descendants(include_self=True))
+                else:
+                    occurrences = event.occurrences.all()
+                starts = [o.start for o in occurrences if o.start >= datetime.combine(self.day1, time.min)]
+                if starts:
+                    next_starts.append((min(starts), event.pk, event))
+            return [event for next_start, pk, event in sorted(next_starts)]
+
+        events = list(ExampleEvent.eventobjects.all())
+        self.ae(list(ExampleEvent.eventobjects.by_next_occurrence(self.day1)), expected(events))
+        self.ae(
+            list(ExampleEvent.eventobjects.by_next_occurrence(self.day1, include_descendants=True)),
+            expected(events, include_descendants=True)
+        )
+        self.assertNumQueries(1, lambda: list(ExampleEvent.eventobjects.by_next_occurrence(self.day1)[2:5]))
+        self.ae(list(ExampleEvent.eventobjects.by_next_occurrence(self.day1)[2:5]), expected(events)[2:5])
+        self.ae(list(ExampleEvent.eventobjects.by_next_occurrence(datetime(2100, 1, 1))), [])
+
     def test_GET(self):
         """        
         a (GET) dictionary, containing date(time) from and to parameters can be passed.
@@ -251,28 +307,38 @@ class TestTestEvents(AppTestCase):
         # reload everything
         reload_films(self)
 
-    # come back to this one (works in admin!)
-    # def test_tree_creation(self):
-    #     """
-    #     If we create a new child, it can take all of its parents' fields (but not occurrences or generators).
-    #     """
-    # 
-    #     self.new_film = ExampleEvent()
-    #     self.ae(self.new_film.slug, 'the-slug')
-    #     
-    #     #object instantiation
-    #     self.new_film = ExampleEvent(parent=self.film)
-    #     self.ae(self.new_film.name, self.film.name)
-    #     self.ae(self.new_film.slug, 'the-slug')        
-    # 
-    #     #creation (saving)
-    #     self.new_film = ExampleEvent.eventobjects.create(parent=self.film)
-    #     self.ae(self.new_film.name, self.film.name)
-    # 
-    #     #get_or_create
-    #     self.next_new_film, created = ExampleEvent.eventobjects.get_or_create(parent=self.film, slug="new-slug")
-    #     self.ae(self.next_new_film.name, self.film.name)
-    #     self.ae(self.next_new_film.slug, 'new-slug')        
+        # the change doesn't skip over a descendant that doesn't inherit it
+        ExampleEvent.eventobjects.filter(pk=self.film_with_talk.pk).update(name="Film Night with a talk")
+        self.film.name = "Film Night!"
+        self.film.save()
+        reload_films(self)
+        self.ae(self.film_with_popcorn.name, "Film Night!")
+        self.ae(self.film_with_talk.name, "Film Night with a talk")
+        self.ae(self.film_with_talk_and_popcorn.name, "Film Night")
+
+    def test_tree_creation(self):
+        """
+        If we create a new child, it can take all of its parents' fields (but not occurrences or generators).
+        """
+
+        self.new_film = ExampleEvent()
+        self.ae(self.new_film.slug, 'the-slug')
+        
+        #object instantiation
+        self.new_film = ExampleEvent(parent=self.film)
+        self.ae(self.new_film.name, self.film.name)
+        self.ae(self.new_film.slug, 'the-slug')
+        self.ae(self.new_film.venue, self.film.venue)
+        self.ae(ExampleEvent(parent=self.film, name="Film Day").name, "Film Day")
+
+        #creation (saving)
+        self.new_film = ExampleEvent.eventobjects.create(parent=self.film)
+        self.ae(self.new_film.name, self.film.name)
+
+        #get_or_create
+        self.next_new_film, created = ExampleEvent.eventobjects.get_or_create(parent=self.film, slug="new-slug")
+        self.ae(self.next_new_film.name, self.film.name)
+        self.ae(self.next_new_film.slug, 'new-slug')
 
     def test_tree_queries(self):
         """
@@ -353,6 +419,9 @@ class TestTestEvents(AppTestCase):
         #a useful derivative
         highest_having_occurrences = tree.highest_having_occurrences()
         self.assertEqual(list(highest_having_occurrences), [self.has_some_occurrences])
+        #which, like the filters above, is a single query
+        self.assertNumQueries(1, lambda: list(tree.highest_having_occurrences()))
+        self.assertNumQueries(1, lambda: list(tree.without_descendants_having(name__contains="some")))
         
         #get the highest ancestor of self that has occurrences (if any). This could be a good 'normalisation' process.
         self.ae(self.has_some_more_occurrences.highest_ancestor_having_occurrences(), self.has_some_occurrences)
@@ -400,6 +469,202 @@ class TestTestEvents(AppTestCase):
         self.ae(list(self.film_with_talk.get_family(include_self=False).occurrences()), [self.film_occ, self.film_with_talk_and_popcorn_occ])
         
 
+    def test_occurrence_summary(self):
+        """
+        Events with an OccurrenceSummaryModel keep a summary of their (and their descendants') occurrences, which
+        occurrence_count(), has_finished() etc. read instead of the occurrences.
+        """
+        self.ae(ExampleEvent.OccurrenceSummary(), None)
+        self.ae(ExampleXEvent.OccurrenceSummary(), ExampleXEventSummary)
+
+        festival = ExampleXEvent.eventobjects.create(name="Festival")
+        concert = ExampleXEvent.eventobjects.create(name="Concert", parent=festival)
+        festival = festival.reload()
+        summary = lambda event: ExampleXEventSummary.objects.get(event=event)
+        self.ae(summary(festival).subtree_count, 0)
+
+        future = datetime.now() + timedelta(days=7)
+        festival.occurrences.create(start=datetime(2010, 1, 1, 10, 00), end=datetime(2010, 1, 1, 11, 00))
+        concert.occurrences.create(start=datetime(2010, 1, 2, 20, 00), end=datetime(2010, 1, 2, 22, 00))
+        concert.occurrences.create(start=future, end=future + timedelta(hours=2))
+
+        s = summary(festival)
+        self.ae((s.count, s.first_start, s.last_end, s.next_start), (1, datetime(2010, 1, 1, 10, 00), datetime(2010, 1, 1, 11, 00), None))
+        self.ae((s.subtree_count, s.subtree_first_start, s.subtree_last_end, s.subtree_next_start), (3, datetime(2010, 1, 1, 10, 00), future + timedelta(hours=2), future))
+        s = summary(concert)
+        self.ae((s.count, s.first_start, s.last_start, s.next_start), (2, datetime(2010, 1, 2, 20, 00), future, future))
+
+        festival = festival.reload()
+        self.assertNumQueries(1, lambda: self.ae(festival.occurrence_count(), 3))
+        self.ae(festival.occurrence_count(include_descendants=False), 1)
+        # has_finished() is about the event's own occurrences
+        self.ae(festival.has_finished(), True)
+        self.ae(concert.reload().has_finished(), False)
+
+        # bulk deletes keep the summaries up to date too
+        concert.occurrences.filter(start=future).bulk_delete()
+        festival = festival.reload()
+        self.ae(festival.occurrence_count(), 2)
+        self.ae(concert.reload().has_finished(), True)
+        self.ae(summary(festival).subtree_next_start, None)
+
+        # saving an occurrence only refreshes the summaries of its event and the event's ancestors
+        talk = ExampleXEvent.eventobjects.create(name="Talk", parent=festival.reload())
+        ExampleXEventSummary.objects.filter(event=talk).update(subtree_count=10)
+        concert.occurrences.create(start=future, end=future + timedelta(hours=2))
+        self.ae(summary(talk).subtree_count, 10)
+        self.ae(summary(festival).subtree_count, 13)
+        ExampleXEvent.refresh_occurrence_summaries([festival.pk])
+        self.ae(summary(festival).subtree_count, 3)
+        s = summary(festival)
+        concert.occurrences.get(start=future).delete()
+        concert.occurrences.create(start=future, end=future + timedelta(hours=2))
+        self.ae(
+            [getattr(summary(festival), field) for field in OCCURRENCE_SUMMARY_FIELDS],
+            [getattr(s, field) for field in OCCURRENCE_SUMMARY_FIELDS]
+        )
+
+        # opening_occurrence() and closing_occurrence() only look at the occurrences at the summary's first and last
+        # starts, telling them apart by their ends
+        concert.occurrences.create(start=future, end=future + timedelta(hours=1))
+        concert.occurrences.create(start=datetime(2010, 1, 2, 20, 00), end=datetime(2010, 1, 2, 21, 00))
+        concert = concert.reload()
+        self.ae(concert.opening_occurrence(), concert.occurrences.get(end=datetime(2010, 1, 2, 21, 00)))
+        self.ae(concert.closing_occurrence(), concert.occurrences.get(end=future + timedelta(hours=2)))
+        self.ae(concert.reload().opening_occurrence(), concert.occurrences.all()[0])
+        self.ae(concert.reload().closing_occurrence(), concert.occurrences.all().reverse()[0])
+        self.ae(talk.reload().opening_occurrence(), None)
+
+        # a summary whose next start has passed has just its next starts refreshed, leaving the rest of the tree
+        past = datetime.now() - timedelta(days=1)
+        ExampleXEventSummary.objects.filter(event__in=[festival, concert]).update(
+            next_start=past, subtree_next_start=past)
+        concert = concert.reload()
+        self.ae(concert.has_finished(), False)
+        s = summary(concert)
+        self.ae((s.next_start, s.subtree_next_start), (future, future))
+        s = summary(festival)
+        self.ae((s.next_start, s.subtree_next_start), (past, past))
+        festival = festival.reload()
+        festival.occurrence_count()
+        s = summary(festival)
+        self.ae((s.next_start, s.subtree_next_start), (None, future))
+
+    def test_event_tree_fields(self):
+        """
+        TreeOccurrenceModels keep a copy of their event's tree_id and lft, so that in_subtree_of() is a range query. The
+        copies follow the events around the tree.
+        """
+        self.ae(ExampleOccurrence.tracks_event_tree, False)
+        self.ae(ExampleXOccurrence.tracks_event_tree, True)
+
+        def check_fields():
+            for occurrence in ExampleXOccurrence.objects.select_related('event'):
+                self.ae(
+                    (occurrence.event_tree_id, occurrence.event_lft),
+                    (occurrence.event.tree_id, occurrence.event.lft)
+                )
+
+        def check_subtree(event):
+            for include_self in (True, False):
+                self.ae(
+                    set(ExampleXOccurrence.objects.in_subtree_of(event, include_self=include_self)),
+                    set(ExampleXOccurrence.objects.filter(event__in=event.get_descendants(include_self=include_self)))
+                )
+
+        festival = ExampleXEvent.eventobjects.create(name="Festival")
+        concert = ExampleXEvent.eventobjects.create(name="Concert", parent=festival)
+        talk = ExampleXEvent.eventobjects.create(name="Talk", parent=concert)
+        other = ExampleXEvent.eventobjects.create(name="Other")
+        festival.occurrences.create(start=datetime(2010, 1, 1, 10, 00), end=datetime(2010, 1, 1, 11, 00))
+        talk.occurrences.create(start=datetime(2010, 1, 2, 10, 00), end=datetime(2010, 1, 2, 11, 00))
+        other.occurrences.create(start=datetime(2010, 1, 3, 10, 00), end=datetime(2010, 1, 3, 11, 00))
+        # generated occurrences get the fields too
+        concert.generators.create(
+            event_start=datetime(2010, 1, 4, 20, 00),
+            event_end=datetime(2010, 1, 4, 22, 00),
+            rule=Rule.objects.create(frequency="DAILY"),
+            repeat_until=datetime(2010, 1, 6, 23, 59),
+        )
+        check_fields()
+        check_subtree(festival.reload())
+        check_subtree(concert.reload())
+        self.ae(ExampleXOccurrence.objects.in_subtree_of(festival.reload()).count(), 5)
+
+        # new events renumber the events after them
+        ExampleXEvent.eventobjects.create(name="Workshop", parent=festival.reload())
+        check_fields()
+        # as do moves and deletes
+        talk = talk.reload()
+        talk.parent = other.reload()
+        talk.save()
+        check_fields()
+        check_subtree(other.reload())
+        concert.reload().move_to(other.reload())
+        check_fields()
+        talk.reload().delete()
+        check_fields()
+        check_subtree(other.reload())
+
+    def test_tree_snapshot(self):
+        """
+        Event models with EventMeta.cache_tree answer ancestor and descendant lookups from a cached snapshot of the
+        tree, which is replaced when events are created, moved or deleted.
+        """
+        self.ae(ExampleEvent.tree_snapshot(), None)
+
+        festival = ExampleXEvent.eventobjects.create(name="Festival")
+        concert = ExampleXEvent.eventobjects.create(name="Concert", parent=festival)
+        encore = ExampleXEvent.eventobjects.create(name="Encore", parent=concert)
+        talk = ExampleXEvent.eventobjects.create(name="Talk", parent=festival)
+        other = ExampleXEvent.eventobjects.create(name="Other")
+
+        def check(event):
+            event = event.reload()
+            ancestors = list(event.get_ancestors().values_list('pk', flat=True))
+            descendants = list(event.get_descendants(include_self=False).values_list('pk', flat=True))
+            self.ae(event.ancestor_ids(), ancestors)
+            self.ae(event.ancestor_ids(include_self=True), ancestors + [event.pk])
+            self.ae(event.descendant_ids(), descendants)
+            self.ae(event.descendant_ids(include_self=True), [event.pk] + descendants)
+            self.ae(set(event.get_family().values_list('pk', flat=True)), set(ancestors + [event.pk] + descendants))
+
+        for event in (festival, concert, encore, talk, other):
+            check(event)
+        self.ae(len(ExampleXEvent.tree_snapshot()), 5)
+        self.ae(ExampleXEvent.tree_snapshot().child_ids(festival.pk),
+            list(festival.reload().get_children().values_list('pk', flat=True)))
+        encore = encore.reload()
+        self.assertNumQueries(0, lambda: encore.ancestor_ids())
+
+        # moves replace the snapshot
+        concert = concert.reload()
+        concert.parent = other.reload()
+        concert.save()
+        for event in (festival, concert, encore, talk, other):
+            check(event)
+        self.ae(encore.reload().ancestor_ids(), [other.pk, concert.pk])
+
+        talk.occurrences.create(start=datetime(2010, 1, 1, 10, 00), end=datetime(2010, 1, 1, 11, 00))
+        festival.occurrences.create(start=datetime(2010, 1, 2, 10, 00), end=datetime(2010, 1, 2, 11, 00))
+        self.ae(talk.reload().highest_ancestor_having_occurrences(), festival)
+        self.ae(encore.reload().highest_ancestor_having_occurrences(), None)
+
+        talk.reload().delete()
+        self.ae(ExampleXEvent.tree_snapshot().descendant_ids(festival.pk), [])
+
+        # with a cache that keeps nothing, every snapshot is built afresh, so changes are never missed
+        from django.core.cache.backends.dummy import DummyCache
+        from eventtools.models import event as event_module
+        default_cache = event_module.cache
+        event_module.cache = DummyCache('', {})
+        try:
+            self.ae(ExampleXEvent.tree_snapshot().child_ids(festival.pk), [])
+            ExampleXEvent.eventobjects.create(name="Talk", parent=festival.reload())
+            self.ae(len(ExampleXEvent.tree_snapshot().child_ids(festival.pk)), 1)
+        finally:
+            event_module.cache = default_cache
+
     def test_diffs(self):
         self.ae(unicode(self.film), u'Film Night')
         self.ae(unicode(self.film_with_talk), u'Film Night (director\'s talk)')
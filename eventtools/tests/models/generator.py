@@ -1,15 +1,21 @@
 # -*- coding: utf-8“ -*-
 from datetime import date, time, datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from dateutil.tz import gettz
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.client import RequestFactory
+import vobject
 
 from eventtools.models import Rule
 from eventtools.tests._fixture import generator_fixture
 from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
 from eventtools.tests.eventtools_testapp.models import *
-from eventtools.utils import datetimeify
+from eventtools.utils import datetimeify, ics
 
 
 class TestGenerators(AppTestCase):
@@ -65,6 +71,566 @@ class TestGenerators(AppTestCase):
 
         self.ae(self.weekly_generator.robot_description(), "1 January 2010, 10:30-11:30am, repeating weekly until 29 January 2010")
 
+    def test_robot_descriptions(self):
+        """
+        Robot descriptions of many events can be built at once, in four queries however many events and generators
+        there are, and are cached until the events' generators change.
+        """
+        settings.ROBOT_DESCRIPTION_CACHE_TIMEOUT = None
+        try:
+            nothing = ExampleGEvent.eventobjects.create(name='Nothing')
+            self.ae(nothing.robot_description(), u'')
+            sparse = ExampleGEvent.eventobjects.create(name='Sparse')
+            sparse.generators.create(
+                event_start=datetime(2010, 3, 1, 9, 00),
+                event_end=datetime(2010, 3, 1, 10, 00),
+                rule=self.weekly,
+                repeat_until=datetime(2010, 3, 8, 23, 59),
+            )
+
+            events = ExampleGEvent.eventobjects.all()
+            descriptions = events.robot_descriptions()
+            self.ae(set(descriptions), set([event.pk for event in events]))
+            self.ae(descriptions[self.bin_night.pk], self.bin_night.robot_description())
+            self.ae(descriptions[nothing.pk], u'')
+            self.ae(descriptions[sparse.pk], sparse.robot_description())
+            # the events, their generators, the occurrence counts and the occurrences of the sparse generators
+            self.assertNumQueries(4, lambda: ExampleGEvent.eventobjects.robot_descriptions())
+        finally:
+            del settings.ROBOT_DESCRIPTION_CACHE_TIMEOUT
+
+        # cached descriptions change with the generators
+        description = self.bin_night.robot_description()
+        self.ae(self.bin_night.robot_description(), description)
+        self.weekly_generator.repeat_until = datetime(2010, 2, 26, 23, 59)
+        self.weekly_generator.save()
+        self.assertNotEqual(self.bin_night.robot_description(), description)
+        self.assertTrue(u'26 February 2010' in self.bin_night.robot_description())
+
+    def test_bulk_generation(self):
+        """
+        With BULK_GENERATION, generate() fetches the generator's existing occurrences once and INSERTs the missing
+        ones in chunks. The result is the same as creating them one at a time: exceptions are honoured, and
+        occurrences that already exist aren't duplicated.
+        """
+        settings.BULK_GENERATION = True
+        try:
+            daily = Rule.objects.create(frequency="DAILY")
+            g = self.furniture_collection.generators.create(
+                event_start=datetime(2010, 3, 1, 9, 00),
+                event_end=datetime(2010, 3, 1, 10, 00),
+                rule=daily,
+                repeat_until=datetime(2010, 3, 31, 23, 59),
+            )
+            self.ae(g.occurrences.count(), 31)
+            starts = list(g.occurrences.values_list('start', flat=True))
+            self.ae(starts[0], datetime(2010, 3, 1, 9, 00))
+            self.ae(starts[-1], datetime(2010, 3, 31, 9, 00))
+
+            #regenerating creates nothing new
+            g.generate()
+            self.ae(g.occurrences.count(), 31)
+
+            #deleted occurrences stay deleted
+            g.occurrences.get(start=datetime(2010, 3, 2, 9, 00)).delete()
+            g = g.reload()
+            g.generate()
+            self.ae(g.occurrences.count(), 30)
+            self.ae(g.occurrences.filter(start=datetime(2010, 3, 2, 9, 00)).count(), 0)
+
+            #the same as the one-at-a-time path
+            g2 = self.furniture_collection.generators.create(
+                event_start=datetime(2010, 3, 1, 9, 00),
+                event_end=datetime(2010, 3, 1, 10, 00),
+                rule=daily,
+                repeat_until=datetime(2010, 3, 31, 23, 59),
+            )
+            g2.occurrences.all().delete()
+            g2 = g2.reload()
+            g2.reset_exceptions()
+            g2.generate(bulk=False)
+            self.ae(
+                [(o.start, o.end) for o in g2.occurrences.all()],
+                [(start, start + timedelta(hours=1)) for start in starts],
+            )
+        finally:
+            del settings.BULK_GENERATION
+
+    def test_incremental_generation(self):
+        """
+        Generators record how far they have generated in `generated_until`. When an event is saved, its endless
+        generators only generate the occurrences between that mark and the new horizon.
+        """
+        g = self.endless_generator.reload()
+        self.assertTrue(g.generated_until > datetime.now())
+
+        # pretend we last generated 10 weeks ago (detaching occurrences with update() adds no exceptions)
+        mark = g.generated_until - timedelta(weeks=10)
+        type(g).objects.filter(pk=g.pk).update(generated_until=mark)
+        g.occurrences.filter(start__gt=mark).update(generator=None)
+        early_start = g.occurrences.all()[0].start
+        g.occurrences.filter(start=early_start).update(generator=None)
+
+        self.bin_night.save()
+        g = g.reload()
+        self.assertTrue(g.generated_until > mark)
+        self.assertTrue(g.occurrences.filter(start__gt=mark).count() >= 10)
+        # earlier dates are not revisited
+        self.ae(g.occurrences.filter(start=early_start).count(), 0)
+
+        # a full generate() still fills every gap
+        g.generate()
+        self.ae(g.occurrences.filter(start=early_start).count(), 1)
+
+        # removing exceptions moves the mark back, so an incremental generate() fills in the dates they excepted
+        g.occurrences.get(start=early_start).delete()
+        g = g.reload()
+        self.assertTrue(g.is_exception(early_start))
+        g.remove_exceptions([early_start])
+        self.ae(g.reload().generated_until, early_start - timedelta.resolution)
+        g.generate(incremental=True)
+        self.ae(g.occurrences.filter(start=early_start).count(), 1)
+
+    def test_windowed_dates(self):
+        """
+        dates_between() expands a generator's rule over a window only. The dates are the same as expanding the whole
+        rule from event_start, however long ago that was.
+        """
+        rules = [
+            Rule.objects.create(frequency="DAILY"),
+            self.weekly,
+            Rule.objects.create(frequency="WEEKLY", params="interval:2;byweekday:0,3"),
+            Rule.objects.create(frequency="MONTHLY"),
+            Rule.objects.create(frequency="MONTHLY", params="byweekday:1;bysetpos:-1"),
+            Rule.objects.create(frequency="HOURLY", params="interval:5"),
+        ]
+        window_start = datetime(2010, 6, 15, 12, 00)
+        window_end = datetime(2010, 8, 1)
+        for rule in rules:
+            g = self.furniture_collection.generators.create(
+                event_start=datetime(2008, 3, 4, 10, 30),
+                event_end=datetime(2008, 3, 4, 11, 00),
+                rule=rule,
+                repeat_until=window_end,
+            )
+            expected = rule.get_rrule(dtstart=g.event_start).between(window_start, window_end, inc=True)
+            self.assertTrue(expected)
+            self.ae(g.dates_between(window_start, window_end), expected)
+
+        # a count depends on where the rule started, so it isn't rebased
+        counted = Rule.objects.create(frequency="DAILY", params="count:3")
+        self.ae(counted.rebase(datetime(2008, 3, 4), window_start), datetime(2008, 3, 4))
+
+        # saves expand the new rule over the occurrences as they are after any time shift, so an earlier start time
+        # with a new rule keeps the occurrences that conform to it
+        g = self.furniture_collection.generators.create(
+            event_start=datetime(2008, 3, 4, 10, 30),
+            event_end=datetime(2008, 3, 4, 11, 00),
+            rule=rules[0],
+            repeat_until=datetime(2008, 3, 25, 23, 59),
+        )
+        pks = list(g.occurrences.values_list('pk', flat=True))
+        g.event_start = datetime(2008, 3, 4, 9, 30)
+        g.rule = self.weekly
+        g.save()
+        self.ae(list(g.occurrences.values_list('pk', flat=True)), pks[::7])
+        self.ae(list(g.occurrences.values_list('start', flat=True)),
+            [datetime(2008, 3, 4, 9, 30) + timedelta(weeks=n) for n in range(4)])
+
+    def test_rule_cache(self):
+        """
+        Rules are parsed once per process and shared by every generator that uses them. Saving a rule invalidates
+        its cached version.
+        """
+        rule = Rule.objects.create(frequency="DAILY", params="byhour:9,17")
+        self.assertTrue(rule.compiled() is Rule.objects.get(pk=rule.pk).compiled())
+
+        dtstart = datetime(2010, 1, 1, 9, 00)
+        self.ae(list(rule.get_rrule(dtstart)[:3]), [
+            datetime(2010, 1, 1, 9, 00), datetime(2010, 1, 1, 17, 00), datetime(2010, 1, 2, 9, 00)])
+        # rebinding dtstart
+        self.ae(rule.get_rrule(dtstart + timedelta(7))[0], datetime(2010, 1, 8, 9, 00))
+
+        rule.frequency = "WEEKLY"
+        rule.params = ""
+        rule.save()
+        self.ae(list(Rule.objects.get(pk=rule.pk).get_rrule(dtstart)[:2]), [
+            datetime(2010, 1, 1, 9, 00), datetime(2010, 1, 8, 9, 00)])
+
+        complex_rule = Rule.objects.create(complex_rule="FREQ=WEEKLY;BYDAY=MO,FR")
+        self.ae(list(complex_rule.get_rrule(dtstart)[:3]), [
+            datetime(2010, 1, 1, 9, 00), datetime(2010, 1, 4, 9, 00), datetime(2010, 1, 8, 9, 00)])
+        self.ae(list(complex_rule.get_rrule(dtstart + timedelta(3))[:2]), [
+            datetime(2010, 1, 4, 9, 00), datetime(2010, 1, 8, 9, 00)])
+
+    def test_change_plan(self):
+        """
+        Saving a changed generator works out one plan of the occurrences to shift, re-end, delete and add, which is
+        applied with bulk statements with BULK_GENERATION.
+        """
+        settings.BULK_GENERATION = True
+        try:
+            daily = Rule.objects.create(frequency="DAILY")
+            g = self.furniture_collection.generators.create(
+                event_start=datetime(2010, 3, 1, 9, 00),
+                event_end=datetime(2010, 3, 1, 10, 00),
+                rule=daily,
+                repeat_until=datetime(2010, 3, 31, 23, 59),
+            )
+            pks = list(g.occurrences.values_list('pk', flat=True))
+            self.ae(len(pks), 31)
+
+            saved = g.reload()
+            g.event_start = datetime(2010, 3, 1, 9, 30)
+            g.repeat_until = datetime(2010, 3, 15, 23, 59)
+            plan = g.plan_changes(saved)
+            # only the start time has changed, so the database shifts the occurrences itself, deleting those that end
+            # up past repeat_until
+            self.ae(plan.shift, {})
+            self.ae(plan.time_shift, ('start', time(9, 00), timedelta(minutes=30)))
+            self.ae(plan.delete, set())
+            self.ae(plan.re_end, {})
+            self.ae(plan.add, [])
+
+            g.save()
+            occurrences = list(g.occurrences.all())
+            self.ae([o.pk for o in occurrences], pks[:15])
+            for o in occurrences:
+                self.ae(o.start.time(), time(9, 30))
+                self.ae(o.end.time(), time(10, 00))
+
+            # _shift_times() shifts the occurrences in place, keeping their pks
+            g.reload()._shift_times('end', time(10, 00), timedelta(minutes=15))
+            self.ae(list(g.occurrences.values_list('pk', flat=True)), pks[:15])
+            self.ae(set([(o.start.time(), o.end.time()) for o in g.occurrences.all()]), set([(time(9, 30), time(10, 15))]))
+            g = g.reload()
+            g.event_end = datetime(2010, 3, 1, 10, 15)
+            g.save()
+
+            # endless generators keep their shifted occurrences too
+            g.repeat_until = None
+            g.save()
+            g.event_start = datetime(2010, 3, 1, 9, 00)
+            g.save()
+            self.ae(list(g.occurrences.values_list('pk', flat=True)[:15]), pks[:15])
+
+            # shifting days moves each occurrence itself
+            saved = g.reload()
+            g.event_start = datetime(2010, 3, 2, 9, 00)
+            g.event_end = datetime(2010, 3, 2, 10, 15)
+            plan = g.plan_changes(saved)
+            self.ae(plan.time_shift, None)
+            self.ae(plan.shift[pks[0]], (datetime(2010, 3, 2, 9, 00), datetime(2010, 3, 2, 10, 15)))
+            g.save()
+            self.ae(list(g.occurrences.values_list('pk', flat=True)[:15]), pks[:15])
+            self.ae(g.occurrences.all()[0].start, datetime(2010, 3, 2, 9, 00))
+        finally:
+            del settings.BULK_GENERATION
+
+    def test_time_shift(self):
+        """
+        With BULK_GENERATION, changing only the start or end time of a generator shifts the matching occurrences in
+        the database, dropping those that are shifted past repeat_until.
+        """
+        settings.BULK_GENERATION = True
+        try:
+            daily = Rule.objects.create(frequency="DAILY")
+            g = self.furniture_collection.generators.create(
+                event_start=datetime(2010, 3, 1, 9, 00),
+                event_end=datetime(2010, 3, 1, 10, 00),
+                rule=daily,
+                repeat_until=datetime(2010, 3, 31, 9, 30),
+            )
+            self.ae(g.occurrences.count(), 31)
+
+            g.event_start = datetime(2010, 3, 1, 9, 45)
+            g.save()
+            self.ae(g.occurrences.count(), 30)
+            for o in g.occurrences.all():
+                self.ae((o.start.time(), o.end.time()), (time(9, 45), time(10, 00)))
+            self.ae(g.occurrences.order_by('-start')[0].start, datetime(2010, 3, 30, 9, 45))
+
+            g.event_end = datetime(2010, 3, 1, 10, 30)
+            g.save()
+            self.ae(g.occurrences.count(), 30)
+            for o in g.occurrences.all():
+                self.ae((o.start.time(), o.end.time()), (time(9, 45), time(10, 30)))
+        finally:
+            del settings.BULK_GENERATION
+
+    def test_change_plan_one_by_one(self):
+        """
+        Without BULK_GENERATION, the plan is applied by saving and deleting each occurrence, so the generated
+        occurrences that are deleted are added to the generator's exceptions, as when they are deleted by hand.
+        """
+        daily = Rule.objects.create(frequency="DAILY")
+        weekly = Rule.objects.create(frequency="WEEKLY")
+        g = self.furniture_collection.generators.create(
+            event_start=datetime(2010, 3, 1, 9, 00),
+            event_end=datetime(2010, 3, 1, 10, 00),
+            rule=daily,
+            repeat_until=datetime(2010, 3, 31, 9, 30),
+        )
+        pks = list(g.occurrences.values_list('pk', flat=True))
+        self.ae(len(pks), 31)
+
+        # shrinking repeat_until
+        g.repeat_until = datetime(2010, 3, 28, 9, 30)
+        g.save()
+        self.ae(g.occurrences.count(), 28)
+        for day in (29, 30, 31):
+            self.assertTrue(g.is_exception(datetime(2010, 3, day, 9, 00)))
+        self.assertTrue(g.reload().is_exception(datetime(2010, 3, 31, 9, 00)))
+
+        # shifting the start time past repeat_until
+        g.event_start = datetime(2010, 3, 1, 9, 45)
+        plan = g.plan_changes(g.reload(), bulk=False)
+        self.ae(plan.time_shift, None)
+        g.save()
+        self.ae(g.occurrences.count(), 27)
+        self.ae(list(g.occurrences.values_list('pk', flat=True)), pks[:27])
+        self.assertTrue(g.reload().is_exception(datetime(2010, 3, 28, 9, 00)))
+        for o in g.occurrences.all():
+            self.ae((o.start.time(), o.end.time()), (time(9, 45), time(10, 00)))
+
+        # changing the rule
+        g.rule = weekly
+        g.save()
+        self.ae(g.occurrences.count(), 4)
+        g = g.reload()
+        self.assertTrue(g.is_exception(datetime(2010, 3, 2, 9, 45)))
+        self.assertFalse(g.is_exception(datetime(2010, 3, 8, 9, 45)))
+
+    def test_exception_table(self):
+        """
+        Generators with an exception model (a GeneratorExceptionModel with a FK to the generator, related_name
+        'exception_set') keep their exceptions in that table, rather than in the `exceptions` field.
+        """
+        self.ae(ExampleGenerator.ExceptionModel(), None)
+        self.ae(ExampleXGenerator.ExceptionModel(), ExampleXException)
+
+        daily = Rule.objects.create(frequency="DAILY")
+        event = ExampleXEvent.eventobjects.create(name="Daily")
+        g = event.generators.create(
+            event_start=datetime(2010, 3, 1, 9, 00),
+            event_end=datetime(2010, 3, 1, 10, 00),
+            rule=daily,
+            repeat_until=datetime(2010, 3, 31, 23, 59),
+        )
+        self.ae(g.occurrences.count(), 31)
+
+        # deleting an occurrence adds an exception
+        first = g.occurrences.all()[0]
+        first.delete()
+        g = g.reload()
+        self.ae(list(g.exception_set.values_list('start', flat=True)), [datetime(2010, 3, 1, 9, 00)])
+        self.ae(g.exceptions, {})
+
+        # exceptions can be added and removed in bulk, and are honoured by generate()
+        mondays = [datetime(2010, 3, d, 9, 00) for d in (8, 15, 22, 29)]
+        g.add_exceptions(mondays + [datetime(2010, 3, 1, 9, 00)])
+        self.ae(g.exception_set.count(), 5)
+        self.assertTrue(g.is_exception(datetime(2010, 3, 15, 9, 00)))
+        self.assertFalse(g.is_exception(datetime(2010, 3, 16, 9, 00)))
+        g.occurrences.filter(start__in=mondays).update(generator=None)
+        g.generate()
+        self.ae(g.occurrences.count(), 26)
+
+        g.remove_exceptions(mondays[:2])
+        self.ae(g.exception_set.count(), 3)
+        self.assertFalse(g.reload().is_exception(datetime(2010, 3, 15, 9, 00)))
+        # an incremental generate() revisits the dates that are no longer exceptions
+        g.generate(incremental=True)
+        self.ae(g.occurrences.count(), 28)
+
+        g.reset_exceptions()
+        self.ae(g.exception_set.count(), 0)
+        g.generate()
+        self.ae(g.occurrences.count(), 31)
+
+    def test_clean_occurrences_exception_table(self):
+        """
+        clean_occurrences reads the exceptions from the exception table too, so it keeps edited occurrences and only
+        removes the ones that are wrong.
+        """
+        event = ExampleXEvent.eventobjects.create(name="Daily")
+        g = event.generators.create(
+            event_start=datetime(2010, 3, 1, 9, 00),
+            event_end=datetime(2010, 3, 1, 10, 00),
+            rule=Rule.objects.create(frequency="DAILY"),
+            repeat_until=datetime(2010, 3, 5, 23, 59),
+        )
+        edited, broken = g.occurrences.all()[1:3]
+        edited.end = datetime(2010, 3, 2, 11, 00)
+        edited.save()
+        self.assertTrue(g.reload().is_exception(edited.start))
+        self.ae(g.reload().exceptions, {})
+        g.occurrences.filter(pk=broken.pk).update(end=datetime(2010, 3, 3, 11, 00))
+
+        call_command('clean_occurrences', 'eventtools_testapp.ExampleXGenerator', verbosity=0)
+        self.ae(g.occurrences.filter(pk=edited.pk).count(), 1)
+        self.ae(g.occurrences.filter(pk=broken.pk).count(), 0)
+        self.ae(g.occurrences.count(), 4)
+
+    def test_bulk_delete(self):
+        """
+        Deleting a queryset of occurrences with bulk_delete() adds the generated ones to their generators' exceptions,
+        just like deleting them one by one, but with one write per generator.
+        """
+        doomed = ExampleGOccurrence.objects.filter(generator__in=[self.weekly_generator, self.endless_generator])
+        doomed = doomed.filter(start__lt=datetime(2010, 1, 20))
+        starts = dict([(g.pk, set(g.occurrences.filter(start__lt=datetime(2010, 1, 20)).values_list('start', flat=True)))
+            for g in (self.weekly_generator, self.endless_generator)])
+        count = doomed.count()
+        self.assertTrue(count > 2)
+
+        self.ae(doomed.bulk_delete(), count)
+        self.ae(doomed.count(), 0)
+        for g in (self.weekly_generator, self.endless_generator):
+            g = g.reload()
+            self.ae(sorted(g.exceptions.keys()), sorted([start.isoformat() for start in starts[g.pk]]))
+            g.generate()
+            self.ae(g.occurrences.filter(start__lt=datetime(2010, 1, 20)).count(), 0)
+
+    def test_unique_occurrences(self):
+        """
+        With a unique index on the occurrences (see the create_occurrence_indexes command) and UNIQUE_OCCURRENCES,
+        generation leaves the index to skip the occurrences that already exist.
+        """
+        call_command('create_occurrence_indexes', 'eventtools_testapp.ExampleGOccurrence', verbosity=0)
+        settings.UNIQUE_OCCURRENCES = True
+        try:
+            daily = Rule.objects.create(frequency="DAILY")
+            g = self.furniture_collection.generators.create(
+                event_start=datetime(2010, 3, 1, 9, 00),
+                event_end=datetime(2010, 3, 1, 10, 00),
+                rule=daily,
+                repeat_until=datetime(2010, 3, 31, 23, 59),
+            )
+            self.ae(g.occurrences.count(), 31)
+            g.generate()
+            g.generate(bulk=False)
+            self.ae(g.occurrences.count(), 31)
+            self.ae(g.create_occurrence(start=datetime(2010, 3, 2, 9, 00), end=datetime(2010, 3, 2, 10, 00)), None)
+            self.ae(g.occurrences.count(), 31)
+        finally:
+            del settings.UNIQUE_OCCURRENCES
+
+    def test_deferred_regeneration(self):
+        """
+        With DEFER_REGENERATION, saving a generator queues it for regeneration (once, however often it's saved) in its
+        RegenerationRequestModel, and the process_regeneration_requests command generates the occurrences.
+        """
+        settings.DEFER_REGENERATION = True
+        settings.REGENERATION_DELAY = 0
+        try:
+            daily = Rule.objects.create(frequency="DAILY")
+            g = self.furniture_collection.generators.create(
+                event_start=datetime(2010, 3, 1, 9, 00),
+                event_end=datetime(2010, 3, 1, 10, 00),
+                rule=daily,
+                repeat_until=datetime(2010, 3, 31, 23, 59),
+            )
+            self.ae(g.occurrences.count(), 0)
+            g.event_end = datetime(2010, 3, 1, 11, 00)
+            g.save()
+            self.ae(ExampleGRegenerationRequest.objects.count(), 1)
+
+            call_command('process_regeneration_requests', verbosity=0)
+            self.ae(g.occurrences.count(), 31)
+            self.ae(set([o.duration for o in g.occurrences.all()]), set([timedelta(hours=2)]))
+            self.ae(ExampleGRegenerationRequest.objects.count(), 0)
+
+            # claimed requests aren't claimed again, and saves meanwhile queue another request
+            g.save()
+            claimed = ExampleGRegenerationRequest.objects.claim()
+            self.ae(len(claimed), 1)
+            self.ae(ExampleGRegenerationRequest.objects.claim(), [])
+            g.save()
+            self.ae(ExampleGRegenerationRequest.objects.count(), 2)
+            claimed[0].run()
+            self.ae(ExampleGRegenerationRequest.objects.count(), 1)
+
+            # a save queues a full regeneration, and turns a pending incremental request into one
+            ExampleGRegenerationRequest.objects.all().delete()
+            g.save()
+            self.ae(ExampleGRegenerationRequest.objects.get().incremental, False)
+            ExampleGRegenerationRequest.objects.all().delete()
+            ExampleGRegenerationRequest.objects.request(g, incremental=True)
+            self.ae(ExampleGRegenerationRequest.objects.get().incremental, True)
+            g.save()
+            self.ae(ExampleGRegenerationRequest.objects.get().incremental, False)
+
+            # generators without a queue can't be deferred
+            self.ae(ExampleXGenerator.RegenerationRequest(), None)
+            x = ExampleXEvent.eventobjects.create(name="Queueless")
+            self.assertRaises(ImproperlyConfigured, x.generators.create,
+                event_start=datetime(2010, 3, 1, 9, 00),
+                event_end=datetime(2010, 3, 1, 10, 00),
+                rule=daily,
+                repeat_until=datetime(2010, 3, 31, 23, 59),
+            )
+        finally:
+            del settings.DEFER_REGENERATION
+            del settings.REGENERATION_DELAY
+
+    def test_ical_series(self):
+        """
+        With `series`, a CalendarWriter writes each generator's occurrences as one recurring VEVENT: an RRULE from the
+        generator's rule, EXDATEs for the occurrences that aren't in the feed, and overrides for edited occurrences.
+        Calendar apps expand it to the same occurrences as the feed without series.
+        """
+        self.ae(Rule(frequency="WEEKLY", params="interval:2;byweekday:0,2;count:4").ical_recur(),
+            "FREQ=WEEKLY;BYDAY=MO,WE;INTERVAL=2")
+        self.ae(Rule(frequency="YEARLY", params="byeaster:0").ical_recur(), None)
+        self.ae(Rule(complex_rule="RRULE:FREQ=MONTHLY;BYDAY=+1MO;COUNT=3").ical_recur(), "FREQ=MONTHLY;BYDAY=+1MO")
+
+        deleted, moved = self.weekly_generator.occurrences.all()[1:3]
+        deleted.delete()
+        moved.start += timedelta(hours=2)
+        moved.end += timedelta(hours=2)
+        moved.save()
+
+        request = RequestFactory().get('/')
+        tz = gettz(settings.TIME_ZONE)
+        def as_utc(start, all_day):
+            if all_day:
+                return start.date()
+            return start.replace(tzinfo=tz).astimezone(ics.UTC)
+
+        def expanded(text):
+            calendar = vobject.readOne(text)
+            # overrides replace the instances of their own series
+            overridden = set([(vevent.uid.value, vevent.recurrence_id.value) for vevent in calendar.vevent_list
+                if hasattr(vevent, 'recurrence_id')])
+            starts = set()
+            for vevent in calendar.vevent_list:
+                if hasattr(vevent, 'rrule'):
+                    starts.update([start for start in vevent.getrruleset()
+                        if (vevent.uid.value, start) not in overridden])
+                else:
+                    starts.add(vevent.dtstart.value)
+            return set([start.tzinfo is None and start.date() or start.astimezone(ics.UTC) for start in starts])
+
+        pool = ExampleGOccurrence.objects.filter(event=self.bin_night)
+        writer = ics.CalendarWriter(request, series=True)
+        texts = []
+        self.assertNumQueries(4, lambda: texts.append("".join(writer.stream(pool))))
+        text = texts[0]
+        # the one-off, the weekly series and its override, the duplicate weekly series (clashing occurrences are
+        # allowed, so it has its 5 occurrences), and the endless and all-day series
+        self.ae(self.dupe_weekly_generator.occurrences.count(), 5)
+        self.ae(text.count("BEGIN:VEVENT"), 6)
+        self.ae(text.count("RRULE:FREQ=WEEKLY;UNTIL="), 4)
+        self.ae(text.count("EXDATE"), 1)
+        self.ae(text.count("RECURRENCE-ID"), 1)
+        self.ae(text.count("BEGIN:VTIMEZONE"), 1)
+        self.ae(expanded(text), set([as_utc(o.start, o.all_day) for o in pool]))
+
+        # a window of the feed only has the occurrences in the window
+        pool = pool.filter(start__gte=datetime(2010, 1, 10), start__lt=datetime(2010, 3, 1))
+        self.ae(expanded("".join(writer.stream(pool))), set([as_utc(o.start, o.all_day) for o in pool]))
+
     def test_all_day(self):
         """
         If the start time of a generator is time.min and the end time is time.max, then the generator generates all_day
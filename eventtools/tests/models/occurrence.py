@@ -6,6 +6,10 @@ from datetime import date, time, datetime, timedelta
 from eventtools.tests._fixture import bigfixture, reload_films
 from eventtools.utils import datetimeify
 from dateutil.relativedelta import relativedelta
+from django.test.client import RequestFactory
+from vobject import iCalendar
+from eventtools.conf import settings
+from eventtools.utils import ics
 
 class TestOccurrences(AppTestCase):
     """
@@ -131,6 +135,67 @@ class TestOccurrences(AppTestCase):
         self.assertTrue(o.relative_time_to_go().years < 0)
         self.ae(o2.relative_time_to_go(), None)
 
+    def test_dirty_fields(self):
+        """
+        Occurrences remember the values they were loaded (or last saved) with, so saving can tell what has changed
+        without fetching the saved occurrence again.
+        """
+        e = ExampleEvent.eventobjects.create(name="event with occurrences")
+        o = e.occurrences.create(start=datetime(2010,1,1,9,00), end=datetime(2010,1,1,10,00))
+        self.ae(o.get_dirty_fields(), {})
+
+        o = ExampleOccurrence.objects.get(pk=o.pk)
+        o.start = datetime(2010,1,1,9,30)
+        self.ae(o.get_dirty_fields(), {'start': datetime(2010,1,1,9,00)})
+        self.ae(o.saved_instance().start, datetime(2010,1,1,9,00))
+
+        o.save()
+        self.ae(o.get_dirty_fields(), {})
+        self.ae(ExampleOccurrence(start=datetime(2010,1,1,9,00)).saved_instance(), None)
+
+    def test_ical_writer(self):
+        """
+        CalendarWriter writes VEVENTs straight to text. In vobject_compatible mode, the output is byte for byte what
+        vobject serializes for as_icalendar().
+        """
+        e = ExampleEvent.eventobjects.create(name="Tours, talks; films")
+        long_e = ExampleEvent.eventobjects.create(name=u"A long event name \\ with \"quotes\",\nlines and " + u"é中" * 40)
+        corpus = [
+            e.occurrences.create(start=datetime(2010, 1, 1, 10, 00), end=datetime(2010, 1, 1, 11, 30)),
+            e.occurrences.create(start=date(2010, 1, 2)), # all day
+            long_e.occurrences.create(start=datetime(2010, 6, 1, 10, 00), end=datetime(2010, 6, 3, 17, 00)),
+            long_e.occurrences.create(start=datetime(2010, 6, 4, 10, 00), status="cancelled"),
+        ]
+        corpus[2].venue_description = u"Gallery 1, Level 2; the old wing"
+        corpus[2].ical_description = u"x" * 200
+        corpus[2].latitude, corpus[2].longitude = -33.86, 151.2
+        corpus[3].is_cancelled = True
+        request = RequestFactory().get('/')
+
+        ical = iCalendar()
+        ical.add('X-WR-CALNAME').value = settings.ICAL_CALNAME
+        ical.add('X-WR-CALDESC').value = settings.ICAL_CALDESC
+        ical.add('method').value = 'PUBLISH'
+        for o in corpus:
+            o.as_icalendar(ical, request)
+        writer = ics.CalendarWriter(request, vobject_compatible=True)
+        self.ae("".join(writer.stream(corpus)), ical.serialize())
+        self.ae(corpus[0].as_vevent(request, vobject_compatible=True), corpus[0].as_icalendar(iCalendar(), request).vevent.serialize())
+
+        # the *_attr hooks are honoured
+        writer = ics.CalendarWriter(request, vobject_compatible=True, summary_attr='status', url_attr='nothing')
+        ical = corpus[3].as_icalendar(iCalendar(), request, summary_attr='status', url_attr='nothing')
+        self.ae(writer.vevent(corpus[3]), ical.vevent.serialize())
+        self.assertTrue("SUMMARY:cancelled" in writer.vevent(corpus[3]))
+
+        # otherwise, VEVENTs are as RFC 5545 has them
+        vevent = ics.CalendarWriter(request).vevent(corpus[2])
+        self.assertTrue("GEO:-33.86;151.2\r\n" in vevent)
+        self.assertTrue("LOCATION:Gallery 1\\, Level 2\\; the old wing\r\n" in vevent)
+        self.assertFalse("METHOD" in ics.CalendarWriter(request).vevent(corpus[3]))
+        # UIDs stay the same from one feed to the next
+        self.assertTrue("UID:%s\r\n" % str(ics.occurrence_uid(corpus[2], request.get_host())) in vevent)
+
 """
 TODO
 
@@ -1,12 +1,14 @@
 # -*- coding: utf-8“ -*-
+from cStringIO import StringIO
 from datetime import date, time, datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from gzip import GzipFile
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 
-from eventtools.utils import datetimeify
+from eventtools.utils import datetimeify, ics
 from eventtools_testapp.models import *
 
 from _fixture import bigfixture, reload_films
@@ -121,7 +123,7 @@ class TestViews(AppTestCase):
 
         url = reverse('occurrence_list',)
         r = self.client.get(url,  {'startdate':'2010-01-01', 'enddate':'2010-01-05'})
-        self.assertEqual(r.context['occurrence_pool'].count(), 109)
+        self.assertEqual(r.context['occurrence_pool'].count(), 5)
         self.assertEqual(len(r.context['occurrence_page']), 5)
         self.assertEqual(r.context['occurrence_page'][0].start.date(), date(2010,1,1))
         self.assertEqual(r.context['occurrence_page'].reverse()[0].start.date(), date(2010,1,5))
@@ -157,7 +159,7 @@ class TestViews(AppTestCase):
         You can view an ical for an occurrence.
         The ical is linked from the occurrence page.
         You can view an ical for a collection of occurrences.
-        (TODO: do large icals perform well? If not we might have to make it a feed.)
+        Icals are streamed, a slice of occurrences at a time.
         """
         e = self.daily_tour
         o = e.occurrences.all()[0]
@@ -166,26 +168,119 @@ class TestViews(AppTestCase):
         o_ical_url = reverse('occurrence_ical', kwargs={'occurrence_id': o.id })
         r = self.client.get(o_ical_url)
         self.assertEqual(r.status_code, 200)
-                
-        self.assertContains(r, "BEGIN:VCALENDAR", 1)
-        self.assertContains(r, "BEGIN:VEVENT", 1)
-
-        self.assertContains(r, "SUMMARY:Daily Tour", 1)
-        self.assertContains(r, "DTSTART;VALUE=DATE:20100101", 1)
-        self.assertContains(r, "DTEND;VALUE=DATE:20100101", 1)
-        self.assertContains(r, "URL:http://testserver%s" % o_url, 1)
+        # the response is streamed, so read it once
+        content = r.content
+
+        self.ae(content.count("BEGIN:VCALENDAR"), 1)
+        self.ae(content.count("BEGIN:VEVENT"), 1)
+
+        self.ae(content.count("SUMMARY:Daily Tour"), 1)
+        self.ae(content.count("DTSTART;VALUE=DATE:20100101"), 1)
+        self.ae(content.count("DTEND;VALUE=DATE:20100101"), 1)
+        self.ae(content.count("URL:http://testserver%s" % o_url), 1)
         # etc.
     
         #Multiple occurrences
         e_ical_url = reverse('event_ical', kwargs={'event_slug': e.slug })
         r = self.client.get(e_ical_url)
         self.assertEqual(r.status_code, 200)
-                
-        self.assertContains(r, "BEGIN:VCALENDAR", 1)
-        self.assertContains(r, "BEGIN:VEVENT", 49)
-        self.assertContains(r, "SUMMARY:Daily Tour", 49)
-        self.assertContains(r, "DTSTART;VALUE=DATE:20100101", 1)
-        self.assertContains(r, "DTEND;VALUE=DATE:20100101", 1)
+        content = r.content
+
+        self.ae(content.count("BEGIN:VCALENDAR"), 1)
+        self.ae(content.count("BEGIN:VEVENT"), 49)
+        self.ae(content.count("SUMMARY:Daily Tour"), 49)
+        self.ae(content.count("DTSTART;VALUE=DATE:20100101"), 1)
+        self.ae(content.count("DTEND;VALUE=DATE:20100101"), 1)
+        self.ae(content.count("UID:"), 49)
+        # lines are folded to fewer than 75 octets
+        for line in content.split("\r\n"):
+            self.assertTrue(len(line) < 75)
+        # once read (eg. by middleware that sets an ETag), the content is kept, so it can be read again
+        self.ae(r.content, content)
+        self.ae("".join(r), content)
+
+        # the occurrences are streamed, a slice at a time
+        occurrences = e.occurrences.all()
+        expected = list(occurrences)
+        self.assertNumQueries(5, lambda: self.ae(list(ics.iterate_in_chunks(occurrences, 10)), expected))
+        # each chunk follows on from the ordering values of the last, with the pk breaking ties
+        e.occurrences.create(start=expected[9].start, end=expected[9].end + timedelta(hours=1))
+        e.occurrences.create(start=expected[9].start, end=expected[9].end)
+        for ordering in [('start', 'end'), ('-end',), ('event__name', 'start')]:
+            self.ae(
+                list(ics.iterate_in_chunks(occurrences.order_by(*ordering), 10)),
+                list(occurrences.order_by(*(ordering + ('pk',))))
+            )
+        self.ae(ics.fold(u"SUMMARY:" + u"\u00e9" * 40), "SUMMARY:" + "\xc3\xa9" * 33 + "\r\n " + "\xc3\xa9" * 7 + "\r\n")
+        self.ae(ics.escape_text(u"Tours, talks; films\nand \\"), u"Tours\\, talks\\; films\\nand \\\\")
+
+    def test_ical_window(self):
+        """
+        The occurrence list ical has the occurrences in the requested window. Windows with an open end are closed at
+        ICAL_MAX_WINDOW from the other, and longer windows are a bad request. Feeds have at most ICAL_MAX_OCCURRENCES
+        occurrences.
+        """
+        url = reverse('occurrence_list_ical')
+        r = self.client.get(url, {'startdate': '2010-01-01', 'enddate': '2010-01-05'})
+        self.assertContains(r, "BEGIN:VEVENT", 5)
+
+        r = self.client.get(url, {'enddate': '2010-01-05'})
+        self.assertContains(r, "BEGIN:VEVENT", ExampleOccurrence.objects.between(date(2009, 1, 5), date(2010, 1, 5)).count())
+        self.ae(self.client.get(url, {'startdate': '2010-01-01', 'enddate': '2011-06-01'}).status_code, 400)
+
+        settings.ICAL_MAX_OCCURRENCES = 3
+        try:
+            r = self.client.get(url, {'startdate': '2010-01-01', 'enddate': '2010-01-05'})
+            self.assertContains(r, "BEGIN:VEVENT", 3)
+        finally:
+            del settings.ICAL_MAX_OCCURRENCES
+        occurrences = ExampleOccurrence.objects.all()
+        self.ae(list(ics.iterate_in_chunks(occurrences, 10, limit=25)), list(occurrences[:25]))
+
+    def test_ical_cache(self):
+        """
+        With ICAL_CACHE, feeds are cached gzipped, with an ETag and Last-Modified from the change version of the
+        occurrences. Conditional GETs of unchanged feeds get a 304 without querying the occurrences, and saving an
+        occurrence (or its event) changes the version.
+        """
+        settings.ICAL_CACHE = True
+        try:
+            e = self.daily_tour
+            url = reverse('event_ical', kwargs={'event_slug': e.slug })
+            ExampleOccurrence.occurrences_changed()
+            r = self.client.get(url)
+            self.ae(r.status_code, 200)
+            self.assertContains(r, "BEGIN:VEVENT", 49)
+            etag, last_modified = r['ETag'], r['Last-Modified']
+
+            # the cached feed, gzipped for clients that accept it, with its own ETag
+            responses = []
+            self.assertNumQueries(0, lambda: responses.append(self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')))
+            r2 = responses[0]
+            self.ae(r2['Content-Encoding'], 'gzip')
+            self.assertTrue(r2['ETag'] != etag)
+            self.ae(GzipFile(fileobj=StringIO(r2.content)).read(), r.content)
+
+            self.assertNumQueries(0, lambda: responses.append(self.client.get(url, HTTP_IF_NONE_MATCH=etag)))
+            self.ae(responses[-1].status_code, 304)
+            self.ae(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+            self.ae(self.client.get(url, HTTP_IF_NONE_MATCH=r2['ETag'], HTTP_ACCEPT_ENCODING='gzip').status_code, 304)
+
+            o = e.occurrences.all()[0]
+            o.end += timedelta(hours=1)
+            o.save()
+            r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.ae(r.status_code, 200)
+            self.assertTrue(r['ETag'] != etag)
+
+            etag = r['ETag']
+            e.name = "Daily Tours"
+            e.save()
+            r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.ae(r.status_code, 200)
+            self.assertContains(r, "SUMMARY:Daily Tours", 49)
+        finally:
+            del settings.ICAL_CACHE
 
     def test_hcal(self):
         """
@@ -0,0 +1,217 @@
+"""
+Helpers for writing many rows at once, for the places where eventtools would
+otherwise save model instances one by one (eg. generating occurrences).
+
+These bypass Model.save(), so no signals are sent, and the instances passed in
+don't get their primary keys set.
+"""
+from django.db import connections, router, transaction, models
+
+from eventtools.conf import settings
+
+# SQLite refuses statements with more than this many parameters.
+SQLITE_MAX_VARIABLES = 999
+
+def chunks(items, size=None):
+    """
+    Split the list `items` into lists of at most `size` (by default, OCCURRENCE_INSERT_CHUNK_SIZE) items, eg. to keep
+    `pk__in` lookups within the database's limits.
+    """
+    if size is None:
+        size = settings.OCCURRENCE_INSERT_CHUNK_SIZE
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+def _supports_multirow_insert(connection):
+    if connection.vendor in ('postgresql', 'mysql'):
+        return True
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 7, 11)
+    return False
+
+def supports_insert_ignore(connection):
+    """
+    Whether bulk_insert() can skip rows that would violate a unique index on this connection.
+    """
+    if connection.vendor in ('sqlite', 'mysql'):
+        return True
+    if connection.vendor == 'postgresql': # ON CONFLICT is new in PostgreSQL 9.5
+        version = getattr(connection, 'pg_version', None) # eg. 90500
+        if version is not None:
+            return version >= 90500
+        connection.cursor() # the version is read when connecting
+        return tuple(connection.ops.postgres_version[:2]) >= (9, 5)
+    return False
+
+def bulk_insert(model, objs, chunk_size=None, ignore_conflicts=False):
+    """
+    INSERT the unsaved model instances `objs`, `chunk_size` rows per statement.
+
+    Backends that can't do multi-row INSERTs get one executemany() per chunk instead.
+
+    With `ignore_conflicts` (see supports_insert_ignore()), rows that would violate a unique index are skipped, and
+    the number of rows actually inserted is returned.
+    """
+    objs = list(objs)
+    if not objs:
+        return 0
+    if chunk_size is None:
+        chunk_size = settings.OCCURRENCE_INSERT_CHUNK_SIZE
+
+    if model._meta.parents: # multi-table inheritance needs several INSERTs per row
+        for obj in objs:
+            obj.save(force_insert=True)
+        return len(objs)
+
+    using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    fields = [f for f in model._meta.local_fields if not isinstance(f, models.AutoField)]
+    if connection.vendor == 'sqlite':
+        chunk_size = max(1, min(chunk_size, SQLITE_MAX_VARIABLES // len(fields)))
+
+    columns = u", ".join([qn(f.column) for f in fields])
+    row_sql = u"(%s)" % u", ".join(["%s"] * len(fields))
+    insert_sql = u"INSERT INTO %s (%s) VALUES " % (qn(model._meta.db_table), columns)
+    suffix = u""
+    if ignore_conflicts:
+        if connection.vendor == 'sqlite':
+            insert_sql = u"INSERT OR IGNORE" + insert_sql[len(u"INSERT"):]
+        elif connection.vendor == 'mysql':
+            insert_sql = u"INSERT IGNORE" + insert_sql[len(u"INSERT"):]
+        else:
+            suffix = u" ON CONFLICT DO NOTHING"
+
+    multirow = _supports_multirow_insert(connection)
+    inserted = 0
+    cursor = connection.cursor()
+    for i in range(0, len(objs), chunk_size):
+        rows = [
+            [f.get_db_prep_save(f.pre_save(obj, True), connection=connection) for f in fields]
+            for obj in objs[i:i+chunk_size]
+        ]
+        if multirow:
+            params = []
+            for row in rows:
+                params.extend(row)
+            cursor.execute(insert_sql + u", ".join([row_sql] * len(rows)) + suffix, params)
+        else:
+            cursor.executemany(insert_sql + row_sql + suffix, rows)
+        inserted += cursor.rowcount
+    transaction.commit_unless_managed(using=using)
+    if ignore_conflicts:
+        return inserted
+    return len(objs)
+
+def bulk_update(model, values, chunk_size=None):
+    """
+    UPDATE many rows, each with its own values. `values` maps primary keys to dicts of {field name: value}.
+
+    Rows that set the same fields are updated together, `chunk_size` rows per statement, using CASE expressions.
+    """
+    if not values:
+        return 0
+    if chunk_size is None:
+        chunk_size = settings.OCCURRENCE_INSERT_CHUNK_SIZE
+
+    using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    pk = model._meta.pk
+    pk_column = u"%s.%s" % (qn(model._meta.db_table), qn(pk.column))
+
+    groups = {}
+    for key, row in values.iteritems():
+        groups.setdefault(tuple(sorted(row.keys())), []).append(key)
+
+    cursor = connection.cursor()
+    for field_names, keys in groups.iteritems():
+        fields = [model._meta.get_field(name) for name in field_names]
+        if connection.vendor == 'sqlite':
+            chunk_size = max(1, min(chunk_size, SQLITE_MAX_VARIABLES // (2 * len(fields) + 1)))
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i+chunk_size]
+            assignments = []
+            params = []
+            for field in fields:
+                # PostgreSQL can't infer the type of a CASE of bare parameters
+                if connection.vendor == 'postgresql':
+                    placeholder = u"CAST(%%s AS %s)" % field.db_type(connection=connection)
+                else:
+                    placeholder = u"%s"
+                whens = []
+                for key in chunk:
+                    whens.append(u"WHEN %%s THEN %s" % placeholder)
+                    params.append(pk.get_db_prep_value(key, connection=connection))
+                    params.append(field.get_db_prep_save(values[key][field.name], connection=connection))
+                assignments.append(u"%s = CASE %s %s END" % (qn(field.column), pk_column, u" ".join(whens)))
+            params.extend([pk.get_db_prep_value(key, connection=connection) for key in chunk])
+            cursor.execute(u"UPDATE %s SET %s WHERE %s IN (%s)" % (
+                qn(model._meta.db_table),
+                u", ".join(assignments),
+                pk_column,
+                u", ".join([u"%s"] * len(chunk)),
+            ), params)
+    transaction.commit_unless_managed(using=using)
+    return len(values)
+
+def bulk_delete(model, pks, chunk_size=None):
+    """
+    DELETE the rows with the given primary keys, `chunk_size` rows per statement, without sending any signals.
+
+    If other models refer to `model`, the rows are deleted with QuerySet.delete(), so that the references are
+    cleaned up (and signals are sent).
+    """
+    pks = list(pks)
+    if not pks:
+        return 0
+    if chunk_size is None:
+        chunk_size = settings.OCCURRENCE_INSERT_CHUNK_SIZE
+
+    using = router.db_for_write(model)
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        chunk_size = min(chunk_size, SQLITE_MAX_VARIABLES)
+
+    if model._meta.get_all_related_objects():
+        for i in range(0, len(pks), chunk_size):
+            model._default_manager.filter(pk__in=pks[i:i+chunk_size]).delete()
+        return len(pks)
+
+    qn = connection.ops.quote_name
+    pk = model._meta.pk
+    cursor = connection.cursor()
+    for i in range(0, len(pks), chunk_size):
+        chunk = pks[i:i+chunk_size]
+        cursor.execute(u"DELETE FROM %s WHERE %s IN (%s)" % (
+            qn(model._meta.db_table),
+            qn(pk.column),
+            u", ".join([u"%s"] * len(chunk)),
+        ), [pk.get_db_prep_value(key, connection=connection) for key in chunk])
+    transaction.commit_unless_managed(using=using)
+    return len(pks)
+
+# Backends that datetime_add_sql() and time_of_day_sql() know how to write SQL for
+DATETIME_SQL_VENDORS = ('sqlite', 'postgresql')
+
+def datetime_add_sql(connection, column, seconds):
+    """
+    SQL for the datetime `column` plus a whole number of `seconds`, and its params.
+    """
+    if connection.vendor == 'sqlite':
+        # gives 'YYYY-MM-DD HH:MM:SS', which is how Django stores datetimes without microseconds
+        return u"datetime(%s, %%s)" % column, [u"%+d seconds" % seconds]
+    if connection.vendor == 'postgresql':
+        return u"(%s + %%s * INTERVAL '1 second')" % column, [seconds]
+    raise NotImplementedError("Datetime arithmetic isn't supported on %s." % connection.vendor)
+
+def time_of_day_sql(connection, column):
+    """
+    SQL for the time of day of the datetime `column`, to compare with connection.ops.value_to_db_time() values.
+    """
+    if connection.vendor == 'sqlite':
+        return u"substr(%s, 12)" % column
+    if connection.vendor == 'postgresql':
+        return u"CAST(%s AS time)" % column
+    raise NotImplementedError("Time of day extraction isn't supported on %s." % connection.vendor)
@@ -0,0 +1,56 @@
+"""
+A mixin for models that need to know how an instance has changed since it was loaded (or last saved), without
+fetching the saved row again to compare.
+"""
+
+_missing = object()
+
+class DirtyFieldsMixin(object):
+    """
+    Snapshots the field values of saved instances when they're created (eg. loaded from a queryset) and after each
+    save().
+
+    The snapshot is shallow, and doesn't see changes made with QuerySet.update(). Instances whose snapshot is
+    incomplete (eg. with deferred fields) fall back to fetching the saved row.
+    """
+    def __init__(self, *args, **kwargs):
+        super(DirtyFieldsMixin, self).__init__(*args, **kwargs)
+        self._snapshot_state()
+
+    def save(self, *args, **kwargs):
+        result = super(DirtyFieldsMixin, self).save(*args, **kwargs)
+        self._snapshot_state()
+        return result
+
+    def _snapshot_state(self):
+        if self.pk is None:
+            self._saved_state = None
+        else:
+            # read from __dict__, so that deferred fields aren't loaded
+            self._saved_state = dict([
+                (f.attname, self.__dict__.get(f.attname, _missing)) for f in self._meta.fields])
+
+    def saved_instance(self):
+        """
+        An instance with the field values this one was loaded with, or None if it hasn't been saved.
+        """
+        if self.pk is None:
+            return None
+        state = getattr(self, '_saved_state', None)
+        if state is None or _missing in state.values() or state[self._meta.pk.attname] != self.pk:
+            return type(self)._base_manager.get(pk=self.pk)
+        return type(self)(**state)
+
+    def get_dirty_fields(self):
+        """
+        A dict of {attname: saved value} for the fields that have changed since this instance was loaded.
+        """
+        saved = self.saved_instance()
+        if saved is None:
+            return {}
+        dirty = {}
+        for f in self._meta.fields:
+            saved_value = getattr(saved, f.attname)
+            if getattr(self, f.attname) != saved_value:
+                dirty[f.attname] = saved_value
+        return dirty
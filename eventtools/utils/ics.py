@@ -0,0 +1,390 @@
+"""
+Writing iCalendar (RFC 5545) text directly, a line at a time, so that feeds can be streamed rather than built up as
+one vobject iCalendar in memory.
+"""
+from datetime import datetime, timedelta
+from dateutil.tz import gettz, tzutc
+from vobject.icalendar import TimezoneComponent
+
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+
+from eventtools.conf import settings
+from eventtools.utils.bulk import chunks
+
+CRLF = "\r\n"
+UTC = tzutc()
+PRODID = "-//PYVOBJECT//NONSGML Version 1//EN" # as vobject writes it, so feeds don't change
+
+def escape_text(value):
+    """
+    Escape a TEXT value: backslashes, semicolons, commas and newlines.
+    """
+    value = value.replace(u"\\", u"\\\\").replace(u";", u"\\;").replace(u",", u"\\,")
+    return value.replace(u"\r\n", u"\\n").replace(u"\n", u"\\n").replace(u"\r", u"\\n")
+
+def fold(line, length=75):
+    """
+    Encode `line` as UTF-8 and fold it into lines of fewer than `length` octets (counting the leading space of the
+    continuation lines), without splitting multi-byte characters. Each line ends with CRLF.
+    """
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    if len(line) < length:
+        return line + CRLF
+    lines = []
+    start = 0
+    while len(line) - start >= length:
+        end = start + length - 1
+        while (ord(line[end]) & 0xC0) == 0x80: # a UTF-8 continuation byte
+            end -= 1
+        lines.append(line[start:end])
+        start = end
+    lines.append(line[start:])
+    return (CRLF + " ").join(lines) + CRLF
+
+def format_value(value):
+    """
+    Format a date or datetime value. Datetimes in UTC end with 'Z'; naive ones are floating times.
+    """
+    if isinstance(value, datetime):
+        text = value.strftime("%Y%m%dT%H%M%S")
+        if value.tzinfo is not None and value.utcoffset() == timedelta(0):
+            text += "Z"
+        return text
+    return value.strftime("%Y%m%d")
+
+def content_line(name, value, escape=True):
+    """
+    A folded content line. Dates and datetimes are formatted (with VALUE=DATE for dates), and other values are
+    escaped as TEXT unless `escape` is False.
+    """
+    if hasattr(value, 'strftime'):
+        if not isinstance(value, datetime):
+            name += ";VALUE=DATE"
+        value = format_value(value)
+    else:
+        value = unicode(value)
+        if escape:
+            value = escape_text(value)
+    return fold(u"%s:%s" % (name, value))
+
+def iterate_in_chunks(occurrences, chunk_size=None, limit=None):
+    """
+    Iterate over (up to `limit` of) `occurrences`, a queryset a chunk at a time (with their events), so that only one
+    chunk of instances is held at a time. Each chunk is fetched by the ordering values of the last one (and its pk),
+    so the database doesn't skip through the earlier occurrences again, unless some of the ordering fields can't be
+    compared that way (see _keyset()), when OFFSET slices are used instead. Other iterables are iterated as they are.
+    """
+    if not hasattr(occurrences, 'iterator'):
+        for i, occurrence in enumerate(occurrences):
+            if limit is not None and i >= limit:
+                return
+            yield occurrence
+        return
+    if chunk_size is None:
+        chunk_size = settings.ICAL_CHUNK_SIZE
+    occurrences = occurrences.select_related('event')
+    # a unique ordering, so the chunks don't overlap
+    ordering = list(occurrences.query.order_by or occurrences.model._meta.ordering) + ['pk']
+    occurrences = occurrences.order_by(*ordering)
+    keys = _keyset(occurrences.model, ordering)
+    done = 0
+    last = None
+    while limit is None or done < limit:
+        size = chunk_size
+        if limit is not None:
+            size = min(size, limit - done)
+        if keys is None:
+            chunk = occurrences[done:done + size]
+        elif last is None:
+            chunk = occurrences[:size]
+        else:
+            chunk = occurrences.filter(_after(keys, last))[:size]
+        count = 0
+        for occurrence in chunk.iterator():
+            count += 1
+            yield occurrence
+        if count < size:
+            return
+        done += count
+        last = occurrence
+
+def _keyset(model, ordering):
+    """
+    The (field, descending) pairs of `ordering`, if the occurrences of `model` can be fetched by the values of those
+    fields in the last one fetched, ie. they are all columns of the occurrence table that can't be NULL. Otherwise
+    None.
+    """
+    opts = model._meta
+    keys = []
+    for name in ordering:
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name == 'pk':
+            name = opts.pk.name
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if field.null or field.rel is not None: # related fields are ordered by the related model's ordering
+            return None
+        keys.append((field, descending))
+    return keys
+
+def _after(keys, occurrence):
+    """
+    A Q of the occurrences that come after `occurrence` in the ordering `keys` (see _keyset()).
+    """
+    after = None
+    for i, (field, descending) in enumerate(keys):
+        q = Q(**{'%s__%s' % (field.name, descending and 'lt' or 'gt'): getattr(occurrence, field.attname)})
+        for earlier, _ in keys[:i]:
+            q &= Q(**{earlier.name: getattr(occurrence, earlier.attname)})
+        after = after is None and q or after | q
+    return after
+
+def occurrence_uid(occurrence, host):
+    """
+    A UID for `occurrence` (or for a generator's series) that stays the same from one feed to the next.
+    """
+    return u"%s-%s@%s" % (occurrence._meta.db_table, occurrence.pk, host)
+
+_vtimezones = {}
+
+def vtimezone(name):
+    """
+    The text of a VTIMEZONE for the time zone `name` (eg. 'Australia/Sydney'), as vobject works it out.
+    """
+    if name not in _vtimezones:
+        component = TimezoneComponent(gettz(name))
+        component.tzid.value = name
+        _vtimezones[name] = component.serialize()
+    return _vtimezones[name]
+
+def can_write_series(occurrences):
+    """
+    Whether `occurrences` is a queryset of generated occurrences that CalendarWriter can write as series.
+    """
+    return hasattr(occurrences, 'query') and occurrences.query.can_filter() \
+        and 'generator' in [field.name for field in occurrences.model._meta.fields]
+
+
+class CalendarWriter(object):
+    """
+    Writes iCalendars of occurrences, working out what's the same for every occurrence in a feed (the time zone, the
+    site's domain, and which attributes to read, as for OccurrenceModel.as_icalendar()) once rather than per occurrence.
+
+    The VEVENTs are as RFC 5545 has them: cancelled occurrences only have STATUS:CANCELLED, GEO is latitude;longitude,
+    and URLs aren't escaped. With `vobject_compatible`, the output is instead byte for byte what vobject serializes for
+    OccurrenceModel.as_icalendar(): every value is escaped, cancelled occurrences have METHOD:CANCEL too, GEO is
+    longitude;latitude, and the properties are in vobject's order.
+
+    With `series`, each generator's occurrences are written as one recurring VEVENT, with an RRULE, EXDATEs and
+    overrides for edited occurrences (see GeneratorModel.ical_series()), where they can be. Series are in TIME_ZONE,
+    with a VTIMEZONE, rather than in UTC, so that they keep their local times across daylight saving changes. A series
+    has the summary, URL etc. of its first occurrence, so only use this if occurrences that follow their generator's
+    rule don't differ from each other in the attributes the calendar has.
+    """
+    def __init__(self,
+        request,
+        vobject_compatible=False,
+        series=False,
+        summary_attr='ical_summary',
+        description_attr='ical_description',
+        url_attr='get_absolute_url',
+        location_attr='venue_description',
+        latitude_attr='latitude',
+        longitude_attr='longitude',
+        cancelled_attr='is_cancelled',
+    ):
+        self.vobject_compatible = vobject_compatible
+        self.series = series
+        self.host = request.get_host()
+        self.domain = "".join(('http', ('', 's')[request.is_secure()], '://', self.host))
+        self.time_zone = getattr(settings, 'TIME_ZONE', None)
+        self.tz = self.time_zone and gettz(self.time_zone) or None
+        self.text_attrs = (('SUMMARY', summary_attr), ('DESCRIPTION', description_attr), ('LOCATION', location_attr))
+        self.url_attr = url_attr
+        self.latitude_attr = latitude_attr
+        self.longitude_attr = longitude_attr
+        self.cancelled_attr = cancelled_attr
+
+    def header(self):
+        lines = [
+            "BEGIN:VCALENDAR" + CRLF,
+            content_line("VERSION", "2.0"),
+            content_line("METHOD", "PUBLISH"), # IE/Outlook needs this
+            content_line("PRODID", PRODID),
+        ]
+        if not self.vobject_compatible: # vobject puts them after the events
+            lines.extend(self._calendar_names())
+        if self.series and self.tz is not None:
+            lines.append(vtimezone(self.time_zone))
+        return "".join(lines)
+
+    def footer(self):
+        lines = []
+        if self.vobject_compatible:
+            lines.extend(self._calendar_names())
+        lines.append("END:VCALENDAR" + CRLF)
+        return "".join(lines)
+
+    def _calendar_names(self):
+        return [content_line("X-WR-CALDESC", settings.ICAL_CALDESC), content_line("X-WR-CALNAME", settings.ICAL_CALNAME)]
+
+    def vevent(self, occurrence, series=None, recurrence_id=None):
+        """
+        The text of a VEVENT for `occurrence`. With a `series`, it overrides the series' occurrence at `recurrence_id`.
+        """
+        start, end = occurrence.start, occurrence.end
+        if occurrence.all_day:
+            start, end = start.date(), end.date()
+        elif self.tz is not None and not start.tzinfo and not end.tzinfo:
+            # Google Calendar (and probably others) can't handle timezone declarations, so convert to UTC
+            start = start.replace(tzinfo=self.tz).astimezone(UTC)
+            end = end.replace(tzinfo=self.tz).astimezone(UTC)
+
+        lines = ["BEGIN:VEVENT" + CRLF]
+        if series is None:
+            lines.append(content_line('UID', occurrence_uid(occurrence, self.host)))
+        else:
+            lines.append(content_line('UID', occurrence_uid(series.generator, self.host)))
+            lines.append(self._series_times('RECURRENCE-ID', [recurrence_id], series.generator.all_day))
+        lines.append(content_line('DTSTART', start))
+        lines.append(content_line('DTEND', end))
+        lines.extend(self._properties(occurrence))
+        lines.append("END:VEVENT" + CRLF)
+        return "".join(lines)
+
+    def series_vevent(self, series, occurrence):
+        """
+        The text of a recurring VEVENT for `series` (see GeneratorModel.ical_series()), with the attributes of its first
+        occurrence, `occurrence`.
+        """
+        generator = series.generator
+        all_day = generator.all_day
+        if all_day:
+            until = series.until.date()
+        elif self.tz is not None: # UNTIL has to be in UTC when DTSTART has a time zone
+            until = series.until.replace(tzinfo=self.tz).astimezone(UTC)
+        else:
+            until = series.until
+
+        lines = [
+            "BEGIN:VEVENT" + CRLF,
+            content_line('UID', occurrence_uid(generator, self.host)),
+            self._series_times('DTSTART', [series.dtstart], all_day),
+            self._series_times('DTEND', [series.dtstart + generator.event_duration], all_day),
+            content_line('RRULE', "%s;UNTIL=%s" % (series.recur, format_value(until)), escape=False),
+        ]
+        if series.exdates:
+            lines.append(self._series_times('EXDATE', series.exdates, all_day))
+        lines.extend(self._properties(occurrence))
+        lines.append("END:VEVENT" + CRLF)
+        return "".join(lines)
+
+    def _series_times(self, name, values, all_day):
+        """
+        A content line of the local datetimes `values`, as a series has them: dates for all-day series, otherwise
+        times in TIME_ZONE (or floating times, without one).
+        """
+        if all_day:
+            name += ";VALUE=DATE"
+            values = [value.date() for value in values]
+        elif self.tz is not None:
+            name += ";TZID=%s" % self.time_zone
+        return fold(u"%s:%s" % (name, u",".join([format_value(value) for value in values])))
+
+    def _properties(self, occurrence):
+        """
+        The content lines of the properties of `occurrence` other than its UID and times.
+        """
+        resolve = occurrence._resolve_attr
+        properties = [] # (name, value, escape)
+        if resolve(self.cancelled_attr):
+            if self.vobject_compatible:
+                properties.append(('METHOD', u'CANCEL', True))
+            properties.append(('STATUS', u'CANCELLED', True))
+        for name, attr in self.text_attrs:
+            value = resolve(attr)
+            if value:
+                properties.append((name, value, True))
+        url = resolve(self.url_attr)
+        if url:
+            properties.append(('URL', u"%s%s" % (self.domain, url), self.vobject_compatible))
+        lat, lon = resolve(self.latitude_attr), resolve(self.longitude_attr)
+        if lat and lon:
+            if self.vobject_compatible:
+                properties.append(('GEO', u"%s;%s" % (lon, lat), True))
+            else:
+                properties.append(('GEO', u"%s;%s" % (lat, lon), False))
+        if self.vobject_compatible:
+            properties.sort()
+        return [content_line(name, value, escape) for name, value, escape in properties]
+
+    def stream(self, occurrences, chunk_size=None, limit=None):
+        """
+        Yield the text of an iCalendar of (up to `limit` of) `occurrences`, a VEVENT at a time (see
+        iterate_in_chunks()).
+        """
+        yield self.header()
+        if self.series and can_write_series(occurrences):
+            for text in self._stream_series(occurrences, chunk_size, limit):
+                yield text
+        else:
+            for occurrence in iterate_in_chunks(occurrences, chunk_size, limit):
+                yield self.vevent(occurrence)
+        yield self.footer()
+
+    def _stream_series(self, occurrences, chunk_size=None, limit=None):
+        """
+        Yield the VEVENTs of `occurrences`, a queryset, with each generator's occurrences as a series where they can be.
+        `limit` is on the number of occurrences read, rather than of VEVENTs.
+        """
+        Generator = occurrences.model._meta.get_field('generator').rel.to
+        rows = {}
+        generated = occurrences.filter(generator__rule__isnull=False).order_by('start', 'pk')
+        generated = generated.values_list('pk', 'generator', 'start', 'end', 'event')
+        if limit is not None:
+            generated = generated[:limit]
+            limit -= len(generated)
+        for pk, generator_id, start, end, event_id in generated:
+            rows.setdefault(generator_id, []).append((pk, start, end, event_id))
+
+        for occurrence in iterate_in_chunks(occurrences.filter(generator__rule__isnull=True), chunk_size, limit):
+            yield self.vevent(occurrence)
+
+        for generator_ids in chunks(rows.keys(), chunk_size or settings.ICAL_CHUNK_SIZE):
+            series_list = []
+            unwritten = [] # the occurrences of generators that aren't written as series
+            pks = []
+            for generator in Generator._default_manager.filter(pk__in=generator_ids).select_related('rule'):
+                series = generator.ical_series(rows[generator.pk])
+                if series is None:
+                    unwritten.extend(rows[generator.pk])
+                else:
+                    series_list.append(series)
+                    pks.append(series.instance_pk)
+                    pks.extend([pk for recurrence_id, pk in series.overrides])
+                    pks.extend(series.standalone)
+
+            loaded = {}
+            for chunk in chunks(pks):
+                for occurrence in occurrences.model._default_manager.filter(pk__in=chunk).select_related('event'):
+                    loaded[occurrence.pk] = occurrence
+            for series in series_list:
+                if series.instance_pk in loaded: # unless it's just been deleted
+                    yield self.series_vevent(series, loaded[series.instance_pk])
+                for recurrence_id, pk in series.overrides:
+                    if pk in loaded:
+                        yield self.vevent(loaded[pk], series, recurrence_id)
+                for pk in series.standalone:
+                    if pk in loaded:
+                        yield self.vevent(loaded[pk])
+
+            unwritten.sort(key=lambda row: row[1])
+            for chunk in chunks([row[0] for row in unwritten], chunk_size or settings.ICAL_CHUNK_SIZE):
+                for occurrence in occurrences.model._default_manager.filter(pk__in=chunk) \
+                        .select_related('event').order_by('start', 'pk'):
+                    yield self.vevent(occurrence)
@@ -5,6 +5,9 @@ from django.db import connection
 
 class ModelInstanceAwareDefault():
     """
+    Deprecated: EventModel no longer uses this. Events created with a parent take the parent's fields_to_inherit in
+    EventModel.__init__ instead.
+
     This callable class provides model instance awareness in order to generate a default.
     It uses 9th level voodoo, so may break if django changes much. Probably much better to patch django to send the model instance and field into the callable.
     Could be expanded to be general.
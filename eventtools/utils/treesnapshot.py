@@ -0,0 +1,77 @@
+"""
+A compact copy of the MPTT fields of a whole tree model, for answering ancestor and descendant lookups in memory.
+"""
+from array import array
+
+class TreeSnapshot(object):
+    """
+    The id, parent id, tree_id, lft, rght and level of every node, in arrays in (tree_id, lft) order, so that a node's
+    descendants are the nodes that follow it. Pickles to a few strings, so it's cheap to keep in a cache.
+    """
+    COLUMNS = ('ids', 'parents', 'tree_ids', 'lefts', 'rights', 'levels')
+
+    def __init__(self, rows):
+        """
+        `rows` are (id, parent id, tree_id, lft, rght, level) tuples in (tree_id, lft) order.
+        """
+        for name in self.COLUMNS:
+            setattr(self, name, array('l'))
+        for pk, parent_id, tree_id, left, right, level in rows:
+            self.ids.append(pk)
+            self.parents.append(parent_id or 0) # ids start at 1
+            self.tree_ids.append(tree_id)
+            self.lefts.append(left)
+            self.rights.append(right)
+            self.levels.append(level)
+        self._index()
+
+    def _index(self):
+        self.positions = dict([(pk, i) for i, pk in enumerate(self.ids)])
+
+    def __getstate__(self):
+        return dict([(name, getattr(self, name).tostring()) for name in self.COLUMNS])
+
+    def __setstate__(self, state):
+        for name in self.COLUMNS:
+            column = array('l')
+            column.fromstring(state[name])
+            setattr(self, name, column)
+        self._index()
+
+    def __contains__(self, pk):
+        return pk in self.positions
+
+    def __len__(self):
+        return len(self.ids)
+
+    def ancestor_ids(self, pk, include_self=False):
+        """
+        The ids of the ancestors of node `pk`, root first.
+        """
+        position = self.positions[pk]
+        ids = include_self and [pk] or []
+        parent_id = self.parents[position]
+        while parent_id:
+            ids.append(parent_id)
+            parent_id = self.parents[self.positions[parent_id]]
+        ids.reverse()
+        return ids
+
+    def descendant_ids(self, pk, include_self=False):
+        """
+        The ids of the descendants of node `pk`, in tree order.
+        """
+        position = self.positions[pk]
+        count = (self.rights[position] - self.lefts[position] - 1) // 2
+        start = position if include_self else position + 1
+        return list(self.ids[start:position + 1 + count])
+
+    def child_ids(self, pk):
+        level = self.levels[self.positions[pk]] + 1
+        return [child for child in self.descendant_ids(pk) if self.levels[self.positions[child]] == level]
+
+    def family_ids(self, pk, include_self=True):
+        """
+        The ids of the ancestors and descendants of node `pk`, in tree order.
+        """
+        return self.ancestor_ids(pk) + self.descendant_ids(pk, include_self=include_self)
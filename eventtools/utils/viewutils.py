@@ -1,9 +1,16 @@
+from django.core.cache import cache
 from django.core.paginator import Paginator, EmptyPage, InvalidPage
 from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+from django.views.decorators.http import condition
 from eventtools.conf import settings
-from datetime import date
+from eventtools.utils import ics
+import hashlib
+from cStringIO import StringIO
+from datetime import date, datetime
 from dateutil import parser as dateparser
-from vobject import iCalendar
+from gzip import GzipFile
 
 
 def paginate(request, pool):
@@ -46,21 +53,101 @@ def parse_GET_date(GET={}):
         fr = date.today()
             
     return fr, to
+
+def parse_GET_window(GET={}, max_window=None):
+    """
+    The (start, end) dates of the window that parse_GET_date() reads from GET, with an open end closed at
+    `max_window` (a relativedelta, or None for no limit) from the other. Raises ValueError if the window is longer
+    than max_window.
+    """
+    fr, to = parse_GET_date(GET)
+    if max_window is None:
+        return fr, to
+    if to is None:
+        to = fr + max_window
+    elif fr is None:
+        fr = to - max_window
+    elif to > fr + max_window:
+        raise ValueError("The date window is too long.")
+    return fr, to
     
-def response_as_ical(request, occurrences):
-    ical = iCalendar()
-    ical.add('X-WR-CALNAME').value = settings.ICAL_CALNAME
-    ical.add('X-WR-CALDESC').value = settings.ICAL_CALDESC
-    ical.add('method').value = 'PUBLISH'  # IE/Outlook needs this
-
-    if hasattr(occurrences, '__iter__'):
-        for occ in occurrences:
-            ical = occ.as_icalendar(ical, request)
-    else:
-        ical = occurrences.as_icalendar(ical, request)
-    
-    icalstream = ical.serialize()
-    response = HttpResponse(icalstream, mimetype='text/calendar')
+def response_as_ical(request, occurrences, feed_key=None, model=None):
+    """
+    An iCalendar of `occurrences` (an occurrence, or an iterable or queryset of them), streamed a VEVENT at a time
+    (see eventtools.utils.ics), so memory use doesn't grow with the number of occurrences. At most
+    ICAL_MAX_OCCURRENCES occurrences are written.
+
+    The stream can only be read once, so reading the response's `content` (as GZipMiddleware, or CommonMiddleware
+    with USE_ETAGS, does) joins it into a string, which is kept and sent instead. Such middleware therefore holds the
+    whole feed in memory.
+
+    With ICAL_CACHE and a `feed_key` (what decides which occurrences are in the feed, other than the request's URL, eg.
+    its date window), the feed is cached gzipped, and conditional GETs are answered from the change version of
+    `model`'s occurrences (see OccurrenceModel.change_version()). `occurrences` can then be a callable that returns
+    them, so that a 304, or a feed from the cache, doesn't need them.
+    """
+    if settings.ICAL_CACHE and feed_key is not None:
+        return _cached_response_as_ical(request, occurrences, feed_key, model or occurrences.model)
+    if callable(occurrences):
+        occurrences = occurrences()
+    return _ical_response(_ical_writer(request).stream(_as_iterable(occurrences),
+        limit=settings.ICAL_MAX_OCCURRENCES))
+
+def _as_iterable(occurrences):
+    if not hasattr(occurrences, '__iter__'):
+        return [occurrences]
+    return occurrences
+
+def _ical_writer(request):
+    return ics.CalendarWriter(request,
+        vobject_compatible=settings.ICAL_VOBJECT_COMPATIBLE, series=settings.ICAL_SERIES)
+
+class ICalResponse(HttpResponse):
+    """
+    An HttpResponse whose content can be an iterator, as in response_as_ical. The first read of `content` joins the
+    iterator into a string and keeps it, so the content can be read again and is still sent to the client.
+    """
+    def _get_content(self):
+        if not self._is_string:
+            self._set_content(HttpResponse._get_content(self))
+        return HttpResponse._get_content(self)
+
+    content = property(_get_content, HttpResponse._set_content)
+
+def _ical_response(content):
+    response = ICalResponse(content, mimetype='text/calendar')
     response['Filename'] = 'events.ics'  # IE needs this
     response['Content-Disposition'] = 'attachment; filename=events.ics'
     return response
+
+def _cached_response_as_ical(request, occurrences, feed_key, model):
+    token, timestamp = model.change_version()
+    key = hashlib.md5(repr((request.get_host(), request.is_secure(), request.path,
+        sorted(request.GET.items()), feed_key, token))).hexdigest()
+    gzipped = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    # the gzipped feed is a different representation, so it has its own (strong) ETag
+    etag = gzipped and key + '-gzip' or key
+
+    def render(request):
+        content = cache.get('eventtools.ical.%s' % key)
+        if content is None:
+            feed = occurrences
+            if callable(feed):
+                feed = feed()
+            content = compress_string("".join(_ical_writer(request).stream(_as_iterable(feed),
+                limit=settings.ICAL_MAX_OCCURRENCES)))
+            cache.set('eventtools.ical.%s' % key, content, settings.ICAL_CACHE_TIMEOUT)
+        if not gzipped:
+            content = GzipFile(fileobj=StringIO(content)).read()
+        response = _ical_response(content)
+        if gzipped:
+            response['Content-Encoding'] = 'gzip'
+        response['Content-Length'] = str(len(content))
+        return response
+
+    response = condition(
+        etag_func=lambda request: etag,
+        last_modified_func=lambda request: datetime.utcfromtimestamp(int(timestamp)),
+    )(render)(request)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
@@ -2,13 +2,14 @@ from dateutil.relativedelta import relativedelta
 
 from django.conf.urls.defaults import *
 from django.core.paginator import Paginator, EmptyPage, InvalidPage
+from django.http import HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template.context import RequestContext
 from django.utils.safestring import mark_safe
 
 from eventtools.conf import settings
 from eventtools.utils.pprint_timespan import humanized_date_range
-from eventtools.utils.viewutils import paginate, response_as_ical
+from eventtools.utils.viewutils import paginate, parse_GET_window, response_as_ical
 
 class EventViews(object):
     #define
@@ -40,14 +41,15 @@ class EventViews(object):
         return render_to_response('eventtools/occurrence.html', context, context_instance=RequestContext(request))
 
     def occurrence_ical(self, request, occurrence_id):
-        context = self._occurrence_context(request, occurrence_id)
-        return response_as_ical(request, [context['occurrence']])
+        return response_as_ical(request,
+            lambda: [self._occurrence_context(request, occurrence_id)['occurrence']],
+            feed_key=('occurrence', occurrence_id), model=self.occurrence_qs.model)
         
     #event
     def _event_context(self, request, event_slug):
         event = get_object_or_404(self.event_qs, slug=event_slug)
         event_descendants = event.get_descendants(include_self=True)
-        occurrence_pool = event_descendants.occurrences()
+        occurrence_pool = event.Occurrence().objects.in_subtree_of(event)
 
         return {
             'event': event,
@@ -67,8 +69,9 @@ class EventViews(object):
         return render_to_response('eventtools/occurrence_list.html', event_context, context_instance=RequestContext(request))
  
     def event_ical(self, request, event_slug):
-        event_context = self._event_context(request, event_slug)
-        return response_as_ical(request, event_context['occurrence_pool'])
+        return response_as_ical(request,
+            lambda: self._event_context(request, event_slug)['occurrence_pool'],
+            feed_key=('event', event_slug), model=self.occurrence_qs.model)
 
     #occurrence_list
     def _occurrence_list_context(self, request, qs):
@@ -96,7 +99,7 @@ class EventViews(object):
             return {
                 'bounded': True,
                 'pageinfo': pageinfo,
-                'occurrence_pool': qs,
+                'occurrence_pool': occurrence_pool,
                 'occurrence_page': occurrence_pool,
                 'selected_start': date_bounds[0],        
                 'selected_end': date_bounds[1],        
@@ -125,6 +128,19 @@ class EventViews(object):
         return render_to_response(template ,occurrence_context, context_instance=RequestContext(request))
         
     def occurrence_list_ical(self, request):
-        occurrence_list_context = self._occurrence_list_context(request, self.occurrence_qs)
-        pool = occurrence_list_context['occurrence_pool']
-        return response_as_ical(request, pool)
+        """
+        The occurrences in the window from_GET() reads (today onwards, by default), with an open end closed at
+        ICAL_MAX_WINDOW from the other. Longer windows are a bad request.
+        """
+        try:
+            window = parse_GET_window(request.GET, settings.ICAL_MAX_WINDOW)
+        except ValueError, e:
+            return HttpResponseBadRequest(str(e))
+
+        def occurrences():
+            pool = self.occurrence_qs.from_GET(request.GET)[0]
+            if None not in window:
+                pool = pool.between(*window)
+            return pool
+        return response_as_ical(request, occurrences,
+            feed_key=('occurrence_list', window), model=self.occurrence_qs.model)